@@ -15,6 +15,9 @@ path_sct = os.environ.get("SCT_DIR", os.path.dirname(os.path.dirname(__file__)))
 # append path that contains scripts, to be able to load modules
 sys.path.append(os.path.join(path_sct, 'scripts'))
 import sct_utils as sct
+# append path of the atlas loader
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'validate_atlas'))
+from load_atlas import load_atlas
 
 # parameters
 tracts_to_sum_index = 0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29
@@ -25,11 +28,11 @@ file_label = 'info_label.txt'
 
 
 def main():
-    # Extract the tracts from the atlas' folder
-    tracts = get_tracts(folder_atlas)
-    nb_tracts = len(tracts)
+    # Extract the tracts from the atlas' folder (nb_tracts x nx x ny x nz)
+    atlas = load_atlas(folder_atlas)[0]
+    nb_tracts = len(atlas)
     # Get the sum of the tracts
-    tracts_sum = add_tracts(tracts, tracts_to_sum_index)
+    tracts_sum = add_tracts(atlas, tracts_to_sum_index)
     # Save sum of the tracts to niftii
     save_3D_nparray_nifti(tracts_sum, 'tmp.WM_all.nii.gz', os.path.join(folder_atlas, "WMtract__00.nii.gz"))
     # binarize it
@@ -40,27 +43,7 @@ def main():
     sct.run('fslmaths tmp.WM_all_bin_dil -sub tmp.WM_all '+os.path.join(os.path.join(folder_atlas, file_csf)))
     # add line in info_label.txt
     text_label = '\n'+str(nb_tracts)+', CSF, '+file_csf
-    io.open(os.path.join(folder_atlas, file_label) 'a+b').write(text_label)
-
-def get_tracts(tracts_folder):
-    """Loads tracts in an atlas folder and converts them from .nii.gz format to numpy ndarray 
-    Save path of each tracts
-    Only the tract must be in tracts_format in the folder"""
-    fname_tract = glob.glob(os.path.join(tracts_folder, "*.nii.gz"))
-    
-    #Initialise tracts variable as object because there are 4 dimensions
-    tracts = np.empty([len(fname_tract), 1], dtype=object)
-    
-    #Load each partial volumes of each tracts
-    for label in range(0, len(fname_tract)):
-       tracts[label, 0] = nib.load(fname_tract[label]).get_data()
-    
-    #Reshape tracts if it is the 2D image instead of 3D
-    for label in range(0, len(fname_tract)):
-       if (tracts[label,0]).ndim == 2:
-           tracts[label,0] = tracts[label,0].reshape(int(np.size(tracts[label,0],0)), int(np.size(tracts[label,0],1)),1)
-    return tracts
-
+    io.open(os.path.join(folder_atlas, file_label), 'a+b').write(text_label)
 
 def save_3D_nparray_nifti(np_matrix_3d, output_image, fname_atlas):
     # Save 3d numpy matrix to niftii image
@@ -74,11 +57,8 @@ def save_3D_nparray_nifti(np_matrix_3d, output_image, fname_atlas):
     sct.run('fslcpgeom '+fname_atlas+' '+output_image, verbose=0)
 
 
-def add_tracts(tracts, tracts_to_sum_index):
-    tracts_sum = np.empty((tracts[0, 0]).shape)
-    for i in tracts_to_sum_index:
-        tracts_sum = tracts_sum + tracts[i, 0]
-    return tracts_sum
+def add_tracts(atlas, tracts_to_sum_index):
+    return atlas[list(tracts_to_sum_index)].sum(axis=0, dtype=np.float64)
 
 
 if __name__ == "__main__":
@@ -16,14 +16,15 @@
 # Author : Charles Naaman
 # Created : 31-07-2014
 
-import sys, io, os, re, glob, math
+import sys, os, glob
 
 import numpy as np
 
 path_sct = os.environ.get("SCT_DIR", os.path.dirname(os.path.dirname(__file__)))
 # append path that contains scripts, to be able to load modules
 sys.path.append(os.path.join(path_sct, "scripts"))
-import sct_utils as sct
+from load_atlas import load_atlas
+from multi_rater_dice import binarize, load_masks, dice_atlas_user, dice_user_user, pairs_mean
 
 
 # Tracts for which masks are created
@@ -31,6 +32,9 @@ import sct_utils as sct
 selected_tracts = (2,17)
 selected_tracts = list(selected_tracts)
 
+# Tracts of the dorsal column
+dorsal_column_tracts = [0, 1, 15, 16]
+
 # Folder where the results of dice estimation are outputed
 DICE_estimation_folder= 'DICE_coefficient'
 if not os.path.isdir(DICE_estimation_folder):
@@ -42,112 +46,54 @@ results_file = os.path.join(DICE_estimation_folder, 'results.txt')
 # Folder where the atlas of the tracts are
 atlas_tracts_folder = 'cropped_atlas'
 
-# Tract of the dorsal column
-sct.run('./add_tracts_dc.py')
-dorsal_column_tract = os.path.join(DICE_estimation_folder, 'dorsal_column.nii.gz')
-
-# Name and path of the binarized created tracts 
-bin_tracts_folder = os.path.join(DICE_estimation_folder, 'bin_tracts')
-
-# Remove all of the binarized tracts already in the folder
-if os.path.isdir(bin_tracts_folder):
-    shutil.rmtree(bin_tracts_folder)
-os.makedirs(bin_tracts_folder)
-
-bin_tracts_prefix = 'bin_tract_mask'
-
 # Folder where the manually made masks of tracts are located
 # In this folder, each subfolder has to contain manually created masks by different users. No other subfolders are allowed.
+# The masks of each user, sorted by name, correspond to the selected tracts and then to the dorsal column
 manual_masks_folder = 'manual_masks'
 
 # Get the names of the folders created by user
-user_folders = os.walk(manual_masks_folder).next()[1]
+user_folders = sorted(os.walk(manual_masks_folder).next()[1])
 
 # Determine the number of different users
 number_users = len(user_folders)
 
 
-# Extract the name of the different tracts in the atlas
-fname_atlas_tract = glob.glob(os.path.join(atlas_tracts_folder, '*.nii.gz'))
-fname_atlas_tract.append(dorsal_column_tract)
+# Load the tracts of the atlas, and add the dorsal column
+atlas = load_atlas(atlas_tracts_folder)[0]
+tracts = np.concatenate((atlas[selected_tracts], atlas[dorsal_column_tracts].sum(axis=0)[np.newaxis]))
+tracts_name = [str(i) for i in selected_tracts] + ['dorsal column']
 
-# Create binarized tracts 
-selected_tracts.append(len(fname_atlas_tract)-1)
+# Binarize the tracts (threshold at 0.5)
+bin_tracts = binarize(tracts, 0.5)
 
-# Create the name of the different binarized tracts
-fname_bin_tract = [None]*(len(fname_atlas_tract)+1)
-for i in selected_tracts:
-    if i < 10:
-        fname_bin_tract[i] = os.path.join(bin_tracts_folder, bin_tracts_prefix + '0' + str(i) + '.nii.gz')
-    else:
-        fname_bin_tract[i] = os.path.join(bin_tracts_folder, bin_tracts_prefix + str(i) + '.nii.gz')
-        
-# Initialize arrays in which DICE estimation results are saved
-DICE_atlas_user = np.zeros([number_users, len(selected_tracts)])
-DICE_user_user =  np.zeros([math.factorial(number_users-1), len(selected_tracts)])
+# Load the masks created by the users: users x tracts x voxels
+user_masks = np.array([load_masks(sorted(glob.glob(os.path.join(manual_masks_folder, user, '*.nii*'))), atlas.shape[1:])
+                       for user in user_folders])
 
-# Extract a list of the masks for each user
-fname_mask = [None]*(len(fname_atlas_tract)+1)
+# Calculate 3D DICE coefficient between the binarized tracts and the masks of each user, for each tract
+DICE_atlas_user = dice_atlas_user(bin_tracts, user_masks)
 
+# Calculate 3D DICE coefficient between masks created by different users, for each tract
+DICE_user_user = dice_user_user(user_masks)
 
-# Put tracts equal to 0 under the threshold    
+# Print results in the results file
+f = open(results_file, 'w')
+f.write('=====================================================================================\n')
+f.write('3D DICE coefficient between atlas and user\n')
+f.write('=====================================================================================\n')
+for j in range(0, number_users):
+    f.write(user_folders[j] + '\t : ' + str(round(np.mean(DICE_atlas_user[j, :]), 3)) + '\n')
+f.write('=====================================================================================\n')
+f.write('3D DICE coefficient between users\n')
+f.write('=====================================================================================\n')
+DICE_user_user_mean = pairs_mean(DICE_user_user)
+for i in range(0, len(tracts_name)):
+    f.write('tract ' + tracts_name[i] + ' : \t ' + str(round(DICE_user_user_mean[i], 3)) + '\n')
+f.close()
 
-for i in selected_tracts:
-    sct.run('fslmaths ' + fname_atlas_tract[i] + ' -thr 0.5 ' + fname_bin_tract[i])
-    sct.run('fslmaths ' + fname_bin_tract[i] + ' -bin ' + fname_bin_tract[i])
-    
-# Initialize results_file
-sct.run('echo "=====================================================================================" > ' + results_file)
-sct.run('echo "3D DICE coefficient between atlas and user" >> ' + results_file)
-sct.run('echo "=====================================================================================" >> ' + results_file)
+print open(results_file).read()
 
 
-for j in range(0, number_users):
-    # Get the name and path of the masks created by the user
-    fname_mask[j] = glob.glob(os.path.join(manual_masks_folder, user_folders[j] + '*'))
-    for i in selected_tracts:
-        # Adjust geometry of the binarized tracts and the masks created by user
-        sct.run('fslcpgeom ' + fname_mask[j][selected_tracts.index(i)] + ' ' + fname_bin_tract[i])
-        # Calculate dice coefficient for each tract
-        status, output = sct.run('sct_dice_coefficient ' + fname_mask[j][selected_tracts.index(i)] + ' ' + fname_bin_tract[i])
-        # Remove non decimal values from output
-        non_decimal = re.compile(r'[^\d.]+')
-        output = non_decimal.sub('', output)        
-        # Remove the first number since it does not correspond with the dice coefficient
-        output = output[1:]
-        DICE_atlas_user[j, selected_tracts.index(i)] = float(output)
-    sct.run('echo ' +  user_folders[j] + '\t : ' + str(round(np.mean(DICE_atlas_user[j,:]),3)) + ' >> ' + results_file)
-    
-      
-sct.run('echo "=====================================================================================" >> ' + results_file)
-sct.run('echo "3D DICE coefficient between users" >> ' + results_file)
-sct.run('echo "=====================================================================================" >> ' + results_file)
-
-
-    # Calculate 3D DICE coefficient between masks created by different users
-
-for i in selected_tracts:
-    # Index of the inter-user dice coefficient, the number of coefficients are equal to factorial(number_users)
-    index = 0
-    for j in range(0, number_users - 1):
-        # Get the name and path of the masks created by the user
-        for l in range(j+1, number_users):
-            # Calculate DICE coefficient for each tract
-            status,output = sct.run('sct_dice_coefficient ' + fname_mask[j][selected_tracts.index(i)] + ' ' + fname_mask[l][selected_tracts.index(i)] + ' -o output.txt' )
-            # Remove non decimal values from output
-            non_decimal = re.compile(r'[^\d.]+')
-            output = non_decimal.sub('', output)        
-            # Remove the first number since it does not correspond with the dice coefficient
-            output = output[1:]
-            DICE_user_user[index, selected_tracts.index(i)] = float(output)
-            index=index+1
-    # Print results in the results file
-    sct.run('echo  tract ' + str(i) + ' : \t ' +  str(round(np.mean(DICE_atlas_user[:,selected_tracts.index(i)]),3)) + ' >> ' + results_file )
-
-status, output = sct.run('cat ' + results_file)
-print output
-   
-      
 #  OlD STUFF: sum the tracts and calculate DICE on the tracts_sum
 # # Calculate 3D DICE coefficient between binarized atlas tracts and masks made by user
 # If dice_sum = 0, the DICE coefficient is calculated for each tract individually
@@ -7,6 +7,10 @@
 import os
 import getopt
 import sys
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import nibabel as nib
 path_sct = os.environ.get("SCT_DIR", os.path.dirname(os.path.dirname(__file__)))
 # append path that contains scripts, to be able to load modules
 sys.path.append(os.path.join(path_sct, "scripts"))
@@ -44,25 +48,51 @@ def main():
     sct.run('mkdir '+folder_out)
 
     # get atlas files
-    status, output = sct.run('ls '+os.path.join(folder_in, '*.nii.gz') verbose)
+    status, output = sct.run('ls '+os.path.join(folder_in, '*.nii.gz'), verbose)
     fname_list = output.split()
 
+    # crop all the files
+    crop_files(fname_list, folder_out, zind)
+
 
-    # loop across atlas
-    for i in xrange(0, len(fname_list)):
-        path_list, file_list, ext_list = sct.extract_fname(fname_list[i])
-        crop_file(fname_list[i], folder_out, zind)
-    
 def crop_file(fname_data, folder_out, zind):
-    # extract file name
-    path_list, file_list, ext_list = sct.extract_fname(fname_data)
-   
-   # crop file with fsl, and then merge back
-    cmd = 'fslmerge -z '+os.path.join(folder_out, file_list)
-    for i in zind:
-        sct.run('fslroi '+fname_data+' z'+str(zind.index(i))+'_'+file_list+' 0 -1 0 -1 '+str(i)+' 1')
-        cmd = cmd+' z'+str(zind.index(i))+'_'+file_list
-    sct.run(cmd)
+    """
+    Extract z-slices of an image (as fslroi on each slice followed by fslmerge -z, without temporary files)
+    :param fname_data: image file
+    :param folder_out: output folder (the cropped image has the same file name)
+    :param zind: list of the z indices of the slices to extract, in the order of the output slices
+    :return: file name of the cropped image
+    """
+    path_data, file_data, ext_data = sct.extract_fname(fname_data)
+    zind = [int(iz) for iz in zind]
+    img = nib.load(fname_data)
+    # load the file once and gather the slices
+    data = np.asanyarray(img.dataobj)[:, :, zind, ...]
+    # origin of the output image at the first slice, as fslroi does
+    affine = img.get_affine().copy()
+    affine[:3, 3] = np.dot(affine, [0, 0, zind[0], 1])[:3]
+    header = img.get_header().copy()
+    header.set_data_dtype(img.get_data_dtype())
+    fname_out = os.path.join(folder_out, file_data+ext_data)
+    nib.save(nib.Nifti1Image(data, affine, header), fname_out)
+    return fname_out
+
+
+def crop_files(fname_list, folder_out, zind, nb_threads=None):
+    """
+    Crop images in parallel (see crop_file)
+    :param nb_threads: number of threads (default: number of CPUs)
+    :return: file names of the cropped images
+    """
+    if not nb_threads:
+        nb_threads = multiprocessing.cpu_count()
+    pool = ThreadPool(max(1, min(nb_threads, len(fname_list))))
+    try:
+        return pool.map(lambda fname_data: crop_file(fname_data, folder_out, zind), fname_list)
+    finally:
+        pool.close()
+        pool.join()
+
 
 def usage():
     print '\n' \
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# In-process estimation of a metric within the labels (tracts) of an atlas
+#
+# Same estimation methods as sct_extract_metric (bin, wa, wath, ml, map), computed directly
+# from a numpy array and the atlas loaded in memory: used by validate_atlas to avoid saving
+# the phantoms to NIfTI files, running sct_extract_metric in a new process and parsing its
+# text output at each bootstrap iteration.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2014 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import numpy as np
+from sparse_atlas import SparseAtlas
+
+
+# methods estimating the metric from the atlas
+list_methods_auto = ['bin', 'wa', 'wath', 'ml', 'map']
+# partial volume threshold of the binary (bin) and thresholded (wath) methods
+threshold_label = 0.5
+
+
+def average_within_mask(data, mask):
+    """
+    Weighted average of data within a mask (as sct_average_data_within_mask)
+    :param data: 3d numpy array
+    :param mask: 3d numpy array of weights, same shape as data
+    :return: float
+    """
+    mask = np.asarray(mask, dtype=np.float64)
+    return float((data * mask).sum() / mask.sum())
+
+
+def weighted_average(data, weights):
+    """
+    Weighted average of data within each map of weights
+    :param data: 3d numpy array
+    :param weights: array of maps of weights (nb_maps x nx x ny x nz)
+    :return: array of nb_maps values
+    """
+    weights = weights.reshape(len(weights), -1)
+    return np.dot(weights, data.ravel()) / weights.sum(axis=1)
+
+
+def extract_metric(data, atlas, method, labels=None, average_labels=0, param_map='20,20'):
+    """
+    Estimate the metric within labels of the atlas, as sct_extract_metric does
+    :param data: 3d numpy array of the metric
+    :param atlas: partial volume maps of all the labels of the atlas (nb_labels x nx x ny x nz), see load_atlas, or
+    SparseAtlas
+    :param method: 'bin': average within the labels binarized at threshold_label
+                   'wa': average weighted by the partial volumes
+                   'wath': average weighted by the partial volumes, set to 0 below threshold_label
+                   'ml': maximum likelihood, least squares fit of all the labels together
+                   'map': maximum a posteriori, least squares fit with a gaussian prior on the values of the labels
+    :param labels: indices of the labels to estimate (default: all)
+    :param average_labels: if 1, return a single value for all the selected labels together: the labels are merged
+    (bin, wa, wath) or their estimates are averaged, weighted by their volume (ml, map)
+    :param param_map: 'std_tract,std_noise' prior std of the values of the labels and std of the noise, in percent of
+    the prior value of the labels (the weighted average within all the labels)
+    :return: array of estimates, one per label (or a single one if average_labels)
+    """
+    if method not in list_methods_auto:
+        raise ValueError('Unknown method: '+method)
+    is_sparse = isinstance(atlas, SparseAtlas)
+    nb_labels = atlas.nb_labels if is_sparse else len(atlas)
+    if labels is None:
+        labels = range(nb_labels)
+    labels = list(labels)
+
+    if method in ['bin', 'wa', 'wath']:
+        if is_sparse:
+            threshold = None if method == 'wa' else threshold_label
+            return atlas.weighted_average(data, labels, threshold, method == 'bin', average_labels)
+        weights = atlas[labels]
+        if method == 'bin':
+            weights = (weights >= threshold_label).astype(np.float64)
+        elif method == 'wath':
+            weights = np.where(weights >= threshold_label, weights, 0)
+        if average_labels:
+            weights = weights.sum(axis=0)[np.newaxis]
+        return weighted_average(data, weights)
+
+    # ml, map: fit of the partial volume model y = P x over the voxels of the labels
+    if is_sparse:
+        PtP, Pty = atlas.normal_equations(data)
+        volumes = atlas.volumes()
+    else:
+        P = atlas.reshape(nb_labels, -1)
+        index_voxels = np.nonzero(P.sum(axis=0) > 0)[0]
+        P = P[:, index_voxels].T  # nb_voxels x nb_labels
+        y = data.ravel()[index_voxels]
+        PtP, Pty = np.dot(P.T, P), np.dot(P.T, y)
+        volumes = P.sum(axis=0)
+    if method == 'ml':
+        if is_sparse:
+            x = np.linalg.lstsq(PtP, Pty, rcond=-1)[0]
+        else:
+            x = np.linalg.lstsq(P, y, rcond=-1)[0]
+    else:
+        std_tract, std_noise = [float(p) for p in param_map.split(',')]
+        # prior: the same value in every label, the weighted average within all the labels
+        x0 = Pty.sum() / volumes.sum()
+        var_tract = (std_tract / 100 * x0) ** 2
+        var_noise = (std_noise / 100 * x0) ** 2
+        if var_tract == 0:
+            # no deviation from the prior allowed
+            x = x0 * np.ones(nb_labels)
+        else:
+            # x = x0 + (P'P/var_noise + I/var_tract)^-1 P'(y - P x0)/var_noise
+            A = PtP + (var_noise / var_tract) * np.eye(nb_labels)
+            x = x0 + np.linalg.solve(A, Pty - x0 * PtP.sum(axis=1))
+    x = x[labels]
+    if average_labels:
+        volumes = volumes[labels]
+        return np.array([np.dot(volumes, x) / volumes.sum()])
+    return x
@@ -4,7 +4,7 @@
 # Saves the phantom to a niftii image afterwards
 
 ## Import common Python libraries
-# import os
+import os
 # import getopt
 # import sys
 # import time
@@ -17,6 +17,7 @@ import numpy as np
 # import math
 import random
 import nibabel as nib
+from load_atlas import load_atlas, atlas_to_tracts
 # from numpy import mean, asarray, std, zeros, sum, ones, dot, eye, sqrt, empty, size, linspace, abs, amin, argmin, concatenate, array
 # from numpy.linalg import solve,pinv
 
@@ -116,6 +117,61 @@ def phantom_generation(tracts, std_noise_perc, range_tract_perc, true_value, fol
     return[synthetic_vol, synthetic_voln, values_synthetic_data, tracts_sum]
 
 
+#=======================================================================================================================
+# batch phantom generation
+#=======================================================================================================================
+def tracts_to_matrix(atlas):
+    """
+    Matrix of the tracts, one row per tract
+    :param atlas: atlas of tracts (numtracts x nx x ny x nz), as returned by load_atlas
+    :return: tracts_matrix (numtracts x nvox, float32, a view of the atlas when possible), shape of the volume (nx, ny, nz)
+    """
+    shape = atlas.shape[1:]
+    return np.ascontiguousarray(atlas, dtype=np.float32).reshape(len(atlas), -1), shape
+
+
+def phantom_generation_batch(tracts_matrix, shape, nb_phantoms, std_noise_perc, range_tract_perc, true_value, value_gm, value_csf):
+    """
+    Generate several phantoms at once, as phantom_generation does: each phantom is the product of its tract values by
+    the matrix of tracts, computed for all the phantoms with one matrix product, and the noise is drawn for all the
+    phantoms together
+    :param tracts_matrix: numtracts x nvox matrix of tracts (see tracts_to_matrix)
+    :param shape: shape of the volume
+    :param nb_phantoms: number of phantoms
+    :param std_noise_perc: std of the gaussian noise, in percentage of the true value
+    :param range_tract_perc: range of the uniformly-distributed tract values, in percentage of the true value
+    :param true_value: true value of the tract
+    :param value_gm: value of the gray matter (second last tract)
+    :param value_csf: value of the CSF (last tract)
+    :return: synthetic_vols, synthetic_volns (nb_phantoms x nx x ny x nz, float32), record: dict with the parameters
+    (std_noise, range_tract, true_value) and the values of the tracts of each phantom (values, nb_phantoms x numtracts),
+    in place of phantom_values.txt
+    """
+    # Transform std noise and range tract to a percentage of the true value
+    range_tract = float(range_tract_perc) / 100 * true_value
+    std_noise = float(std_noise_perc) / 100 * true_value
+    numtracts = tracts_matrix.shape[0]
+
+    # values of the tracts: true_value - range_tract <= values <= true_value + range_tract, then GM and CSF
+    values_synthetic_data = true_value - range_tract + np.random.uniform(0, 2*range_tract, size=(nb_phantoms, numtracts))
+    values_synthetic_data[:, numtracts-2] = value_gm
+    values_synthetic_data[:, numtracts-1] = value_csf
+
+    # phantoms: one row per phantom
+    synthetic_vols = np.dot(values_synthetic_data.astype(np.float32), tracts_matrix)
+
+    # add gaussian noise
+    if not std_noise == 0:
+        synthetic_volns = synthetic_vols + np.random.normal(loc=0, scale=std_noise, size=synthetic_vols.shape).astype(np.float32)
+    else:
+        synthetic_volns = synthetic_vols
+
+    record = {'std_noise': std_noise_perc, 'range_tract': range_tract_perc, 'true_value': true_value,
+              'values': values_synthetic_data}
+    shape_batch = (nb_phantoms,) + tuple(shape)
+    return [synthetic_vols.reshape(shape_batch), synthetic_volns.reshape(shape_batch), record]
+
+
 #=======================================================================================================================
 # Save 3D numpy array to a nifti
 #=======================================================================================================================
@@ -140,23 +196,12 @@ def save_3D_nparray_nifti(np_matrix_3d, output_image, fname_atlas):
 # Get tracts 
 #=======================================================================================================================
 def get_tracts(tracts_folder):
-    # Loads tracts in an atlas folder and converts them from .nii.gz format to numpy ndarray 
-    # Save path of each tracts
-    # Only the tract must be in tracts_format in the folder
-    fname_tract = glob.glob(tracts_folder + '/*' + '.nii.gz')
-    
-    #Initialise tracts variable as object because there are 4 dimensions
-    tracts = np.empty([len(fname_tract), 1], dtype=object)
-    
-    #Load each partial volumes of each tracts
-    for label in range(0, len(fname_tract)):
-       tracts[label, 0] = nib.load(fname_tract[label]).get_data()
-    
-    #Reshape tracts if it is the 2D image instead of 3D
-    for label in range(0, len(fname_tract)):
-       if (tracts[label,0]).ndim == 2:
-           tracts[label,0] = tracts[label,0].reshape(int(np.size(tracts[label,0],0)), int(np.size(tracts[label,0],1)),1)
-    return tracts
+    """
+    Load the tracts of an atlas folder (see load_atlas)
+    :param tracts_folder: folder of the atlas
+    :return: np array of tracts (numtracts x 1, object), in the order of info_label.txt
+    """
+    return atlas_to_tracts(load_atlas(tracts_folder)[0])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Load an atlas of tracts (one partial volume NIfTI file per label) as a single array
+#
+# The labels are read in the order of info_label.txt. The decompressed atlas is cached in the
+# atlas folder as an uncompressed .npy file, loaded as a memory map, along with the name, size
+# and modification time of the files it was built from: as long as they do not change, loading
+# the atlas does not decompress the tracts again.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2014 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import glob
+import json
+import numpy as np
+import nibabel as nib
+
+
+file_label_default = 'info_label.txt'
+file_cache = 'atlas_cache.npy'
+file_cache_key = 'atlas_cache.json'
+
+
+def read_label_file(folder_atlas, file_label=file_label_default):
+    """
+    Read the labels of the atlas (combined labels are ignored)
+    :param folder_atlas: folder of the atlas
+    :param file_label: file listing the labels ('ID, name, file' per line), in the atlas folder. If it does not exist,
+    the .nii.gz files of the folder are used, sorted by name
+    :return: label_id, label_name, label_file (lists)
+    """
+    fname_label = os.path.join(folder_atlas, file_label)
+    if not os.path.isfile(fname_label):
+        label_file = sorted(os.path.basename(fname) for fname in glob.glob(os.path.join(folder_atlas, '*.nii.gz')))
+        return range(len(label_file)), [os.path.splitext(os.path.splitext(f)[0])[0] for f in label_file], label_file
+    label_id, label_name, label_file = [], [], []
+    for line in open(fname_label):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = [field.strip() for field in line.split(',')]
+        # the combined labels list label ranges instead of files
+        if len(fields) < 3 or not (fields[-1].endswith('.nii.gz') or fields[-1].endswith('.nii')):
+            continue
+        label_id.append(int(fields[0]))
+        label_name.append(', '.join(fields[1:-1]))
+        label_file.append(fields[-1])
+    return label_id, label_name, label_file
+
+
+def cache_key(folder_atlas, file_label, label_file):
+    """name, size and modification time of the files the atlas is built from"""
+    key = []
+    for fname in [file_label] + list(label_file):
+        path = os.path.join(folder_atlas, fname)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            key.append([fname, stat.st_size, stat.st_mtime])
+    return key
+
+
+def load_atlas(folder_atlas, file_label=file_label_default, cache=1):
+    """
+    Load all the labels of an atlas in one contiguous array
+    :param folder_atlas: folder of the atlas
+    :param file_label: file listing the labels (see read_label_file)
+    :param cache: if 1, use (and update if needed) the uncompressed cache of the atlas folder. The cached atlas is
+    returned as a read-only memory map
+    :return: atlas (float32, nb_labels x nx x ny x nz, 2D tracts get nz=1), label_id, label_name, label_file
+    """
+    label_id, label_name, label_file = read_label_file(folder_atlas, file_label)
+    fname_cache = os.path.join(folder_atlas, file_cache)
+    fname_key = os.path.join(folder_atlas, file_cache_key)
+    key = cache_key(folder_atlas, file_label, label_file)
+
+    if cache and os.path.isfile(fname_cache) and os.path.isfile(fname_key):
+        try:
+            if json.load(open(fname_key)) == key:
+                return np.load(fname_cache, mmap_mode='r'), label_id, label_name, label_file
+        except ValueError:
+            pass  # corrupted key: rebuild the cache
+
+    # load the tracts
+    atlas = None
+    for i_label in range(len(label_file)):
+        data = nib.load(os.path.join(folder_atlas, label_file[i_label])).get_data()
+        if data.ndim == 2:
+            data = data.reshape(data.shape[0], data.shape[1], 1)
+        if atlas is None:
+            atlas = np.empty((len(label_file),) + data.shape, dtype=np.float32)
+        atlas[i_label] = data
+
+    if cache and atlas is not None:
+        # write to temporary files then rename, so that concurrent loads never read a partial cache
+        try:
+            suffix = '.tmp' + str(os.getpid())
+            np.save(fname_cache + suffix, atlas)
+            os.rename(fname_cache + suffix + '.npy', fname_cache)
+            json.dump(key, open(fname_key + suffix, 'w'))
+            os.rename(fname_key + suffix, fname_key)
+        except (IOError, OSError):
+            pass  # read-only atlas folder: no cache
+    return atlas, label_id, label_name, label_file
+
+
+def atlas_to_tracts(atlas):
+    """
+    Convert an atlas to the object array of tracts (nb_labels x 1) of the former get_tracts
+    """
+    tracts = np.empty([len(atlas), 1], dtype=object)
+    for label in range(len(atlas)):
+        tracts[label, 0] = atlas[label]
+    return tracts
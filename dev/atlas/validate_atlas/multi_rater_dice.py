@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Dice coefficients between the tracts of the atlas and the masks of several raters
+#
+# The binarized tracts and the masks of all the raters are loaded once, as boolean arrays
+# (one row of voxels per mask). The Dice coefficients of all the (rater, tract) pairs and of
+# all the (rater, rater, tract) triplets are then computed with a few array reductions:
+#     dice(A, B) = 2 |A & B| / (|A| + |B|)
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2014 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import numpy as np
+import nibabel as nib
+
+
+def binarize(data, threshold=0.5):
+    """
+    Binarize partial volumes as fslmaths -thr threshold -bin: voxels >= threshold
+    :param data: numpy array (e.g. atlas of the tracts, nb_tracts x nx x ny x nz)
+    :return: boolean array, one row of voxels per volume (nb_volumes x nb_voxels)
+    """
+    data = np.asarray(data)
+    return (data >= threshold).reshape(len(data), -1)
+
+
+def load_masks(fname_masks, shape=None):
+    """
+    Load binary masks (voxels different from 0)
+    :param fname_masks: list of the files of the masks
+    :param shape: expected shape of the masks (e.g. of the atlas), checked if given
+    :return: boolean array, one row of voxels per mask (nb_masks x nb_voxels)
+    """
+    masks = []
+    for fname in fname_masks:
+        data = np.asarray(nib.load(fname).get_data())
+        if shape is not None and data.shape != tuple(shape):
+            raise ValueError('Shape of '+fname+' '+str(data.shape)+' does not match '+str(tuple(shape)))
+        masks.append(data.ravel() != 0)
+    return np.array(masks, dtype=bool)
+
+
+def dice(intersection, size_a, size_b):
+    """Dice coefficient from the size of the intersection and of the two masks (nan if both masks are empty)"""
+    size = np.asarray(size_a + size_b, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(size > 0, 2 * intersection / size, np.nan)
+
+
+def dice_atlas_user(tracts, user_masks):
+    """
+    Dice coefficient between the binarized tracts of the atlas and the masks of each rater
+    :param tracts: binarized tracts (nb_tracts x nb_voxels), see binarize
+    :param user_masks: masks of the raters (nb_users x nb_tracts x nb_voxels): mask of each rater for each tract
+    :return: array (nb_users x nb_tracts)
+    """
+    tracts = np.asarray(tracts, dtype=bool)
+    user_masks = np.asarray(user_masks, dtype=bool)
+    intersection = np.logical_and(user_masks, tracts[np.newaxis]).sum(axis=2)
+    return dice(intersection, user_masks.sum(axis=2), tracts.sum(axis=1)[np.newaxis])
+
+
+def dice_user_user(user_masks):
+    """
+    Dice coefficient between the masks of each pair of raters, for each tract
+    :param user_masks: masks of the raters (nb_users x nb_tracts x nb_voxels)
+    :return: array (nb_users x nb_users x nb_tracts), symmetric in the raters
+    """
+    masks = np.asarray(user_masks, dtype=bool).transpose(1, 0, 2).astype(np.float32)
+    # intersections of all the pairs of raters, for each tract: (nb_tracts x nb_users x nb_users)
+    intersection = np.matmul(masks, masks.transpose(0, 2, 1)).astype(np.float64)
+    size = masks.sum(axis=2, dtype=np.float64)
+    return dice(intersection, size[:, :, np.newaxis], size[:, np.newaxis, :]).transpose(1, 2, 0)
+
+
+def pairs_mean(dice_users):
+    """
+    Mean over the pairs of different raters
+    :param dice_users: array (nb_users x nb_users x nb_tracts), see dice_user_user
+    :return: array (nb_tracts)
+    """
+    index_a, index_b = np.triu_indices(dice_users.shape[0], 1)
+    return np.nanmean(dice_users[index_a, index_b], axis=0)
@@ -17,6 +17,7 @@ import numpy
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.legend_handler import *
+from results_store import read_summary
 # import subprocess
 # path_sct = subprocess.check_output("echo %SCT_DIR%", shell=True)
 
@@ -66,176 +67,27 @@ def main():
 
     sct.printv("Working directory: " + os.getcwd())
 
-    results_folder_csf = results_folder + '/csf'
-
-    sct.printv('\n\nData will be extracted from folder ' + results_folder_csf, 'warning')
+    sct.printv('\n\nData will be extracted from ' + results_folder + ' (sweep csf)', 'warning')
     sct.printv('\t\tCheck existence...')
-    sct.check_folder_exist(results_folder_csf)
+    sct.check_folder_exist(results_folder)
 
     # Extract methods to display
     methods_to_display = methods_to_display.strip().split(',')
 
-    # Extract file names of the results files
-    fname_results_csf = glob.glob(os.path.join(results_folder_csf, "*.txt"))
-    # Remove doublons (due to the two folders)
-    # for i_fname in range(0, len(fname_results)):
-    #     for j_fname in range(0, len(fname_results)):
-    #         if (i_fname != j_fname) & (os.path.basename(fname_results[i_fname]) == os.path.basename(fname_results[j_fname])):
-    #             fname_results.remove(fname_results[j_fname])
-    file_results = []
-    for fname in fname_results_csf:
-        file_results.append(os.path.basename(fname))
-    for file in file_results:
-        if file_results.count(file) > 1:
-            ind = file_results.index(file)
-            fname_results_csf.remove(fname_results_csf[ind])
-            file_results.remove(file)
-
-    nb_results_file = len(fname_results_csf)
-
-    # 1st dim: SNR, 2nd dim: tract std, 3rd dim: mean abs error, 4th dim: std abs error
-    # result_array = numpy.empty((nb_results_file, nb_results_file, 3), dtype=object)
-    # SNR
-    snr = numpy.zeros((nb_results_file))
-    # Tracts std
-    tracts_std = numpy.zeros((nb_results_file))
-    # CSF value
-    csf_values = numpy.zeros((nb_results_file))
-    # methods' name
-    methods_name = []  #numpy.empty((nb_results_file, nb_method), dtype=object)
-    # labels
-    error_per_label = []
-    std_per_label = []
-    labels_id = []
-    # median
-    median_results = numpy.zeros((nb_results_file, 5))
-    # median std across bootstraps
-    median_std = numpy.zeros((nb_results_file, 5))
-    # min
-    min_results = numpy.zeros((nb_results_file, 5))
-    # max
-    max_results = numpy.zeros((nb_results_file, 5))
-
-    #
-    for i_file in range(0, nb_results_file):
-
-        # Open file
-        f = open(fname_results_csf[i_file])  # open file
-        # Extract all lines in .txt file
-        lines = [line for line in f.readlines() if line.strip()]
-
-        # extract SNR
-        # find all index of lines containing the string "sigma noise"
-        ind_line_noise = [lines.index(line_noise) for line_noise in lines if "sigma noise" in line_noise]
-        if len(ind_line_noise) != 1:
-            sct.printv("ERROR: number of lines including \"sigma noise\" is different from 1. Exit program.", 'error')
-            sys.exit(1)
-        else:
-            # result_array[:, i_file, i_file] = int(''.join(c for c in lines[ind_line_noise[0]] if c.isdigit()))
-            snr[i_file] = int(''.join(c for c in lines[ind_line_noise[0]] if c.isdigit()))
-
-        # extract tract std
-        ind_line_tract_std = [lines.index(line_tract_std) for line_tract_std in lines if
-                              "range tracts" in line_tract_std]
-        if len(ind_line_tract_std) != 1:
-            sct.printv("ERROR: number of lines including \"range tracts\" is different from 1. Exit program.", 'error')
-            sys.exit(1)
-        else:
-            # result_array[i_file, i_file, :] = int(''.join(c for c in lines[ind_line_tract_std[0]].split(':')[1] if c.isdigit()))
-            # regex = re.compile(''('(.*)':)  # re.I permet d'ignorer la case (majuscule/minuscule)
-            # match = regex.search(lines[ind_line_tract_std[0]])
-            # result_array[:, i_file, :, :] = match.group(1)  # le groupe 1 correspond a '.*'
-            tracts_std[i_file] = int(''.join(c for c in lines[ind_line_tract_std[0]].split(':')[1] if c.isdigit()))
-
-        # extract CSF value
-        ind_line_csf_value = [lines.index(line_csf_value) for line_csf_value in lines if
-                              "# value CSF" in line_csf_value]
-        if len(ind_line_csf_value) != 1:
-            sct.printv("ERROR: number of lines including \"range tracts\" is different from 1. Exit program.", 'error')
-            sys.exit(1)
-        else:
-            # result_array[i_file, i_file, :] = int(''.join(c for c in lines[ind_line_tract_std[0]].split(':')[1] if c.isdigit()))
-            # regex = re.compile(''('(.*)':)  # re.I permet d'ignorer la case (majuscule/minuscule)
-            # match = regex.search(lines[ind_line_tract_std[0]])
-            # result_array[:, i_file, :, :] = match.group(1)  # le groupe 1 correspond a '.*'
-            csf_values[i_file] = int(''.join(c for c in lines[ind_line_csf_value[0]].split(':')[1] if c.isdigit()))
-
-
-        # extract method name
-        ind_line_label = [lines.index(line_label) for line_label in lines if "Label" in line_label]
-        if len(ind_line_label) != 1:
-            sct.printv("ERROR: number of lines including \"Label\" is different from 1. Exit program.", 'error')
-            sys.exit(1)
-        else:
-            # methods_name[i_file, :] = numpy.array(lines[ind_line_label[0]].strip().split(',')[1:])
-            methods_name.append(lines[ind_line_label[0]].strip().replace(' ', '').split(',')[1:])
-
-        # extract median
-        ind_line_median = [lines.index(line_median) for line_median in lines if "median" in line_median]
-        if len(ind_line_median) != 1:
-            sct.printv("WARNING: number of lines including \"median\" is different from 1. Exit program.", 'warning')
-            # sys.exit(1)
-        else:
-            median = lines[ind_line_median[0]].strip().split(',')[1:]
-            # result_array[i_file, i_file, 0] = [float(m.split('(')[0]) for m in median]
-            median_results[i_file, :] = numpy.array([float(m.split('(')[0]) for m in median])
-            median_std[i_file, :] = numpy.array([float(m.split('(')[1][:-1]) for m in median])
-
-        # extract min
-        ind_line_min = [lines.index(line_min) for line_min in lines if "min," in line_min]
-        if len(ind_line_min) != 1:
-            sct.printv("WARNING: number of lines including \"min\" is different from 1. Exit program.", 'warning')
-            # sys.exit(1)
-        else:
-            min = lines[ind_line_min[0]].strip().split(',')[1:]
-            # result_array[i_file, i_file, 1] = [float(m.split('(')[0]) for m in min]
-            min_results[i_file, :] = numpy.array([float(m.split('(')[0]) for m in min])
-
-        # extract max
-        ind_line_max = [lines.index(line_max) for line_max in lines if "max" in line_max]
-        if len(ind_line_max) != 1:
-            sct.printv("WARNING: number of lines including \"max\" is different from 1. Exit program.", 'warning')
-            # sys.exit(1)
-        else:
-            max = lines[ind_line_max[0]].strip().split(',')[1:]
-            # result_array[i_file, i_file, 1] = [float(m.split('(')[0]) for m in max]
-            max_results[i_file, :] = numpy.array([float(m.split('(')[0]) for m in max])
-
-        # extract error for each label
-        error_per_label_for_file_i = []
-        std_per_label_for_file_i = []
-        labels_id_for_file_i = []
-        # Due to 2 different kind of file structure, the number of the last label line must be adapted
-        if not ind_line_median:
-            ind_line_median = [len(lines) + 1]
-        for i_line in range(ind_line_label[0] + 1, ind_line_median[0] - 1):
-            line_label_i = lines[i_line].strip().split(',')
-            error_per_label_for_file_i.append([float(error.strip().split('(')[0]) for error in line_label_i[1:]])
-            std_per_label_for_file_i.append([float(error.strip().split('(')[1][:-1]) for error in line_label_i[1:]])
-            labels_id_for_file_i.append(line_label_i[0])
-        error_per_label.append(error_per_label_for_file_i)
-        std_per_label.append(std_per_label_for_file_i)
-        labels_id.append(labels_id_for_file_i)
-
-        # close file
-        f.close()
-
-    # check if all the files in the result folder were generated with the same number of methods
-    if not all(x == methods_name[0] for x in methods_name):
-        sct.printv(
-            'ERROR: All the generated files in folder ' + results_folder + ' have not been generated with the same number of methods. Exit program.',
-            'error')
-        sys.exit(1)
-    # check if all the files in the result folder were generated with the same labels
-    if not all(x == labels_id[0] for x in labels_id):
-        sct.printv(
-            'ERROR: All the generated files in folder ' + results_folder + ' have not been generated with the same labels. Exit program.',
-            'error')
-        sys.exit(1)
-
-    # convert the list "error_per_label" into a numpy array to ease further manipulations
-    error_per_label = numpy.array(error_per_label)
-    std_per_label = numpy.array(std_per_label)
+    # Load the results of all the runs (from the store of the raw results, or from the text files of the older results
+    # folders) and aggregate them by run, method and label (see results_store)
+    summary = read_summary(results_folder, ['csf'])
+    nb_results_file = len(summary['std_noise'])
+    # SNR, tracts std and CSF value of each run
+    snr, tracts_std, csf_values = summary['std_noise'], summary['range_tract'], summary['val_csf']
+    # methods' name and labels, the same for all the runs
+    methods_name = [summary['methods']] * nb_results_file
+    labels_id = [summary['labels']] * nb_results_file
+    # mean(std) across bootstraps of the error within each label (runs x labels x methods)
+    error_per_label, std_per_label = summary['error_per_label'], summary['std_per_label']
+    # mean across bootstraps of the median, min and max error across labels (runs x methods)
+    median_results, median_std = summary['median'], summary['median_std']
+    min_results, max_results = summary['min'], summary['max']
     # compute different stats
     abs_error_per_labels = numpy.absolute(error_per_label)
     max_abs_error_per_meth = numpy.amax(abs_error_per_labels, axis=1)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Columnar store of the results of the validation of the atlas
+#
+# The raw results of all the runs of validate_atlas (one row per estimate of each bootstrap
+# iteration, see validation_engine.results_columns) are kept in a store folder per results folder,
+# one .npz file per run, along with the parameters of their run (sweep, std_noise, range_tract,
+# val_csf, param_map). The plot scripts load them at once and aggregate them with vectorized
+# group-bys (group_by), instead of parsing the text files of each run. The text files of the
+# results folders generated before the store are still read (see read_summary).
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2014 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import re
+import glob
+import numpy as np
+
+
+file_store = 'results_store'
+# parameters identifying a run
+run_keys = ['std_noise', 'range_tract', 'val_csf', 'param_map']
+
+
+def run_files(folder_store):
+    """:return: files of the runs of the store, sorted by run"""
+    return sorted(glob.glob(os.path.join(folder_store, 'run[0-9]*.npz')))
+
+
+def load_results(folder_store):
+    """
+    :param folder_store: folder of the store (one .npz file per run)
+    :return: dict of numpy arrays, one per column
+    """
+    parts = []
+    for fname in run_files(folder_store):
+        part = np.load(fname)
+        parts.append(dict((column, part[column]) for column in part.files))
+        part.close()
+    if not parts:
+        raise IOError('No results in '+folder_store)
+    return dict((column, np.concatenate([part[column] for part in parts])) for column in parts[0])
+
+
+def append_results(folder_store, results, sweep, std_noise, range_tract, val_csf, param_map):
+    """
+    Add the results of a run of validate_atlas to the store (created if it does not exist), as a new file: the runs
+    already in the store are not read
+    :param results: dict of numpy arrays (see validation_engine.ResultsTable.to_arrays)
+    :param sweep: name of the sweep of the run (e.g. 'noise')
+    :return: id of the run in the store
+    """
+    if not os.path.isdir(folder_store):
+        os.makedirs(folder_store)
+    runs = [int(re.findall(r'run(\d+)\.npz$', fname)[0]) for fname in run_files(folder_store)]
+    run = max(runs) + 1 if runs else 0
+    nb_rows = len(results['bootstrap'])
+    results = dict(results)
+    results['run'] = np.repeat(run, nb_rows)
+    results['sweep'] = np.repeat(np.array([sweep]), nb_rows)
+    results['std_noise'] = np.repeat(float(std_noise), nb_rows)
+    results['range_tract'] = np.repeat(float(range_tract), nb_rows)
+    results['val_csf'] = np.repeat(float(val_csf), nb_rows)
+    results['param_map'] = np.repeat(np.array([param_map]), nb_rows)
+    # write to a temporary file then rename, so that the store never holds a partially written run
+    fname_run = os.path.join(folder_store, 'run%04d.npz' % run)
+    np.savez(fname_run + '.tmp.npz', **results)
+    os.rename(fname_run + '.tmp.npz', fname_run)
+    return run
+
+
+def group_index(results, keys, select):
+    """
+    :return: groups: dict of the values of the keys of each group (arrays, sorted by keys), index of the group of each
+    selected row
+    """
+    uniques, inverses = [], []
+    for key in keys:
+        unique, inverse = np.unique(results[key][select], return_inverse=True)
+        uniques.append(unique)
+        inverses.append(inverse.ravel())
+    dims = [max(len(unique), 1) for unique in uniques]
+    index_groups, group = np.unique(np.ravel_multi_index(inverses, dims), return_inverse=True)
+    index_keys = np.unravel_index(index_groups, dims)
+    groups = dict((key, uniques[i][index_keys[i]]) for i, key in enumerate(keys))
+    return groups, group.ravel()
+
+
+def group_by(results, keys, column='perc_error', select=None):
+    """
+    Group the rows of the results by the values of the key columns and compute the statistics of a column in each group
+    :param results: dict of numpy arrays of the same length
+    :param keys: list of the key columns
+    :param column: column of the values
+    :param select: boolean array selecting the rows (default: all)
+    :return: groups: dict of the values of the keys of each group (arrays, sorted by keys), stats: dict of the count,
+    mean, std, mse (mean of squares), median, min and max of the values in each group (arrays)
+    """
+    if select is None:
+        select = np.ones(len(results[column]), dtype=bool)
+    values = np.asarray(results[column][select], dtype=np.float64)
+    groups, group = group_index(results, keys, select)
+    nb_groups = len(groups[keys[0]])
+    count = np.bincount(group, minlength=nb_groups)
+    mean = np.bincount(group, values, nb_groups) / count
+    mse = np.bincount(group, values ** 2, nb_groups) / count
+    # order statistics: values sorted within each group
+    sorted_values = values[np.lexsort((values, group))]
+    start = np.cumsum(count) - count
+    stats = {'count': count, 'mean': mean, 'std': np.sqrt(np.maximum(mse - mean ** 2, 0)), 'mse': mse,
+             'median': (sorted_values[start + (count - 1) // 2] + sorted_values[start + count // 2]) / 2,
+             'min': sorted_values[start], 'max': sorted_values[start + count - 1]}
+    return groups, stats
+
+
+def ordered_unique(values):
+    """unique values, in the order of their first occurrence"""
+    unique, index = np.unique(values, return_index=True)
+    return list(unique[np.argsort(index)])
+
+
+def summarize_runs(results, sweeps, kind='label'):
+    """
+    Summary of the runs of the given sweeps, with the values of the text files of validate_atlas: mean(std) across
+    bootstrap iterations of the error within each label (kind 'label') or tract (kind 'tract'), and of the statistics
+    (MSE, median, min, max) across labels of each iteration. Runs of several sweeps with the same parameters are pooled
+    :param results: dict of numpy arrays (see load_results)
+    :param sweeps: list of the names of the sweeps
+    :param kind: 'label' or 'tract'
+    :return: dict: std_noise, range_tract, val_csf, param_map (one value per run), methods, labels (lists of the label
+    indices or tract names), error_per_label and std_per_label (runs x labels x methods), mse, median, min, max and their
+    std (*_std) (runs x methods)
+    """
+    key_label = 'label' if kind == 'label' else 'tract'
+    select = (results['sweep'][:, np.newaxis] == np.array(sweeps)[np.newaxis, :]).any(axis=1) & (results['kind'] == kind)
+    methods = ordered_unique(results['method'][select])
+    labels = ordered_unique(results[key_label][select])
+    # runs: distinct parameters
+    runs, index_run = group_index(results, run_keys, select)
+    results = dict(results)
+    results['index_run'] = np.zeros(len(select), dtype=int)
+    results['index_run'][select] = index_run
+    nb_runs = len(runs[run_keys[0]])
+    summary = {'std_noise': runs['std_noise'].astype(float), 'range_tract': runs['range_tract'].astype(float),
+               'val_csf': runs['val_csf'].astype(float), 'param_map': [str(p) for p in runs['param_map']],
+               'methods': [str(m) for m in methods],
+               'labels': [int(label) if kind == 'label' else str(label) for label in labels]}
+
+    # mean(std) error of each label across iterations
+    groups, stats = group_by(results, ['index_run', 'method', key_label], select=select)
+    index_method = np.array([methods.index(m) for m in groups['method']], dtype=int)
+    index_label = np.array([labels.index(label) for label in groups[key_label]], dtype=int)
+    for name, stat in [('error_per_label', 'mean'), ('std_per_label', 'std')]:
+        summary[name] = np.zeros((nb_runs, len(labels), len(methods)))
+        summary[name][groups['index_run'], index_label, index_method] = stats[stat]
+
+    # statistics across labels of each iteration, then their mean(std) across iterations
+    iterations, stats = group_by(results, ['index_run', 'run', 'method', 'bootstrap'], select=select)
+    for stat in ['mse', 'median', 'min', 'max']:
+        iterations[stat] = stats[stat]
+        groups, stats_runs = group_by(iterations, ['index_run', 'method'], stat)
+        index_method = np.array([methods.index(m) for m in groups['method']], dtype=int)
+        summary[stat] = np.zeros((nb_runs, len(methods)))
+        summary[stat+'_std'] = np.zeros((nb_runs, len(methods)))
+        summary[stat][groups['index_run'], index_method] = stats_runs['mean']
+        summary[stat+'_std'][groups['index_run'], index_method] = stats_runs['std']
+    return summary
+
+
+def read_text_results(results_folder, sweeps, kind='label'):
+    """
+    Summary of the runs of the given sweeps, read from the text files of validate_atlas (results folders generated
+    before the store): <sweep>/*_all.txt (kind 'label') or <sweep>/sub/*.txt (kind 'tract'). A file present in several
+    sweeps is read once. The MAP parameters are read from the file names (results_map<param_map>_all.txt), '20,20' for
+    the other files
+    :return: summary, as summarize_runs (the statistics across labels are 0 where the files have none)
+    """
+    fname_results = []
+    for sweep in sweeps:
+        folder = os.path.join(results_folder, sweep, 'sub' if kind == 'tract' else '')
+        for fname in sorted(glob.glob(os.path.join(folder, '*.txt'))):
+            if os.path.basename(fname) not in [os.path.basename(f) for f in fname_results]:
+                fname_results.append(fname)
+    if not fname_results:
+        raise IOError('No results in '+results_folder+' for the sweeps '+', '.join(sweeps))
+
+    def header_value(line):
+        return float(re.findall(r'\d+\.?\d*', line.split(':', 1)[1])[0])
+
+    def mean_std(fields):
+        return [float(field.split('(')[0]) for field in fields], [float(field.split('(')[1].rstrip(')')) for field in fields]
+
+    runs = []
+    for fname in fname_results:
+        run = {'param_map': '20,20', 'labels': [], 'error': [], 'std': []}
+        match = re.search(r'results_map(.*)_all\.txt$', os.path.basename(fname))
+        if match:
+            run['param_map'] = match.group(1)
+        for line in open(fname):
+            line = line.strip()
+            if not line:
+                continue
+            fields = [field.strip() for field in line.split(',')]
+            if line.startswith('#'):
+                for name, key in [('sigma noise', 'std_noise'), ('range tracts', 'range_tract'), ('value CSF', 'val_csf')]:
+                    if name in line:
+                        run[key] = header_value(line)
+            elif fields[0] == 'Label':
+                run['methods'] = fields[1:]
+            elif fields[0] in ['MSE', 'median', 'min', 'max']:
+                run[fields[0].lower()] = mean_std(fields[1:])
+            else:
+                run['labels'].append(int(fields[0]) if kind == 'label' else fields[0])
+                error, std = mean_std(fields[1:])
+                run['error'].append(error)
+                run['std'].append(std)
+        if runs and run['methods'] != runs[0]['methods']:
+            raise ValueError('All the results files have not been generated with the same methods: '+fname)
+        if runs and run['labels'] != runs[0]['labels']:
+            raise ValueError('All the results files have not been generated with the same labels: '+fname)
+        runs.append(run)
+    # same order of the runs as summarize_runs
+    runs.sort(key=lambda run: [run[key] for key in run_keys])
+
+    nb_runs = len(runs)
+    summary = {'std_noise': np.array([run['std_noise'] for run in runs]),
+               'range_tract': np.array([run['range_tract'] for run in runs]),
+               'val_csf': np.array([run['val_csf'] for run in runs]),
+               'param_map': [run['param_map'] for run in runs],
+               'methods': runs[0]['methods'], 'labels': runs[0]['labels'],
+               'error_per_label': np.array([run['error'] for run in runs]).reshape(nb_runs, len(runs[0]['labels']), -1),
+               'std_per_label': np.array([run['std'] for run in runs]).reshape(nb_runs, len(runs[0]['labels']), -1)}
+    for stat in ['mse', 'median', 'min', 'max']:
+        summary[stat] = np.zeros((nb_runs, len(summary['methods'])))
+        summary[stat+'_std'] = np.zeros((nb_runs, len(summary['methods'])))
+        for i_run in range(nb_runs):
+            if stat in runs[i_run]:
+                summary[stat][i_run], summary[stat+'_std'][i_run] = runs[i_run][stat]
+    return summary
+
+
+def read_summary(results_folder, sweeps, kind='label'):
+    """
+    Summary of the runs of the given sweeps of a results folder: from its store if it has one (see summarize_runs),
+    from its text files otherwise (see read_text_results)
+    :return: summary (see summarize_runs)
+    """
+    folder_store = os.path.join(results_folder, file_store)
+    if run_files(folder_store):
+        return summarize_runs(load_results(folder_store), sweeps, kind)
+    return read_text_results(results_folder, sweeps, kind)
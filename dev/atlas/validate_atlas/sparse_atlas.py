@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Sparse representation of a partial volume atlas
+#
+# The partial volumes of all the labels are stored in one CSR matrix (voxels x labels): the
+# labels cover a small part of the field of view, so the volume of the labels and the
+# estimation of a metric within them (weighted averages, least squares) only cost
+# O(number of nonzero partial volumes) instead of O(labels x voxels).
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2014 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import numpy as np
+from scipy import sparse
+
+
+class SparseAtlas(object):
+    """
+    Partial volumes of the labels of an atlas, as a CSR matrix (nb_voxels x nb_labels). Voxels are numbered in the
+    C order of the volume (as data.ravel())
+    """
+    def __init__(self, matrix, shape):
+        """
+        :param matrix: sparse matrix (nb_voxels x nb_labels) of the partial volumes
+        :param shape: shape of the volume (nx, ny, nz)
+        """
+        self.matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+        self.matrix.eliminate_zeros()
+        self.shape = tuple(shape)
+        self.nb_labels = self.matrix.shape[1]
+
+    @classmethod
+    def from_dense(cls, atlas):
+        """
+        :param atlas: partial volumes of the labels (nb_labels x nx x ny x nz), see load_atlas
+        """
+        return cls(sparse.csr_matrix(np.reshape(atlas, (len(atlas), -1))).T, atlas.shape[1:])
+
+    def labels_matrix(self, labels=None):
+        """partial volumes of the given labels (nb_voxels x nb_given_labels), all the labels by default"""
+        if labels is None:
+            return self.matrix
+        return self.matrix[:, list(labels)]
+
+    def volumes(self, labels=None):
+        """volume (sum of the partial volumes) of each label"""
+        return np.asarray(self.labels_matrix(labels).sum(axis=0)).ravel()
+
+    def weighted_average(self, data, labels=None, threshold=None, binary=0, merge=0):
+        """
+        Average of data weighted by the partial volume of each label
+        :param data: 3d numpy array, same shape as the atlas
+        :param labels: indices of the labels (default: all)
+        :param threshold: if given, partial volumes below threshold are set to 0
+        :param binary: if 1, the weights are 1 where the partial volume is above threshold, 0 elsewhere
+        :param merge: if 1, the labels are merged (their partial volumes are summed) and a single average is returned
+        :return: array of the averages, one per label (or a single one if merge)
+        """
+        weights = self.labels_matrix(labels)
+        if threshold is not None:
+            above = weights >= threshold
+            weights = above.astype(np.float64) if binary else weights.multiply(above).tocsr()
+        if merge:
+            weights = sparse.csr_matrix(weights.sum(axis=1))
+        return weights.T.dot(np.ravel(data)) / np.asarray(weights.sum(axis=0)).ravel()
+
+    def normal_equations(self, data):
+        """
+        Normal equations of the least squares fit of the partial volume model data = P x, over all the labels
+        :param data: 3d numpy array, same shape as the atlas
+        :return: P'P (dense, nb_labels x nb_labels), P'data (nb_labels)
+        """
+        P = self.matrix
+        return (P.T.dot(P)).toarray(), P.T.dot(np.ravel(data))
+
+    def least_squares(self, data):
+        """
+        Least squares fit of the values of all the labels: data = P x
+        :param data: 3d numpy array, same shape as the atlas
+        :return: array of the values of the labels (minimal norm solution if some labels are not independent)
+        """
+        PtP, Pty = self.normal_equations(data)
+        return np.linalg.lstsq(PtP, Pty, rcond=-1)[0]
@@ -24,13 +24,19 @@
 
 
 # Import common Python libraries
-import os, sys, time, datetime, shutil
+import os, sys, time, glob, datetime, shutil, multiprocessing
 import numpy as np
+import nibabel as nib
 path_sct = os.environ.get("SCT_DIR", os.path.dirname(os.path.dirname(__file__)))
 # append path that contains scripts, to be able to load modules
 sys.path.append(os.path.join(path_sct, "scripts"))
 import sct_utils as sct
-from generate_phantom import phantom_generation, get_tracts, save_3D_nparray_nifti
+from load_atlas import load_atlas
+from generate_phantom import tracts_to_matrix, phantom_generation_batch
+from sparse_atlas import SparseAtlas
+from validation_engine import get_estimator, run_validation, pivot
+from results_store import file_store, append_results
+from crop_image import crop_files
 
 
 # main function
@@ -51,6 +57,8 @@ def main():
     list_methods = ['ml', 'map', 'wa', 'wath', 'bin', 'man0', 'man1', 'man2', 'man3']
     param_map_list = ['0,20', '5,20', '10,20', '15,20', '20,20', '25,20', '30,20', '20,0', '20,5', '20,10', '20,15', '20,20', '20,25', '20,30']
     results_folder = 'results/'  # add / at the end
+    nb_workers = multiprocessing.cpu_count()  # number of processes running the bootstrap iterations
+    in_process = 1  # estimate the metrics in process (1) or with sct_extract_metric (0)
 
     # Crop the atlas
     if crop == 1:
@@ -67,28 +75,28 @@ def main():
     val_csf = val_csf_fixed
     for std_noise in std_noise_list:
         results_file = 'results_noise'+str(std_noise)+'_range'+str(range_tract)+'_csf'+str(val_csf)
-        validate_atlas(folder_cropped_atlas, bootstrap_iter, std_noise, range_tract, val_csf, results_folder+'noise/', results_file, mask_folder, list_methods)
+        validate_atlas(folder_cropped_atlas, bootstrap_iter, std_noise, range_tract, val_csf, results_folder+'noise/', results_file, mask_folder, list_methods, nb_workers=nb_workers, in_process=in_process, fname_store=results_folder+file_store, sweep='noise')
 
     # loop across tract ranges
     std_noise = fixed_noise
     val_csf = val_csf_fixed
     for range_tract in range_tract_list:
         results_file = 'results_noise'+str(std_noise)+'_range'+str(range_tract)+'_csf'+str(val_csf)
-        validate_atlas(folder_cropped_atlas, bootstrap_iter, std_noise, range_tract, val_csf, results_folder+'tracts/', results_file, mask_folder, list_methods)
+        validate_atlas(folder_cropped_atlas, bootstrap_iter, std_noise, range_tract, val_csf, results_folder+'tracts/', results_file, mask_folder, list_methods, nb_workers=nb_workers, in_process=in_process, fname_store=results_folder+file_store, sweep='tracts')
 
     # loop across CSF value
     std_noise = fixed_noise
     range_tract = fixed_range
     for val_csf in val_csf_list:
         results_file = 'results_noise'+str(std_noise)+'_range'+str(range_tract)+'_csf'+str(val_csf)
-        validate_atlas(folder_cropped_atlas, bootstrap_iter, std_noise, range_tract, val_csf, results_folder+'csf/', results_file, mask_folder, list_methods)
+        validate_atlas(folder_cropped_atlas, bootstrap_iter, std_noise, range_tract, val_csf, results_folder+'csf/', results_file, mask_folder, list_methods, nb_workers=nb_workers, in_process=in_process, fname_store=results_folder+file_store, sweep='csf')
 
     # bin vs manual
     std_noise = fixed_noise
     range_tract = fixed_range
     val_csf = val_csf_fixed
     results_file = 'results_noise'+str(std_noise)+'_range'+str(range_tract)+'_csf'+str(val_csf)
-    validate_atlas(folder_cropped_atlas, bootstrap_iter, std_noise, range_tract, val_csf, results_folder+'manual_mask/', results_file, mask_folder, ['bin', 'man0', 'man1', 'man2', 'man3'], 0, '20,20', ['2', '17', '0,1,15,16'])
+    validate_atlas(folder_cropped_atlas, bootstrap_iter, std_noise, range_tract, val_csf, results_folder+'manual_mask/', results_file, mask_folder, ['bin', 'man0', 'man1', 'man2', 'man3'], 0, '20,20', ['2', '17', '0,1,15,16'], nb_workers=nb_workers, in_process=in_process, fname_store=results_folder+file_store, sweep='manual_mask')
 
     # loop across params for MAP estimation
     std_noise = fixed_noise
@@ -96,141 +104,74 @@ def main():
     val_csf = val_csf_fixed
     for param_map in param_map_list:
         results_file = 'results_map'+str(param_map)
-        validate_atlas(folder_cropped_atlas, bootstrap_iter, std_noise, range_tract, val_csf, results_folder+'map/', results_file, mask_folder, ['map'], 1, param_map)
+        validate_atlas(folder_cropped_atlas, bootstrap_iter, std_noise, range_tract, val_csf, results_folder+'map/', results_file, mask_folder, ['map'], 1, param_map, nb_workers=nb_workers, in_process=in_process, fname_store=results_folder+file_store, sweep='map')
 
 
 
 # validate atlas
-def validate_atlas(folder_cropped_atlas, nb_bootstraps, std_noise, range_tract, val_csf, results_folder, results_file, mask_folder, list_methods, test_map=0, param_map='20,20', list_tracts=[]):
+def validate_atlas(folder_cropped_atlas, nb_bootstraps, std_noise, range_tract, val_csf, results_folder, results_file, mask_folder, list_methods, test_map=0, param_map='20,20', list_tracts=[], nb_workers=1, seed=None, in_process=0, fname_store=None, sweep=''):
+    """
+    :param nb_workers: number of processes running the bootstrap iterations (1: sequential)
+    :param seed: seed of the random generator of the phantoms (not seeded if None). The phantoms are generated in this
+    process, so the results do not depend on nb_workers
+    :param in_process: if 1, the metrics are estimated from the phantom in memory (see extract_metric) instead of
+    saving it and running sct_extract_metric / sct_average_data_within_mask
+    :param fname_store: if given, the raw results (error of each estimate of each iteration) are added to this store folder,
+    with the parameters of the run (see results_store)
+    :param sweep: name of the sweep of the run in the store
+    """
     # Parameters
-    file_phantom = "WM_phantom.nii.gz"
-    file_phantom_noise = "WM_phantom_noise.nii.gz"
-    file_tract_sum = "tracts_sum.nii.gz"
-    true_value = 40
-    file_extract_metrics = "metric_label.txt"
-    # list_tracts = ['2', '17', '0,1,15,16']
-    list_tracts_txt = ['csl', 'csr', 'dc']
-    index_dorsalcolumn = 2  # index of dorsal column in list_tracts
-    nb_tracts_all = 32  # total number of tracts in atlas (do not include CSF tracts)
-    # dorsal_column_labels = '0,1,15,16'
-    # nb_tracts_dorsalcolumn = 4
-    value_gm = 35  # value in gray matter
-    #value_csf = 5  # value in csf
     nb_digits_results = 2  # number of digits to display for result file
-    mask_prefix = 'manual_'
-    mask_ext = '.nii.gz'
+    nb_phantoms_batch = 50  # number of phantoms generated at once
 
     # initialization
     start_time = time.time()  # save start time for duration
     folder_tmp = 'tmp.'+datetime.datetime.now().strftime("%y%m%d%H%M%S%f/")
     nb_methods = len(list_methods)
     nb_tracts = len(list_tracts)
-    perc_error = np.zeros(shape=(nb_tracts, nb_methods, nb_bootstraps))  # percent error within single tract (for comparison with manual labeling)
-    perc_error_all = np.zeros(shape=(nb_tracts_all, nb_methods, nb_bootstraps))  # percent error for all tracts (for comparing automatic methods)
-    stat_perc_error_all = np.zeros(shape=(nb_methods, nb_bootstraps, 4))  # statistics
     list_stat = ['MSE', 'median', 'min', 'max']
-    x_true_i = np.zeros(shape=(nb_tracts))
-    fname_phantom = os.path.join(folder_tmp, file_phantom)
-    fname_phantom_noise = os.path.join(folder_tmp, file_phantom_noise)
-    fname_tract_sum = os.path.join(folder_tmp, file_tract_sum)
 
     # create output folder
     create_folder(results_folder, 0)
 
-    # Extract the tracts from the atlas' folder
-    tracts = get_tracts(folder_cropped_atlas)
-
-    # get file name of the first atlas file
-    fname_atlas = os.path.join(folder_cropped_atlas, 'WMtract__00.nii.gz')
-
-    # Get ponderation of each tract for dorsal column average ponderation of each tract of the dorsal column
-    if nb_tracts:
-        list_tract_dorsalcolumn = list_tracts[index_dorsalcolumn].split(',')
-        nb_tracts_dorsalcolumn = len(list_tract_dorsalcolumn)
-
-        pond_dc = np.zeros(nb_tracts_dorsalcolumn)
-        # sum of each
-        pond_sum = 0
-        for i in range(nb_tracts_dorsalcolumn):
-            # i = int(i)
-            # Sum tracts values which are higher than 0 in the tracts
-            pond_dc[i] = sum(tracts[int(list_tract_dorsalcolumn[i]), 0][tracts[int(list_tract_dorsalcolumn[i]), 0] > 0])
-            pond_sum = pond_sum + pond_dc[i]
-        # Normalize the sum of ponderations to 1
-        pond_dc = pond_dc / pond_sum
+    # Extract the tracts from the atlas' folder (nb_labels x nx x ny x nz)
+    atlas = load_atlas(folder_cropped_atlas)[0]
 
     # create temporary folder
     sct.run('mkdir '+folder_tmp)
 
-    # loop across bootstrap
-    for i_bootstrap in range(0, nb_bootstraps):
-        sct.printv('Iteration:  ' + str(i_bootstrap+1) + '/' + str(nb_bootstraps), 1, 'warning')
-
-        # Generate phantom
-        [WM_phantom, WM_phantom_noise, values_synthetic_data, tracts_sum] = phantom_generation(tracts, std_noise, range_tract, true_value, folder_tmp, value_gm, true_value*val_csf/100)
-        # Save generated phantoms as nifti image (.nii.gz)
-        save_3D_nparray_nifti(WM_phantom, fname_phantom, fname_atlas)
-        save_3D_nparray_nifti(WM_phantom_noise, fname_phantom_noise, fname_atlas)
-        save_3D_nparray_nifti(tracts_sum, fname_tract_sum, fname_atlas)
-
-        # Get the np.mean of all values in dorsal column in the generated phantom
-        if nb_tracts:
-            dc_val_avg = 0
-            for j in range(nb_tracts_dorsalcolumn):
-                dc_val_avg = dc_val_avg + values_synthetic_data[int(list_tract_dorsalcolumn[j])] * pond_dc[j]
-            dc_val_avg = float(dc_val_avg)
-            # build variable with true values (WARNING: HARD-CODED INDICES)
-            x_true_i[0] = values_synthetic_data[int(list_tracts[0])]
-            x_true_i[1] = values_synthetic_data[int(list_tracts[1])]
-            x_true_i[2] = dc_val_avg
-
-        fname_extract_metrics = os.path.join(folder_tmp, file_extract_metrics)
-
-        if nb_tracts:
-            if not test_map:
-                # loop across tracts
-                for i_tract in range(len(list_tracts)):
-                    # loop across methods
-                    for i_method in range(len(list_methods)):
-                        # display stuff
-                        print 'Tract: '+list_tracts[i_tract]+', Method: '+list_methods[i_method]
-                        # check if method is manual
-                        if not list_methods[i_method].find('man') == -1:
-                            # find index of manual mask
-                            index_manual = int(list_methods[i_method][list_methods[i_method].find('man')+3])
-                            fname_mask = mask_folder[index_manual] + mask_prefix + list_tracts_txt[i_tract] + mask_ext
-                            # manual extraction
-                            status, output = sct.run('sct_average_data_within_mask -i ' + fname_phantom_noise + ' -m ' + fname_mask + ' -v 0')
-                            x_estim_i = float(output)
-                        else:
-                            # automatic extraction
-                            sct.run('sct_extract_metric -i ' + fname_phantom_noise + ' -f ' + folder_cropped_atlas + ' -m '+list_methods[i_method]+' -l '+list_tracts[i_tract]+' -a -o '+fname_extract_metrics)
-                            # read in txt file
-                            x_estim_i = read_results(fname_extract_metrics)
-                        # Get the percent absolute deviation with the true value
-                        #perc_error[i_tract, i_method, i_bootstrap] = 100 * (x_true_i[i_tract] - x_estim_i) / float(x_true_i[i_tract])
-                        perc_error[i_tract, i_method, i_bootstrap] = 100 * abs(x_estim_i - x_true_i[i_tract]) / float(x_true_i[i_tract])
-
-        # calculate percentage error for all tracts (only for automatic methods)
-        # loop across methods
-        for i_method in range(len(list_methods)):
-            # check if method is automatic
-            if list_methods[i_method].find('man') == -1:
-                # display stuff
-                print 'Tract: ALL, Method: '+list_methods[i_method]
-                # automatic extraction in all tracts
-                sct.run('sct_extract_metric -i ' + fname_phantom_noise + ' -f ' + folder_cropped_atlas + ' -m '+list_methods[i_method] + ' -o '+fname_extract_metrics + ' -p '+param_map)
-                # read results in txt file
-                x_estim_i_all = read_results(fname_extract_metrics)
-                # get nonzero values
-                index_nonzero = np.nonzero(values_synthetic_data)
-                perc_error_all[0:nb_tracts_all, i_method, i_bootstrap] = 100 * abs(x_estim_i_all[index_nonzero] - values_synthetic_data[index_nonzero]) / values_synthetic_data[index_nonzero]  # will be used to display boxcar
-                # perc_error_all[0:nb_tracts_all, i_method, i_bootstrap] = 100 * (x_estim_i_all[index_nonzero] - values_synthetic_data[index_nonzero]) / values_synthetic_data[index_nonzero]  # will be used to display boxcar
-                # compute mean squared error
-                stat_perc_error_all[i_method, i_bootstrap, 0] = (perc_error_all[:, i_method, i_bootstrap] ** 2).mean()  # mean squared error
-                stat_perc_error_all[i_method, i_bootstrap, 1] = np.median(perc_error_all[:, i_method, i_bootstrap])  # median
-                stat_perc_error_all[i_method, i_bootstrap, 2] = min(perc_error_all[:, i_method, i_bootstrap])
-                stat_perc_error_all[i_method, i_bootstrap, 3] = max(perc_error_all[:, i_method, i_bootstrap])
+    # parameters of the bootstrap iterations
+    tracts_matrix, shape = tracts_to_matrix(atlas)
+    params = bootstrap_params(atlas, tracts_matrix, shape, folder_cropped_atlas, nb_bootstraps, mask_folder, list_methods, test_map, param_map, list_tracts, in_process)
+    true_value, value_gm = params['true_value'], params['value_gm']
+    list_tracts_txt, nb_tracts_all = params['list_tracts_txt'], params['nb_tracts_all']
+
+    # Generate the phantoms, by batches of nb_phantoms_batch: a batch is generated when the previous one is done, so
+    # that only one batch of phantoms is in memory
+    if seed is not None:
+        np.random.seed(seed)
+
+    def batches():
+        for i_start in range(0, nb_bootstraps, nb_phantoms_batch):
+            nb_phantoms = min(nb_phantoms_batch, nb_bootstraps - i_start)
+            [WM_phantoms, WM_phantoms_noise, record] = phantom_generation_batch(tracts_matrix, shape, nb_phantoms, std_noise, range_tract, true_value, value_gm, true_value*val_csf/100)
+            yield [(i_start + i, WM_phantoms[i], WM_phantoms_noise[i], record['values'][i]) for i in range(nb_phantoms)]
+
+    # loop across bootstrap: the iterations are independent, they are run by nb_workers processes (each with its own
+    # tmp folder) and evaluate all the methods on the same phantom. Their results are streamed into a columnar table
+    results = run_validation(params, batches(), folder_tmp, min(nb_workers, nb_bootstraps)).to_arrays()
+    if fname_store is not None:
+        append_results(fname_store, results, sweep, std_noise, range_tract, val_csf, param_map)
+
+    # percent error within single tracts and within all tracts, statistics across tracts (automatic methods)
+    perc_error = pivot(results, 'tract', list_tracts_txt[:nb_tracts], list_methods, nb_bootstraps)
+    perc_error_all = pivot(results, 'label', range(nb_tracts_all), list_methods, nb_bootstraps)
+    stat_perc_error_all = np.zeros(shape=(nb_methods, nb_bootstraps, 4))
+    stat_perc_error_all[:, :, 0] = (perc_error_all ** 2).mean(axis=0)  # mean squared error
+    stat_perc_error_all[:, :, 1] = np.median(perc_error_all, axis=0)
+    stat_perc_error_all[:, :, 2] = perc_error_all.min(axis=0)
+    stat_perc_error_all[:, :, 3] = perc_error_all.max(axis=0)
+    list_methods_all = [method for method in list_methods if get_estimator(method)[1]]
 
     # Calculate elapsed time
     elapsed_time = int(round(time.time() - start_time))
@@ -300,8 +241,8 @@ def validate_atlas(folder_cropped_atlas, nb_bootstraps, std_noise, range_tract,
     text_methods = 'Label'
     # loop across methods
     for i_method in range(len(list_methods)):
-        # check if method is automatic
-        if list_methods[i_method].find('man') == -1:
+        # check if method estimates all tracts
+        if list_methods[i_method] in list_methods_all:
             text_methods = text_methods + ', ' + list_methods[i_method]
     print >>results_text, text_methods
 
@@ -311,8 +252,8 @@ def validate_atlas(folder_cropped_atlas, nb_bootstraps, std_noise, range_tract,
         text_results = str(i_tract)
         # loop across methods
         for i_method in range(len(list_methods)):
-            # check if method is automatic
-            if list_methods[i_method].find('man') == -1:
+            # check if method estimates all tracts
+            if list_methods[i_method] in list_methods_all:
                 text_results = text_results + ', ' + str(round(np.mean(perc_error_all[i_tract, i_method, :]), ndigits=nb_digits_results))+'('+str(round(np.std(perc_error_all[i_tract, i_method, :]), ndigits=nb_digits_results))+')'
         print >>results_text, text_results
 
@@ -322,8 +263,8 @@ def validate_atlas(folder_cropped_atlas, nb_bootstraps, std_noise, range_tract,
         text_results = list_stat[i_stat]
         # loop across methods
         for i_method in range(len(list_methods)):
-            # check if method is automatic
-            if list_methods[i_method].find('man') == -1:
+            # check if method estimates all tracts
+            if list_methods[i_method] in list_methods_all:
                 text_results = text_results + ', ' + str(round(np.mean(stat_perc_error_all[i_method, :, i_stat]), ndigits=nb_digits_results))+'('+str(round(np.std(stat_perc_error_all[i_method, :, i_stat]), ndigits=nb_digits_results))+')'
         print >>results_text, text_results
 
@@ -336,6 +277,57 @@ def validate_atlas(folder_cropped_atlas, nb_bootstraps, std_noise, range_tract,
 
 
 
+# parameters of the bootstrap iterations
+def bootstrap_params(atlas, tracts_matrix, shape, folder_cropped_atlas, nb_bootstraps, mask_folder, list_methods, test_map=0, param_map='20,20', list_tracts=[], in_process=0, sparse_atlas=None):
+    """
+    Parameters of the bootstrap iterations of a run (see validation_engine.run_bootstrap)
+    :param atlas: atlas of the tracts (nb_labels x nx x ny x nz), see load_atlas
+    :param tracts_matrix, shape: tracts of the atlas as a matrix and shape of the volume, see tracts_to_matrix
+    :param sparse_atlas: SparseAtlas of the atlas, used for the volumes of the labels and the in-process estimation
+    (built from atlas if None)
+    :return: params (dict)
+    """
+    # Parameters
+    file_phantom = "WM_phantom.nii.gz"
+    file_phantom_noise = "WM_phantom_noise.nii.gz"
+    file_tract_sum = "tracts_sum.nii.gz"
+    true_value = 40
+    file_extract_metrics = "metric_label.txt"
+    # list_tracts = ['2', '17', '0,1,15,16']
+    list_tracts_txt = ['csl', 'csr', 'dc']
+    nb_tracts_all = 32  # total number of tracts in atlas (do not include CSF tracts)
+    # dorsal_column_labels = '0,1,15,16'
+    # nb_tracts_dorsalcolumn = 4
+    value_gm = 35  # value in gray matter
+    #value_csf = 5  # value in csf
+    mask_prefix = 'manual_'
+    mask_ext = '.nii.gz'
+
+    # get file name of the first atlas file
+    fname_atlas = os.path.join(folder_cropped_atlas, 'WMtract__00.nii.gz')
+
+    if sparse_atlas is None:
+        sparse_atlas = SparseAtlas.from_dense(atlas)
+
+    # Get ponderation of each label of the tracts (e.g. dorsal column): the true value of a tract is the average of the
+    # values of its labels, weighted by their volume (sum of the partial volumes)
+    pond_tracts = []
+    for tract in list_tracts:
+        pond = sparse_atlas.volumes([int(label) for label in tract.split(',')])
+        # Normalize the sum of ponderations to 1
+        pond_tracts.append(pond / pond.sum())
+
+    return {'tracts_sum': tracts_matrix.sum(axis=0).reshape(shape), 'true_value': true_value, 'value_gm': value_gm,
+            'fname_atlas': fname_atlas, 'folder_cropped_atlas': folder_cropped_atlas, 'file_phantom': file_phantom,
+            'file_phantom_noise': file_phantom_noise, 'file_tract_sum': file_tract_sum,
+            'file_extract_metrics': file_extract_metrics, 'list_tracts': list_tracts,
+            'list_tracts_txt': list_tracts_txt,
+            'nb_tracts_all': nb_tracts_all, 'list_methods': list_methods, 'mask_folder': mask_folder,
+            'mask_prefix': mask_prefix, 'mask_ext': mask_ext, 'test_map': test_map, 'param_map': param_map,
+            'pond_tracts': pond_tracts, 'nb_bootstraps': nb_bootstraps, 'in_process': in_process,
+            'atlas': sparse_atlas if in_process else None}
+
+
 def create_folder(folder, delete=0):
     """create folder-- can delete if already exists"""
     if os.path.exists(folder):
@@ -346,48 +338,14 @@ def create_folder(folder, delete=0):
         os.mkdir(folder)
 
 
-# read results
-def read_results(fname_metrics):
-    # Read file
-    f = open(fname_metrics)
-
-    # Extract all lines in the results file from sct_extract_metric
-    # Do not extract lines which start with #
-    lines = [lines for lines in f.readlines() if lines.strip() if not lines.startswith("#")]
-
-    # read each line
-    metrics_results = []
-    for i in range(0, len(lines)):
-        line = lines[i].split(',')
-        # Get np.mean value of metric from column 2 of the text file
-        metrics_results.append(line[2][:-1].replace(" ", ""))
-    # Transform the column into a numpy array
-    metrics_results = np.array(metrics_results)
-    # Change the type of the values in the numpy array to float
-    metrics_results = metrics_results.astype(np.float)
-    return metrics_results
-
-
-
 # crop atlas
 def crop_atlas(folder_atlas, folder_out, zind):
 
     # get atlas files
-    status, output = sct.run('ls '+os.path.join(folder_atlas, '*.nii.gz'), 1)
-    fname_list = output.split()
-
-    # loop across atlas
-    for i in xrange(0, len(fname_list)):
-        path_list, file_list, ext_list = sct.extract_fname(fname_list[i])
-        # crop file and then merge back
-        cmd = 'fslmerge -z '+os.path.join(folder_out, file_list)
-        for iz in zind:
-            sct.run('fslroi '+fname_list[i]+' tmpcrop.z'+str(zind.index(iz))+'_'+file_list+' 0 -1 0 -1 '+str(iz)+' 1')
-            cmd = cmd+' tmpcrop.z'+str(zind.index(iz))+'_'+file_list
-        sct.run(cmd)
-
-    # delete tmp file
-    sct.run('rm tmpcrop.*')
+    fname_list = sorted(glob.glob(os.path.join(folder_atlas, '*.nii.gz')))
+
+    # extract the slices of all the files (one thread per file)
+    crop_files(fname_list, folder_out, zind)
 
 
 
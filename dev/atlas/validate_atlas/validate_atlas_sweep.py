@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Validation of WM atlas over a grid of parameters
+#
+# Runs the validation of the atlas (see validate_atlas) for every point of a grid of parameters
+# (std_noise, range_tract, val_csf, methods, MAP parameters). Every (grid point x bootstrap)
+# iteration is a task of a single process pool: each task generates its phantom from its own
+# seed and evaluates all the methods of its grid point on it. The results of the completed
+# tasks are checkpointed in the output folder, so an interrupted sweep resumes without running
+# them again. The checkpoint is only resumed with the same grid, seed, manual masks and atlas (see
+# checkpoint_key). At the end, the results of all the grid points are written to the results
+# store of the output folder (see results_store), read by the plot scripts.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2014 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os, sys, time, glob, json, getopt, datetime, shutil, multiprocessing
+import numpy as np
+path_sct = os.environ.get("SCT_DIR", os.path.dirname(os.path.dirname(__file__)))
+# append path that contains scripts, to be able to load modules
+sys.path.append(os.path.join(path_sct, "scripts"))
+import sct_utils as sct
+from load_atlas import load_atlas, read_label_file, cache_key, file_label_default
+from generate_phantom import tracts_to_matrix, phantom_generation_batch
+from validation_engine import results_columns, get_estimator, init_bootstrap_worker, run_bootstrap
+from results_store import file_store, append_results
+from sparse_atlas import SparseAtlas
+from validate_atlas import bootstrap_params
+
+
+folder_checkpoint = 'checkpoint'
+file_checkpoint_key = 'key.json'
+checkpoint_every = 60  # seconds between two checkpoints
+
+
+def default_grid():
+    """
+    Grid of the validation of the atlas (the sweeps of validate_atlas.main)
+    :return: list of the grid points (dict: sweep, std_noise, range_tract, val_csf, list_methods, test_map, param_map,
+    list_tracts)
+    """
+    # the noise, tracts and csf sweeps estimate all the labels, the manual_mask sweep the tracts
+    list_methods = ['ml', 'map', 'wa', 'wath', 'bin']
+    list_tracts = ['2', '17', '0,1,15,16']
+    fixed_noise, fixed_range, val_csf_fixed = 10, 10, 50
+
+    def point(sweep, std_noise=fixed_noise, range_tract=fixed_range, val_csf=val_csf_fixed, methods=list_methods,
+              test_map=0, param_map='20,20', tracts=[]):
+        return {'sweep': sweep, 'std_noise': std_noise, 'range_tract': range_tract, 'val_csf': val_csf,
+                'list_methods': methods, 'test_map': test_map, 'param_map': param_map, 'list_tracts': tracts}
+
+    grid = [point('noise', std_noise=std_noise) for std_noise in [0, 5, 10, 20]]
+    grid += [point('tracts', range_tract=range_tract) for range_tract in [0, 5, 10, 20]]
+    grid += [point('csf', val_csf=val_csf) for val_csf in [5, 10, 50, 100]]
+    grid += [point('manual_mask', methods=['bin', 'man0', 'man1', 'man2', 'man3'], tracts=list_tracts)]
+    grid += [point('map', methods=['map'], test_map=1, param_map=param_map, tracts=[])
+             for param_map in ['0,20', '5,20', '10,20', '15,20', '20,20', '25,20', '30,20', '20,0', '20,5', '20,10',
+                               '20,15', '20,25', '20,30']]
+    return grid
+
+
+def grid_product(sweep, std_noise_list, range_tract_list, val_csf_list, param_map_list=['20,20'], list_methods=['ml', 'map', 'wa', 'wath', 'bin'], list_tracts=[]):
+    """
+    Grid of all the combinations of the given parameters
+    :return: list of the grid points (see default_grid)
+    """
+    return [{'sweep': sweep, 'std_noise': std_noise, 'range_tract': range_tract, 'val_csf': val_csf,
+             'list_methods': list_methods, 'test_map': 0, 'param_map': param_map, 'list_tracts': list_tracts}
+            for std_noise in std_noise_list for range_tract in range_tract_list for val_csf in val_csf_list
+            for param_map in param_map_list]
+
+
+# state of the sweep worker (atlas, parameters of the grid points), set by init_sweep_worker
+sweep_state = {}
+
+
+def init_sweep_worker(folder_cropped_atlas, grid, nb_bootstraps, mask_folder, in_process, folder_tmp, seed):
+    """
+    initialize a process running sweep tasks: load the atlas (memory mapped cache, shared between the workers) and build
+    its sparse representation once for all the grid points
+    """
+    atlas = load_atlas(folder_cropped_atlas)[0]
+    tracts_matrix, shape = tracts_to_matrix(atlas)
+    sweep_state.update({'atlas': atlas, 'sparse_atlas': SparseAtlas.from_dense(atlas),
+                        'tracts_matrix': tracts_matrix, 'shape': shape, 'grid': grid, 'params': {},
+                        'folder_cropped_atlas': folder_cropped_atlas, 'nb_bootstraps': nb_bootstraps,
+                        'mask_folder': mask_folder, 'in_process': in_process, 'folder_tmp': folder_tmp, 'seed': seed})
+
+
+def run_task(task):
+    """
+    Run one bootstrap iteration of a grid point
+    :param task: i_point, i_bootstrap
+    :return: i_point, rows of the results table (see validation_engine.run_bootstrap)
+    """
+    i_point, i_bootstrap = task
+    s = sweep_state
+    point = s['grid'][i_point]
+    if i_point not in s['params']:
+        s['params'][i_point] = bootstrap_params(s['atlas'], s['tracts_matrix'], s['shape'], s['folder_cropped_atlas'],
+                                                s['nb_bootstraps'], s['mask_folder'], point['list_methods'],
+                                                point['test_map'], point['param_map'], point['list_tracts'],
+                                                s['in_process'], s['sparse_atlas'])
+    params = s['params'][i_point]
+    init_bootstrap_worker(params, s['folder_tmp'])
+
+    # phantom of the task, from its own seed: the results do not depend on the scheduling of the tasks
+    if s['seed'] is not None:
+        np.random.seed([s['seed'], i_point, i_bootstrap])
+    else:
+        np.random.seed()
+    true_value = params['true_value']
+    [WM_phantoms, WM_phantoms_noise, record] = phantom_generation_batch(s['tracts_matrix'], s['shape'], 1, point['std_noise'], point['range_tract'], true_value, params['value_gm'], true_value*point['val_csf']/100)
+    return i_point, run_bootstrap((i_bootstrap, WM_phantoms[0], WM_phantoms_noise[0], record['values'][0]))
+
+
+def checkpoint_key(folder_cropped_atlas, grid, nb_bootstraps, mask_folder, seed):
+    """
+    Key of the checkpoint: parameters the results of the tasks depend on, and the number of bootstrap iterations
+    :return: dict (grid, nb_bootstraps, seed, mask_folder, atlas: name, size and modification time of its files)
+    """
+    label_file = read_label_file(folder_cropped_atlas, file_label_default)[2]
+    key = {'grid': grid, 'nb_bootstraps': nb_bootstraps, 'seed': seed, 'mask_folder': mask_folder,
+           'atlas': cache_key(folder_cropped_atlas, file_label_default, label_file)}
+    # as read back from the key file
+    return json.loads(json.dumps(key))
+
+
+def check_checkpoint(folder_out, key, restart=0):
+    """
+    Check that the checkpoint of folder_out was written with the same grid, seed, manual masks and atlas, and write the
+    key of the sweep. The tasks do not depend on the number of bootstrap iterations (each one has its own seed): a
+    checkpoint with another number of iterations is resumed, its iterations beyond nb_bootstraps are not used
+    :param restart: if 1, a checkpoint with other parameters is deleted, otherwise an error is raised
+    """
+    folder = os.path.join(folder_out, folder_checkpoint)
+    fname_key = os.path.join(folder, file_checkpoint_key)
+    if os.path.isfile(fname_key):
+        previous = json.load(open(fname_key))
+        changed = [name for name in ['grid', 'seed', 'mask_folder', 'atlas'] if previous.get(name) != key[name]]
+        if changed:
+            if not restart:
+                raise ValueError('The checkpoint of '+folder_out+' was written with other parameters ('+', '.join(changed)+'): use another output folder, or restart the sweep')
+            sct.printv('WARNING: the checkpoint was written with other parameters ('+', '.join(changed)+'), restarting the sweep', 1, 'warning')
+            shutil.rmtree(folder)
+    elif glob.glob(os.path.join(folder, 'part*.npz')):
+        if not restart:
+            raise ValueError('The checkpoint of '+folder_out+' has no key: use another output folder, or restart the sweep')
+        shutil.rmtree(folder)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    json.dump(key, open(fname_key+'.tmp', 'w'))
+    os.rename(fname_key+'.tmp', fname_key)
+
+
+def read_checkpoints(folder_out, nb_bootstraps):
+    """
+    :return: rows of the completed tasks of the first nb_bootstraps iterations (dict of numpy arrays, with the column
+    'point'), or None if there are none
+    """
+    fname_parts = sorted(glob.glob(os.path.join(folder_out, folder_checkpoint, 'part*.npz')))
+    if not fname_parts:
+        return None
+    parts = []
+    for fname in fname_parts:
+        part = np.load(fname)
+        parts.append(dict((column, part[column]) for column in part.files))
+        part.close()
+    done = dict((column, np.concatenate([part[column] for part in parts])) for column in parts[0])
+    select = done['bootstrap'] < nb_bootstraps
+    return dict((column, done[column][select]) for column in done)
+
+
+def write_checkpoint(folder_out, rows):
+    """write the rows of newly completed tasks to a new part of the checkpoint"""
+    folder = os.path.join(folder_out, folder_checkpoint)
+    fname = os.path.join(folder, 'part'+datetime.datetime.now().strftime("%y%m%d%H%M%S%f")+'.npz')
+    # write to a temporary file then rename, so that an interrupted sweep never leaves a partial checkpoint
+    np.savez(fname+'.tmp.npz', **dict((column, np.array(rows[column])) for column in rows))
+    os.rename(fname+'.tmp.npz', fname)
+
+
+def run_sweep(folder_cropped_atlas, grid, nb_bootstraps, folder_out, mask_folder=[], nb_workers=1, seed=None, in_process=1, restart=0):
+    """
+    Run the validation of the atlas for every point of the grid, resuming from the checkpoint of folder_out
+    :param grid: list of the grid points (see default_grid)
+    :param nb_bootstraps: number of bootstrap iterations of each grid point
+    :param folder_out: output folder: checkpoint of the completed tasks and results store
+    :param nb_workers: number of processes running the tasks
+    :param seed: seed of the random generator of the phantoms (not seeded if None): task (point, bootstrap) is seeded with
+    [seed, point, bootstrap]
+    :param in_process: see validate_atlas
+    :param restart: if 1, the checkpoint of folder_out is deleted if it was written with other parameters (see
+    check_checkpoint), otherwise an error is raised
+    :return: file name of the results store
+    """
+    start_time = time.time()
+    folder_tmp = os.path.join(folder_out, 'tmp.'+datetime.datetime.now().strftime("%y%m%d%H%M%S%f"))
+
+    # check the methods and the checkpoint before starting
+    for point in grid:
+        for method in point['list_methods']:
+            get_estimator(method)
+    check_checkpoint(folder_out, checkpoint_key(folder_cropped_atlas, grid, nb_bootstraps, mask_folder, seed), restart)
+
+    # tasks not completed yet
+    done = read_checkpoints(folder_out, nb_bootstraps)
+    tasks_done = set()
+    if done is not None:
+        tasks_done = set(zip(done['point'].tolist(), done['bootstrap'].tolist()))
+    tasks = [(i_point, i_bootstrap) for i_point in range(len(grid)) for i_bootstrap in range(nb_bootstraps)
+             if (i_point, i_bootstrap) not in tasks_done]
+    sct.printv('Tasks: '+str(len(tasks))+' to run, '+str(len(grid)*nb_bootstraps-len(tasks))+' already completed', 1, 'info')
+
+    if tasks:
+        initargs = (folder_cropped_atlas, grid, nb_bootstraps, mask_folder, in_process, folder_tmp, seed)
+        if nb_workers > 1:
+            pool = multiprocessing.Pool(min(nb_workers, len(tasks)), init_sweep_worker, initargs)
+            results = pool.imap_unordered(run_task, tasks)
+        else:
+            pool = None
+            init_sweep_worker(*initargs)
+            results = (run_task(task) for task in tasks)
+        pending = dict((column, []) for column in results_columns + ['point'])
+        time_checkpoint = time.time()
+        try:
+            for i_point, rows in results:
+                for column in results_columns:
+                    pending[column].extend(rows[column])
+                pending['point'].extend([i_point] * len(rows['bootstrap']))
+                if time.time() - time_checkpoint > checkpoint_every:
+                    write_checkpoint(folder_out, pending)
+                    pending = dict((column, []) for column in pending)
+                    time_checkpoint = time.time()
+        finally:
+            # checkpoint the tasks completed so far, also when the sweep is interrupted
+            if pending['point']:
+                write_checkpoint(folder_out, pending)
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            shutil.rmtree(folder_tmp, ignore_errors=True)
+
+    # combined results of all the grid points
+    done = read_checkpoints(folder_out, nb_bootstraps)
+    fname_store = os.path.join(folder_out, file_store)
+    if os.path.isdir(fname_store):
+        shutil.rmtree(fname_store)
+    for i_point in range(len(grid)):
+        point = grid[i_point]
+        select = done['point'] == i_point
+        append_results(fname_store, dict((column, done[column][select]) for column in results_columns), point['sweep'],
+                       point['std_noise'], point['range_tract'], point['val_csf'], point['param_map'])
+    sct.printv('Results of '+str(len(grid))+' grid points in '+fname_store+' ('+str(int(round(time.time()-start_time)))+'s)', 1, 'info')
+    return fname_store
+
+
+def usage():
+    print """
+""" + os.path.basename(__file__) + """
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+DESCRIPTION
+  Run the validation of the atlas for all the parameters of validate_atlas (noise, tract range, CSF
+  value, manual masks, MAP parameters) on a pool of processes. An interrupted sweep is resumed
+  from the checkpoint of the output folder.
+
+USAGE
+  """ + os.path.basename(__file__) + """ -a <cropped_atlas> -o <output_folder>
+
+OPTIONAL ARGUMENTS
+  -a <folder>       folder of the cropped atlas. Default: cropped_atlas/
+  -o <folder>       output folder (checkpoint and """ + file_store + """). Default: results_sweep/
+  -n <int>          number of bootstrap iterations of each grid point. Default: 200
+  -w <int>          number of processes. Default: number of CPUs
+  -s <int>          seed of the phantoms. Default: not seeded
+  -r                restart the sweep if the checkpoint of the output folder was written with another grid,
+                    seed or atlas. Default: stop with an error
+  -h                help. Show this message
+"""
+    sys.exit(2)
+
+
+def main():
+    folder_cropped_atlas = 'cropped_atlas/'
+    folder_out = 'results_sweep/'
+    nb_bootstraps = 200
+    nb_workers = multiprocessing.cpu_count()
+    seed = None
+    restart = 0
+    mask_folder = ['manual_masks/charles/', 'manual_masks/julien/', 'manual_masks/tanguy/', 'manual_masks/simon/']  # folder of manual masks
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'ha:o:n:w:s:r')
+    except getopt.GetoptError:
+        usage()
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+        elif opt == '-a':
+            folder_cropped_atlas = arg
+        elif opt == '-o':
+            folder_out = arg
+        elif opt == '-n':
+            nb_bootstraps = int(arg)
+        elif opt == '-w':
+            nb_workers = int(arg)
+        elif opt == '-s':
+            seed = int(arg)
+        elif opt == '-r':
+            restart = 1
+
+    run_sweep(folder_cropped_atlas, default_grid(), nb_bootstraps, folder_out, mask_folder, nb_workers, seed, restart=restart)
+
+
+if __name__ == "__main__":
+    main()
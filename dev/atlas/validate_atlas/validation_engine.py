@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Engine of the validation of the atlas on phantoms
+#
+# Each bootstrap iteration evaluates all the estimation methods on the same phantom. The methods
+# are estimators registered by name (see register_estimator): the automatic methods (bin, wa,
+# wath, ml, map) estimate the metric in the tracts and in all the labels of the atlas, the manual
+# methods (man0, man1, ...) only in the tracts, within the manual masks. The estimates are
+# streamed into a columnar results table (see ResultsTable), one row per estimate.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2014 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import numpy as np
+import nibabel as nib
+import sct_utils as sct
+from generate_phantom import save_3D_nparray_nifti
+from extract_metric import extract_metric, average_within_mask
+
+
+# registry of the estimation methods: name -> (function, all_labels)
+estimators = {}
+# families of estimation methods, named prefix + parameter (e.g. man0): prefix -> (factory, all_labels)
+estimator_families = {}
+
+# columns of the results table
+results_columns = ['bootstrap', 'method', 'kind', 'tract', 'label', 'true_value', 'estimate', 'perc_error']
+
+
+def register_estimator(name, function, all_labels=1):
+    """
+    Register an estimation method
+    :param name: name of the method, as given in list_methods
+    :param function: function(data, context, i_tract) estimating the metric in the phantom data (3d numpy array):
+    within the tract i_tract of context['list_tracts'] (returns a float), or in all the labels of the atlas if i_tract is
+    None (returns an array, one estimate per label). context holds the parameters of the run (see init_bootstrap_worker)
+    :param all_labels: 1 if the method estimates all the labels of the atlas (automatic methods), 0 if it only estimates
+    the tracts (manual masks)
+    """
+    estimators[name] = (function, all_labels)
+
+
+def register_estimator_family(prefix, factory, all_labels=1):
+    """
+    Register a family of estimation methods named prefix + parameter
+    :param factory: factory(parameter) returning the function of the method (see register_estimator)
+    """
+    estimator_families[prefix] = (factory, all_labels)
+
+
+def get_estimator(name):
+    """
+    :return: function, all_labels of the estimation method (see register_estimator)
+    """
+    if name not in estimators:
+        for prefix in estimator_families:
+            if name.startswith(prefix) and len(name) > len(prefix):
+                factory, all_labels = estimator_families[prefix]
+                register_estimator(name, factory(name[len(prefix):]), all_labels)
+                break
+        else:
+            raise ValueError('Unknown estimation method: '+name)
+    return estimators[name]
+
+
+def atlas_estimator(method):
+    """automatic method of extract_metric, or sct_extract_metric if context['in_process'] is 0"""
+    def estimate(data, context, i_tract):
+        labels = None if i_tract is None else [int(label) for label in context['list_tracts'][i_tract].split(',')]
+        if context['in_process']:
+            estimates = extract_metric(data, context['atlas'], method, labels, labels is not None, context['param_map'])
+        else:
+            fname_extract_metrics = os.path.join(context['folder_tmp'], context['file_extract_metrics'])
+            cmd = 'sct_extract_metric -i ' + context['fname_phantom_noise'] + ' -f ' + context['folder_cropped_atlas'] + ' -m ' + method
+            if labels is None:
+                cmd += ' -o ' + fname_extract_metrics + ' -p ' + context['param_map']
+            else:
+                cmd += ' -l ' + context['list_tracts'][i_tract] + ' -a -o ' + fname_extract_metrics
+            sct.run(cmd)
+            estimates = read_results(fname_extract_metrics)
+        return estimates if labels is None else float(estimates[0])
+    return estimate
+
+
+def manual_estimator(index_manual):
+    """average within the manual mask of the tract drawn by the rater index_manual (see context['mask_folder'])"""
+    index_manual = int(index_manual)
+
+    def estimate(data, context, i_tract):
+        fname_mask = context['mask_folder'][index_manual] + context['mask_prefix'] + context['list_tracts_txt'][i_tract] + context['mask_ext']
+        if context['in_process']:
+            return average_within_mask(data, load_mask(fname_mask))
+        status, output = sct.run('sct_average_data_within_mask -i ' + context['fname_phantom_noise'] + ' -m ' + fname_mask + ' -v 0')
+        return float(output)
+    return estimate
+
+
+for method in ['bin', 'wa', 'wath', 'ml', 'map']:
+    register_estimator(method, atlas_estimator(method))
+register_estimator_family('man', manual_estimator, all_labels=0)
+
+
+class ResultsTable(object):
+    """
+    Columnar table of results: one list per column, rows appended by blocks
+    """
+    def __init__(self, columns=results_columns):
+        self.columns = list(columns)
+        self.data = dict((column, []) for column in self.columns)
+
+    def append(self, rows):
+        """
+        :param rows: dict of the values of each column (lists of the same length)
+        """
+        for column in self.columns:
+            self.data[column].extend(rows[column])
+
+    def __len__(self):
+        return len(self.data[self.columns[0]])
+
+    def to_arrays(self):
+        """:return: dict of numpy arrays, one per column"""
+        return dict((column, np.array(self.data[column])) for column in self.columns)
+
+
+def pivot(results, kind, values, list_methods, nb_bootstraps, column='perc_error'):
+    """
+    Arrange a column of the results in an array
+    :param results: dict of numpy arrays (see ResultsTable.to_arrays)
+    :param kind: 'tract' or 'label' rows
+    :param values: tract names (kind 'tract') or label indices (kind 'label'), in the order of the rows of the array
+    :return: array (len(values) x len(list_methods) x nb_bootstraps), 0 where there is no result
+    """
+    array = np.zeros((len(values), len(list_methods), nb_bootstraps))
+    key = 'tract' if kind == 'tract' else 'label'
+    select = results['kind'] == kind
+    index_value = dict((v, i) for i, v in enumerate(values))
+    index_method = dict((m, i) for i, m in enumerate(list_methods))
+    rows = np.array([index_value.get(v, -1) for v in results[key][select]], dtype=int)
+    cols = np.array([index_method.get(m, -1) for m in results['method'][select]], dtype=int)
+    keep = (rows >= 0) & (cols >= 0)
+    array[rows[keep], cols[keep], results['bootstrap'][select][keep]] = results[column][select][keep]
+    return array
+
+
+# state of the bootstrap worker (parameters, tmp folder), set by init_bootstrap_worker
+bootstrap_state = {}
+
+
+def init_bootstrap_worker(params, folder_tmp):
+    """initialize a process running bootstrap iterations: its own tmp folder"""
+    folder_worker = os.path.join(folder_tmp, 'worker'+str(os.getpid()))
+    if not os.path.exists(folder_worker):
+        os.makedirs(folder_worker)
+    bootstrap_state.update(params)
+    bootstrap_state['folder_tmp'] = folder_worker
+    bootstrap_state['fname_phantom_noise'] = os.path.join(folder_worker, params['file_phantom_noise'])
+
+
+def run_bootstrap(bootstrap):
+    """
+    Run one bootstrap iteration: estimate the metric in the tracts (and in all the labels) of a phantom with each method
+    :param bootstrap: i_bootstrap, WM_phantom, WM_phantom_noise, values_synthetic_data (see phantom_generation_batch)
+    :return: rows of the results table (see results_columns)
+    """
+    p = bootstrap_state
+    i_bootstrap, WM_phantom, WM_phantom_noise, values_synthetic_data = bootstrap
+    list_tracts = p['list_tracts']
+    list_methods = p['list_methods']
+    sct.printv('Iteration:  ' + str(i_bootstrap+1) + '/' + str(p['nb_bootstraps']), 1, 'warning')
+    rows = dict((column, []) for column in results_columns)
+
+    def add_rows(method, kind, tract, label, true_value, estimate):
+        true_value = np.atleast_1d(true_value).astype(np.float64)
+        estimate = np.atleast_1d(estimate).astype(np.float64)
+        rows['bootstrap'].extend([i_bootstrap] * len(estimate))
+        rows['method'].extend([method] * len(estimate))
+        rows['kind'].extend([kind] * len(estimate))
+        rows['tract'].extend(tract)
+        rows['label'].extend(label)
+        rows['true_value'].extend(true_value)
+        rows['estimate'].extend(estimate)
+        rows['perc_error'].extend(100 * abs(estimate - true_value) / true_value)
+
+    # Save generated phantoms as nifti image (.nii.gz)
+    if not p['in_process']:
+        fname_atlas = p['fname_atlas']
+        save_3D_nparray_nifti(WM_phantom, os.path.join(p['folder_tmp'], p['file_phantom']), fname_atlas)
+        save_3D_nparray_nifti(WM_phantom_noise, p['fname_phantom_noise'], fname_atlas)
+        save_3D_nparray_nifti(p['tracts_sum'], os.path.join(p['folder_tmp'], p['file_tract_sum']), fname_atlas)
+
+    # estimation within the tracts
+    if list_tracts and not p['test_map']:
+        # true values: average of the labels of each tract, weighted by their volume (pond_tracts)
+        for i_tract in range(len(list_tracts)):
+            labels = [int(label) for label in list_tracts[i_tract].split(',')]
+            x_true = float(np.dot(values_synthetic_data[labels], p['pond_tracts'][i_tract]))
+            for method in list_methods:
+                print 'Tract: '+list_tracts[i_tract]+', Method: '+method
+                x_estim = get_estimator(method)[0](WM_phantom_noise, p, i_tract)
+                add_rows(method, 'tract', [p['list_tracts_txt'][i_tract]], [-1], x_true, x_estim)
+
+    # estimation within all the labels (only for the methods estimating all the labels)
+    index_nonzero = np.nonzero(values_synthetic_data)[0]
+    for method in list_methods:
+        function, all_labels = get_estimator(method)
+        if all_labels:
+            print 'Tract: ALL, Method: '+method
+            x_estim_all = function(WM_phantom_noise, p, None)
+            add_rows(method, 'label', [''] * len(index_nonzero), index_nonzero, values_synthetic_data[index_nonzero],
+                     x_estim_all[index_nonzero])
+
+    return rows
+
+
+def run_validation(params, batches, folder_tmp, nb_workers=1, table=None):
+    """
+    Run the bootstrap iterations and stream their results into a table. The batches are submitted one at a time: the
+    next batch is only taken from the iterable when all the iterations of the previous one are done, so that a generator
+    of batches only holds one batch of phantoms in memory
+    :param params: parameters of the run (see init_bootstrap_worker)
+    :param batches: iterable of the batches (lists) of bootstrap iterations (see run_bootstrap)
+    :param folder_tmp: temporary folder (one sub-folder per worker)
+    :param nb_workers: number of processes running the bootstrap iterations (1: sequential)
+    :param table: ResultsTable receiving the results (created if None)
+    :return: table
+    """
+    import multiprocessing
+    if table is None:
+        table = ResultsTable()
+    # check the methods before starting
+    for method in params['list_methods']:
+        get_estimator(method)
+    if nb_workers > 1:
+        pool = multiprocessing.Pool(nb_workers, init_bootstrap_worker, (params, folder_tmp))
+        run_batch = lambda batch: pool.imap_unordered(run_bootstrap, batch)
+    else:
+        pool = None
+        init_bootstrap_worker(params, folder_tmp)
+        run_batch = lambda batch: (run_bootstrap(bootstrap) for bootstrap in batch)
+    try:
+        for batch in batches:
+            for rows in run_batch(batch):
+                table.append(rows)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        bootstrap_state.clear()
+    return table
+
+
+def load_mask(fname_mask):
+    """load a manual mask, once per process"""
+    masks = bootstrap_state.setdefault('masks', {})
+    if fname_mask not in masks:
+        masks[fname_mask] = nib.load(fname_mask).get_data()
+    return masks[fname_mask]
+
+
+# read results
+def read_results(fname_metrics):
+    # Read file
+    f = open(fname_metrics)
+
+    # Extract all lines in the results file from sct_extract_metric
+    # Do not extract lines which start with #
+    lines = [lines for lines in f.readlines() if lines.strip() if not lines.startswith("#")]
+
+    # read each line
+    metrics_results = []
+    for i in range(0, len(lines)):
+        line = lines[i].split(',')
+        # Get np.mean value of metric from column 2 of the text file
+        metrics_results.append(line[2][:-1].replace(" ", ""))
+    # Transform the column into a numpy array
+    metrics_results = np.array(metrics_results)
+    # Change the type of the values in the numpy array to float
+    metrics_results = metrics_results.astype(np.float)
+    return metrics_results
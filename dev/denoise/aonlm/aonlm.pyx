@@ -1,9 +1,16 @@
 cimport cython
 from cython.view cimport array as cvarray
+from libc.math cimport exp, sqrt, fabs, isnan
+import os
+import sys
 import numpy as np
 import math
+# the foreground restriction and the local moments are shared with ornlm
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from foreground import crop_to_foreground, paste_foreground
+from moments import local_moments
 cdef extern from "mabonlm3d.h":
-    void mabonlm3d_c(double *ima, int *dims, int v, int f, int r, double *fima)
+    void mabonlm3d_c(double *ima, int *dims, int v, int f, int r, double *fima, int Nthreads, unsigned char *mask) nogil
     void Average_block(double *ima,int x,int y,int z,int neighborhoodsize,double *average, double weight, int sx,int sy,int sz, int rician)
     void Value_block(double *Estimate, double *Label,int x,int y,int z,int neighborhoodsize,double *average, double global_sum, int sx,int sy,int sz)
     double distance(double* ima,int x,int y,int z,int nx,int ny,int nz,int f,int sx,int sy,int sz)
@@ -12,30 +19,30 @@ cdef extern from "mabonlm3d.h":
 cdef inline int _int_max(int a, int b): return a if a >= b else b
 cdef inline int _int_min(int a, int b): return a if a <= b else b
 
-cdef double bessi0(double x):
+cdef double bessi0(double x) nogil:
     '''
     Returns the modified Bessel function I0(x) for any real x.
     '''
     cdef double ax,ans,a,y
-    ax=np.abs(x)
+    ax=fabs(x)
     if(ax<3.75):
         y=x/3.75
         y*=y
         ans=1.0+y*(3.5156229+y*(3.0899424+y*(1.2067492+y*(0.2659732+y*(0.360768e-1+y*0.45813e-2)))))
     else:
         y=3.75/ax
-        ans=(np.exp(ax)/np.sqrt(ax))
+        ans=(exp(ax)/sqrt(ax))
         a=y*(0.916281e-2+y*(-0.2057706e-1+y*(0.2635537e-1+y*(-0.1647633e-1+y*0.392377e-2))))
         ans=ans*(0.39894228 + y*(0.1328592e-1 +y*(0.225319e-2+y*(-0.157565e-2+a))))
     return ans
 
 
-cdef double bessi1(double x):
+cdef double bessi1(double x) nogil:
     '''
     Returns the modified Bessel function I1(x) for any real x.
     '''
     cdef double ax,ans,y
-    ax=np.abs(x)
+    ax=fabs(x)
     if(ax < 3.75):
         y=x/3.75
         y*=y
@@ -44,16 +51,16 @@ cdef double bessi1(double x):
         y=3.75/ax
         ans=0.2282967e-1+y*(-0.2895312e-1+y*(0.1787654e-1-y*0.420059e-2))
         ans=0.39894228+y*(-0.3988024e-1+y*(-0.362018e-2+y*(0.163801e-2+y*(-0.1031555e-1+y*ans))))
-        ans *= (np.exp(ax)/np.sqrt(ax))
+        ans *= (exp(ax)/sqrt(ax))
     if(x<0):
         return -ans
     return ans
 
-cdef double Epsi(double snr):
+cdef double Epsi(double snr) nogil:
     cdef double pi=3.1415926535
     cdef double val
     val=(2 + snr*snr - 
-        (pi/8)*np.exp(-(snr*snr)/2)*((2+snr*snr)*bessi0((snr*snr)/4) + 
+        (pi/8)*exp(-(snr*snr)/2)*((2+snr*snr)*bessi0((snr*snr)/4) + 
         (snr*snr)*bessi1((snr*snr)/4))*((2+snr*snr)*bessi0((snr*snr)/4) + 
         (snr*snr)*bessi1((snr*snr)/4)))
     if(val<0.001):
@@ -62,6 +69,60 @@ cdef double Epsi(double snr):
         val=1    
     return val
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _bias_from_moments(double[:] means, double[:] variances, 
+                             double[:] bias) nogil:
+    '''
+    Rician bias 2*sigma^2 of the voxels with positive variance, where sigma^2 
+    is the variance corrected by the Koay factor Epsi of the local SNR. NaN 
+    biases are set to zero.
+    '''
+    cdef int i
+    cdef double snr
+    for i in range(means.shape[0]):
+        snr=means[i]/sqrt(variances[i])
+        bias[i]=2*(variances[i]/Epsi(snr))
+        if isnan(bias[i]):
+            bias[i]=0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _subtract_bias(double[:] moments, double[:] bias, 
+                         double[:] out) nogil:
+    '''
+    out=sqrt(max(0, moments-bias)), elementwise
+    '''
+    cdef int i
+    cdef double estimate
+    for i in range(moments.shape[0]):
+        estimate=moments[i]-bias[i]
+        if estimate<0:
+            estimate=0
+        out[i]=sqrt(estimate)
+
+def rician_bias_correct(volume, sigma):
+    '''
+    Removes the rician bias from a volume of (filtered) second order moments 
+    E[M^2] of the magnitude M, as the aggregation of the rician mode of aonlm 
+    does: returns sqrt(max(0, volume-2*sigma^2)).
+    Parameters
+    ----------
+        volume: array of second order moments (e.g. the non-local means of 
+            the squared image)
+        sigma: the standard deviation of the noise, a scalar or an array of 
+            the shape of volume (e.g. a local noise map)
+    '''
+    out=np.array(volume, dtype=np.float64)
+    bias=np.empty(out.shape)
+    bias[...]=2*np.asarray(sigma, dtype=np.float64)**2
+    cdef double[:] moments=out.reshape(-1)
+    cdef double[:] bias_flat=bias.reshape(-1)
+    with nogil:
+        _subtract_bias(moments, bias_flat, moments)
+    return out
+
 cpdef _average_block(double[:,:,:] ima, int x, int y, int z, 
                    double[:,:,:] average, double weight, int rician):
     cdef int a, b, c, x_pos, y_pos, z_pos
@@ -352,39 +413,6 @@ cdef void _regularize(double[:,:,:] imgIn, double[:,:,:] imgOut, int r):
 #                    totalweight = totalweight + wmax
 #                    _value_block(Estimate, Label,i, j, k, average, totalweight)
 
-def _local_mean(double [:,:,:]ima, int x, int y, int z):
-    cdef int[:] dims=cvarray((3,), itemsize=sizeof(int), format="i")
-    dims[0]=ima.shape[0]
-    dims[1]=ima.shape[1]
-    dims[2]=ima.shape[2]
-    cdef double ss=0
-    cdef int px, py, pz, dx, dy, dz, nx, ny, nz
-    for px in range(x-1,x+2):
-        for py in range(y-1,y+2):
-            for pz in range(z-1,z+2):
-                px=(-px if px<0 else (2*dims[0]-px-1 if px>=dims[0] else px))
-                py=(-py if py<0 else (2*dims[1]-py-1 if py>=dims[1] else py))
-                pz=(-pz if pz<0 else (2*dims[2]-pz-1 if pz>=dims[2] else pz))
-                ss+=ima[px,py,pz]
-    return ss/27.0
-
-def _local_variance(double[:,:,:] ima, double mean, int x, int y, int z):
-    cdef int[:] dims=cvarray((3,), itemsize=sizeof(int), format="i")
-    dims[0]=ima.shape[0]
-    dims[1]=ima.shape[1]
-    dims[2]=ima.shape[2]
-    cdef int cnt=0
-    cdef double ss=0
-    cdef int dx, dy, dz, nx, ny, nz
-    for px in range(x-1,x+2):
-        for py in range(y-1,y+2):
-            for pz in range(z-1,z+2):
-                if ((px>=0 and py>=0 and pz>0) and 
-                            (px<dims[0] and py<dims[1] and pz<dims[2])):
-                    ss+=(ima[px,py,pz]-mean)*(ima[px,py,pz]-mean)
-                    cnt+=1
-    return ss/(cnt-1)
-
 def mabonlm3d(double[:,:,:] image, int v, int f, int rician):
     cdef int USE_CPP_IMPLEMENTATION=1
     cdef double[:,:,:] ima=image.copy_fortran()
@@ -395,8 +423,7 @@ def mabonlm3d(double[:,:,:] image, int v, int f, int rician):
     cdef int slices=ima.shape[2]
     cdef double[:,:,:] average=np.zeros((2*f+1,2*f+1,2*f+1), dtype=np.float64, order='F')
     cdef double[:,:,:] fima=np.zeros_like(ima, order='F')
-    cdef double[:,:,:] means=np.zeros_like(ima, order='F')
-    cdef double[:,:,:] variances=np.zeros_like(ima, order='F')
+    cdef double[:,:,:] means, variances
     cdef double[:,:,:] Estimate=np.zeros_like(ima, order='F')
     cdef double[:,:,:] Label=np.zeros_like(ima, order='F')
     cdef double[:,:,:] bias=np.zeros_like(ima, order='F')
@@ -406,15 +433,8 @@ def mabonlm3d(double[:,:,:] image, int v, int f, int rician):
     cdef double init = 0
     cdef int Ndims = (2*f+1)*(2*f+1)*(2*f+1)
     cdef double wmax=0.0
-    cdef double globalMax=0
-    for k in range(slices):
-        for i in range(cols):
-            for j in range(rows):
-                if(globalMax<ima[i,j,k]):
-                    globalMax=ima[i,j,k]
-                mm=_local_mean(ima,i,j,k)
-                means[i,j,k]=mm
-                variances[i,j,k]=_local_variance(ima, mm, i, j, k)
+    cdef double globalMax=max(0.0, np.max(ima))
+    means, variances=local_moments(ima, 1)
     ##########################################################################
     ##########################################################################
     for k in range(0, slices, 2):
@@ -511,31 +531,21 @@ def mabonlm3d(double[:,:,:] image, int v, int f, int rician):
     if(rician):
         r=np.min([5, slices, rows, cols])
         _regularize(bias, variances, r)
-        for k in range(slices):
-            for j in range(rows):
-                for i in range(cols):
-                    if(variances[i,j,k]>0):
-                        SNR=means[i,j,k]/np.sqrt(variances[i,j,k])
-                        bias[i,j,k]=2*(variances[i,j,k]/Epsi(SNR))
-                        if(np.isnan(bias[i,j,k])):
-                            bias[i]=0
+        # the regularized distances are in 'variances'
+        positive=np.asarray(variances)>0
+        corrected=np.empty(np.count_nonzero(positive))
+        _bias_from_moments(np.asarray(means)[positive], 
+                           np.asarray(variances)[positive], corrected)
+        np.asarray(bias)[positive]=corrected
     #Aggregation of the estimators (i.e. means computation)
-    label = 0.0;
-    estimate = 0.0;
-    for i in range(cols):
-        for j in range(rows):
-            for k in range(slices):
-                label = Label[i,j,k]
-                if(label == 0.0):
-                    fima[i,j,k] = ima[i,j,k]
-                else:
-                    estimate = Estimate[i,j,k]
-                    estimate = (estimate/label)
-                    if(rician):
-                        estimate=np.max([0, estimate-bias[i,j,k]])
-                        fima[i,j,k]=np.sqrt(estimate)
-                    else:
-                        fima[i,j,k]=estimate
+    labels=np.asarray(Label)
+    labeled=labels!=0
+    estimates=np.asarray(Estimate)[labeled]/labels[labeled]
+    if(rician):
+        _subtract_bias(estimates, np.asarray(bias)[labeled], estimates)
+    fima_arr=np.array(ima, order='F')
+    fima_arr[labeled]=estimates
+    fima=fima_arr
     return fima
 
 def _firdn_vector(double[:] f, double[:] h, double[:] out):
@@ -625,16 +635,62 @@ cpdef upfir(double[:,:] image, double[:] h):
     _upfir_matrix(image, h, filtered)
     return filtered
 
-def aonlm(double [:,:,:]image, int v, int f, int r):
+def _aonlm_sweep(double [:,:,:]image, int v, int f, int r, int num_threads, 
+                 search):
     cdef double[:,:,:] I=image.copy_fortran()
     cdef double[:,:,:] filtered=I.copy_fortran()
+    cdef unsigned char[:,:,:] M
+    cdef unsigned char *mask=NULL
     cdef int[:] dims=cvarray((3,), itemsize=sizeof(int), format="i")
     dims[0]=I.shape[0]
     dims[1]=I.shape[1]
     dims[2]=I.shape[2]
-    mabonlm3d_c(&I[0,0,0], &dims[0], v, f, r, &filtered[0,0,0])
+    if search is not None:
+        M=np.asfortranarray(search, dtype=np.uint8)
+        mask=&M[0,0,0]
+    with nogil:
+        mabonlm3d_c(&I[0,0,0], &dims[0], v, f, r, &filtered[0,0,0], num_threads, 
+                    mask)
     return filtered
 
+def aonlm(double [:,:,:]image, int v, int f, int r, int num_threads=1, 
+          mask=None):
+    '''
+    Filters the given 3D image with the adaptive non-local means filter of
+    J. V. Manjon et al. (mabonlm3d_c). Returns the filtered image.
+    Parameters
+    ----------
+        image: the 3D image to be filtered
+        v:  radius of the search window
+        f:  radius of the blocks
+        r:  if nonzero, the rician bias correction is applied
+        num_threads: number of threads used for the blockwise sweep. The 
+            block grid is split into z-chunks of 2f slices that idle threads 
+            take from a shared queue, so the threads stay busy even when the 
+            foreground only covers a few slices. With num_threads=1 the 
+            chunks are filtered in order, as the sequential implementation. 
+            With more threads the running maximum weight given to the 
+            central block is reset at each chunk, so the output (the same 
+            for any num_threads>1) differs slightly from the sequential one
+        mask: optional foreground (3D array of the image shape, nonzero 
+            inside) or bounding box (three (start, stop) pairs). Only the 
+            blocks overlapping the foreground are filtered, searching for 
+            similar blocks among them, and the voxels outside the foreground 
+            are returned unchanged
+    '''
+    if num_threads<1:
+        raise ValueError('num_threads must be positive')
+    if mask is None:
+        return _aonlm_sweep(image, v, f, r, num_threads, None)
+    region=crop_to_foreground(mask, 
+                              (image.shape[0], image.shape[1], image.shape[2]), 
+                              f)
+    if region is None:
+        return np.array(image)
+    box, search, fg=region
+    filtered=_aonlm_sweep(np.asarray(image)[box], v, f, r, num_threads, search)
+    return paste_foreground(image, filtered, box, fg)
+
 def Average_block_cpp(double[:,:,:] X, int px, int py, int pz, double[:,:,:] average, double weight, int rician):
     Average_block(&X[0,0,0], px, py, pz, average.shape[0]//2, &average[0,0,0], weight, X.shape[0], X.shape[1], X.shape[2], rician)
 
@@ -46,22 +46,66 @@ int _isnan(double x){
 
 #define pi 3.1415926535
 
+/* Queue of z-chunks of the block grid, shared by the worker threads */
+typedef struct{
+    int next;      /* next chunk to be taken */
+    int end;       /* the chunks are next, next+step, ... < end */
+    int step;
+    int chunk;     /* number of slices per chunk (even) */
+    int slices;
+    int chunk_wmax; /* if nonzero wmax is reset at the start of each chunk */
+#ifdef _WIN32
+    CRITICAL_SECTION lock;
+#else
+    pthread_mutex_t lock;
+#endif
+}workqueue;
+
 typedef struct{
     int rows;
     int cols;
     int slices;
     double * in_image;   
+    double * padded_image;   /* in_image mirrored by radioS voxels */
+    double * padded_residual;/* in_image-means_image, mirrored likewise */
     double * means_image;
     double * var_image;    
     double * estimate;    
     double * label;    
     double * bias;
-    int ini;
-    int fin;
+    unsigned char * mask;
+    workqueue * queue;
     int radioB;
     int radioS;   
+    int rician;
+    double globalMax;
+    double wmax;
 }myargument;
 
+/* Takes the next chunk from the queue, returns 0 if there are none left.
+   [*ini, *fin) is the z-range of the chunk. */
+int next_chunk(workqueue *queue, int *ini, int *fin)
+{
+    int c;
+#ifdef _WIN32
+    EnterCriticalSection(&queue->lock);
+#else
+    pthread_mutex_lock(&queue->lock);
+#endif
+    c=queue->next;
+    if(c<queue->end) queue->next=c+queue->step;
+#ifdef _WIN32
+    LeaveCriticalSection(&queue->lock);
+#else
+    pthread_mutex_unlock(&queue->lock);
+#endif
+    if(c>=queue->end) return 0;
+    *ini=c*queue->chunk;
+    *fin=(c+1)*queue->chunk;
+    if(*fin>queue->slices) *fin=queue->slices;
+    return 1;
+}
+
 /*Returns the modified Bessel function I0(x) for any real x.*/
 double bessi0(double x)
 {
@@ -294,6 +338,77 @@ d=distancetotal/acu;
 return d;
 }
 
+/* Returns the image extended by f voxels along each axis, mirrored as in 
+   distance (index -n reads n, index s+n reads s-n-1), of size 
+   (sx+2f)*(sy+2f)*(sz+2f). If medias is not NULL, the mirrored image is
+   ima-medias. */
+double *Mirror_pad(double *ima, double *medias, int f, int sx, int sy, int sz)
+{
+int i,j,k,ni,nj,nk,psx,psy,psz;
+double *pad;
+
+psx=sx+2*f;
+psy=sy+2*f;
+psz=sz+2*f;
+pad=(double*)malloc(psx*psy*psz*sizeof(double));
+for(k=0;k<psz;k++)
+{
+ nk=k-f;
+ if(nk<0) nk=-nk;
+ if(nk>=sz) nk=2*sz-nk-1;
+ for(j=0;j<psy;j++)
+ {
+  nj=j-f;
+  if(nj<0) nj=-nj;
+  if(nj>=sy) nj=2*sy-nj-1;
+  for(i=0;i<psx;i++)
+  {
+    ni=i-f;
+    if(ni<0) ni=-ni;
+    if(ni>=sx) ni=2*sx-ni-1;
+    if(medias==NULL) pad[k*(psx*psy)+(j*psx)+i]=ima[nk*(sx*sy)+(nj*sx)+ni];
+    else pad[k*(psx*psy)+(j*psx)+i]=ima[nk*(sx*sy)+(nj*sx)+ni]-medias[nk*(sx*sy)+(nj*sx)+ni];
+  }
+ }
+}
+return pad;
+}
+
+/* Same as distance (and distance2, on the padded residual) on an image 
+   padded by Mirror_pad (psx, psy: padded sizes): the patches are read row by row 
+   without bounds checks, in the same order. The scan stops as soon as the 
+   distance computed so far (a lower bound of the distance) exceeds 
+   'cutoff', and that partial distance is returned: the callers only use 
+   the distances below their cut-off (the minimum distance, 3 times the 
+   minimum distance), so the result is the same. */
+double patch_distance(double *pad,int x,int y,int z,int nx,int ny,int nz,int f,int psx,int psy,double cutoff)
+{
+double d,acu,distancetotal;
+double *row1,*row2;
+int i,j,k;
+
+acu=(2*f+1)*(2*f+1)*(2*f+1);
+distancetotal=0;
+for(k=0;k<=2*f;k++)
+{
+ for(j=0;j<=2*f;j++)
+ {
+  row1=pad+(z+k)*(psx*psy)+((y+j)*psx)+x;
+  row2=pad+(nz+k)*(psx*psy)+((ny+j)*psx)+nx;
+  for(i=0;i<=2*f;i++)
+  {
+    d=row1[i]-row2[i];
+    distancetotal = distancetotal + d*d;
+  }
+  if(distancetotal/acu>cutoff) return distancetotal/acu;
+ }
+}
+
+d=distancetotal/acu;
+
+return d;
+}
+
 void Regularize(double* in,double * out,int r,int sx,int sy,int sz)
 {
 double acu;
@@ -375,27 +490,28 @@ free(temp);
 return;
 }
 
-void* ThreadFunc( void* pArguments, int rician, double globalMax )
+void FilterChunk(myargument *arg, double *average, int ini, int fin)
 {
-    double *bias,*Estimate,*Label,*ima,*means,*variances,*average,epsilon,mu1,var1,totalweight,wmax,t1,t1i,t2,d,w,distanciaminima;
-    int rows,cols,slices,ini,fin,v,f,init,i,j,k,rc,ii,jj,kk,ni,nj,nk,Ndims;
-        
-    myargument arg;
-    arg=*(myargument *) pArguments;
-
-    rows=arg.rows;    
-    cols=arg.cols;
-    slices=arg.slices;
-    ini=arg.ini;    
-    fin=arg.fin;
-    ima=arg.in_image;    
-    means=arg.means_image;  
-    variances=arg.var_image;     
-    Estimate=arg.estimate;
-    bias=arg.bias;
-    Label=arg.label;    
-    v=arg.radioB;
-    f=arg.radioS;    
+    double *bias,*Estimate,*Label,*ima,*padded,*residual,*means,*variances,epsilon,mu1,var1,totalweight,wmax,t1,t1i,t2,d,w,distanciaminima,globalMax;
+    unsigned char *mask;
+    int rows,cols,slices,v,f,init,i,j,k,rc,ii,jj,kk,ni,nj,nk,Ndims,rician,pcols,prows;
+
+    rows=arg->rows;    
+    cols=arg->cols;
+    slices=arg->slices;
+    ima=arg->in_image;    
+    padded=arg->padded_image;
+    residual=arg->padded_residual;
+    means=arg->means_image;  
+    variances=arg->var_image;     
+    Estimate=arg->estimate;
+    bias=arg->bias;
+    Label=arg->label;    
+    mask=arg->mask;
+    v=arg->radioB;
+    f=arg->radioS;    
+    rician=arg->rician;
+    globalMax=arg->globalMax;
                       
 //filter
 epsilon = 0.00001;
@@ -403,16 +519,22 @@ mu1 = 0.95;
 var1 = 0.5+1e-7;
 init = 0;
 rc=rows*cols;
+pcols=cols+2*f;
+prows=rows+2*f;
 
 Ndims = (2*f+1)*(2*f+1)*(2*f+1);
 
-average=(double*)malloc(Ndims*sizeof(double));
-
-wmax=0.0;
+// the sequential sweep carries wmax from one block to the next one; with 
+// several threads it is carried within each chunk only, so that the result 
+// does not depend on which thread takes which chunk
+if(arg->queue->chunk_wmax) wmax=0.0;
+else wmax=arg->wmax;
 for(k=ini;k<fin;k+=2)
 for(j=0;j<rows;j+=2)
 for(i=0;i<cols;i+=2)
 { 
+  // blocks outside the mask (if any) are not filtered
+  if(mask!=NULL && !mask[k*rc+(j*cols)+i]) continue;
     
   // init  
   for (init=0 ; init < Ndims; init++) average[init]=0.0;	 
@@ -437,7 +559,7 @@ for(i=0;i<cols;i+=2)
 			  if(ni>=0 && nj>=0 && nk>=0 && ni<cols && nj<rows && nk<slices)
 			  {			
                     
-				if (ima[nk*rc+(nj*cols)+ni]>0 && (means[nk*(rc)+(nj*cols)+ni])> epsilon && (variances[nk*rc+(nj*cols)+ni]>epsilon))
+				if (ima[nk*rc+(nj*cols)+ni]>0 && (means[nk*(rc)+(nj*cols)+ni])> epsilon && (variances[nk*rc+(nj*cols)+ni]>epsilon) && (mask==NULL || mask[nk*rc+(nj*cols)+ni]))
 				{				
                         
 				  t1 = (means[k*rc+(j*cols)+i])/(means[nk*rc+(nj*cols)+ni]);  
@@ -445,7 +567,7 @@ for(i=0;i<cols;i+=2)
 				  t2 = (variances[k*rc+(j*cols)+i])/(variances[nk*rc+(nj*cols)+ni]);
 				  if( (t1>mu1 && t1<(1/mu1)) || (t1i>mu1 && t1i<(1/mu1)) && t2>var1 && t2<(1/var1))
 				  {   
-					d=distance2(ima,means,i,j,k,ni,nj,nk,f,cols,rows,slices);
+					d=patch_distance(residual,i,j,k,ni,nj,nk,f,pcols,prows,distanciaminima);
                     if(d<distanciaminima) distanciaminima=d;
                   }
                 }
@@ -490,7 +612,7 @@ for(i=0;i<cols;i+=2)
 				
 				if(ni>=0 && nj>=0 && nk>=0 && ni<cols && nj<rows && nk<slices)
 				{									
-					if (ima[nk*rc+(nj*cols)+ni]>0 && (means[nk*(rc)+(nj*cols)+ni])> epsilon && (variances[nk*rc+(nj*cols)+ni]>epsilon))
+					if (ima[nk*rc+(nj*cols)+ni]>0 && (means[nk*(rc)+(nj*cols)+ni])> epsilon && (variances[nk*rc+(nj*cols)+ni]>epsilon) && (mask==NULL || mask[nk*rc+(nj*cols)+ni]))
 					{				
 						t1 = (means[k*rc+(j*cols)+i])/(means[nk*rc+(nj*cols)+ni]);  
                         t1i= (globalMax-means[k*(rc)+(j*cols)+i])/(globalMax-means[nk*(rc)+(nj*cols)+ni]);  
@@ -498,7 +620,7 @@ for(i=0;i<cols;i+=2)
 	
 						if( (t1>mu1 && t1<(1/mu1)) || (t1i>mu1 && t1i<(1/mu1)) && t2>var1 && t2<(1/var1))
 						{                 										
-							d=distance(ima,i,j,k,ni,nj,nk,f,cols,rows,slices);
+							d=patch_distance(padded,i,j,k,ni,nj,nk,f,pcols,prows,3*distanciaminima);
                                        
                             if(d>3*distanciaminima) w=0;
                             else w = exp(-d/distanciaminima);      											
@@ -530,17 +652,29 @@ for(i=0;i<cols;i+=2)
  	  Value_block(Estimate,Label,i,j,k,f,average,totalweight,cols,rows,slices);
     }
 }
-	#ifdef _WIN32
-       //_endthreadex(0);    
-    #else
-       //pthread_exit(0);    
-    #endif
+arg->wmax=wmax;
+}
 
-return 0;
+#ifdef _WIN32
+unsigned __stdcall ThreadFunc( void* pArguments )
+#else
+void* ThreadFunc( void* pArguments )
+#endif
+{
+    myargument *arg=(myargument *) pArguments;
+    int f=arg->radioS;
+    int ini,fin;
+    double *average=(double*)malloc((2*f+1)*(2*f+1)*(2*f+1)*sizeof(double));
+    while(next_chunk(arg->queue, &ini, &fin))
+    {
+        FilterChunk(arg, average, ini, fin);
+    }
+    free(average);
+    return 0;
 }
 
 
-void mabonlm3d_c(double *ima, int *dims, int v, int f, int r, double *fima)
+void mabonlm3d_c(double *ima, int *dims, int v, int f, int r, double *fima, int Nthreads, unsigned char *mask)
 {
 /*Declarations*/
 //mxArray *xData;
@@ -552,7 +686,8 @@ double  *bias=0;
 //double SNR,h,mean,var,label,estimate;
 double SNR,mean,var,label,estimate,globalMax;
 //int Ndims,i,j,k,ii,jj,kk,ni,nj,nk,v,f,ndim,indice,Nthreads,ini,fin,r;
-int i,j,k,ii,jj,kk,ni,nj,nk,indice,Nthreads,ini,fin;
+int i,j,k,ii,jj,kk,ni,nj,nk,indice,nchunks,phase;
+workqueue queue;
 //const int  *dims;
 
 //----------allocate memory-------
@@ -707,83 +842,104 @@ for(k=0;k<dims[2];k++)
 	}
 }
 
-Nthreads = 1;
-
+/* the patch distances read the mirrored image (and residual) without 
+   bounds checks */
+double *padded=Mirror_pad(ima,NULL,f,dims[0],dims[1],dims[2]);
+double *residual=Mirror_pad(ima,means,f,dims[0],dims[1],dims[2]);
+
+if(Nthreads<1) Nthreads=1;
+
+/* The (stride 2) block grid is split into chunks of 'chunk' slices, taken
+   by the threads from a shared queue as they become idle. A block centered 
+   at slice k writes the slices k-f..k+f, so chunks at least 2f slices thick
+   that are not adjacent never write the same voxels: the even chunks are 
+   filtered first, then the odd ones, so the result is the same for any 
+   number of threads. A single thread takes all the chunks in order, which is
+   the sequential sweep. */
+queue.chunk=2*f;
+if(queue.chunk<2) queue.chunk=2;
+queue.slices=dims[2];
+nchunks=(dims[2]+queue.chunk-1)/queue.chunk;
+if(Nthreads>(nchunks+1)/2) Nthreads=(nchunks+1)/2;
+if(Nthreads<1) Nthreads=1;
 #ifdef _WIN32
-
-// Reserve room for handles of threads in ThreadList
+InitializeCriticalSection(&queue.lock);
 ThreadList = (HANDLE*)malloc(Nthreads* sizeof( HANDLE ));
-ThreadArgs = (myargument*) malloc( Nthreads*sizeof(myargument));
-
-for (i=0; i<Nthreads; i++)
-{         
-	// Make Thread Structure   
-    ini=(i*dims[2])/Nthreads;
-    fin=((i+1)*dims[2])/Nthreads;            
-   	ThreadArgs[i].cols=dims[0];
-    ThreadArgs[i].rows=dims[1];
-   	ThreadArgs[i].slices=dims[2];
-    ThreadArgs[i].in_image=ima;	
-  	ThreadArgs[i].var_image=variances;
-    ThreadArgs[i].means_image=means;  
-    ThreadArgs[i].estimate=Estimate;
-    ThreadArgs[i].bias=bias;    
-    ThreadArgs[i].label=Label;    
-    ThreadArgs[i].ini=ini;
-    ThreadArgs[i].fin=fin;
-    ThreadArgs[i].radioB=v;
-    ThreadArgs[i].radioS=f;  
-    	
-    //ThreadList[i] = (HANDLE)_beginthreadex( NULL, 0, &ThreadFunc, &ThreadArgs[i] , 0, NULL );
-        
-}
-ThreadFunc(&ThreadArgs[0], r, globalMax);
-//for (i=0; i<Nthreads; i++) { WaitForSingleObject(ThreadList[i], INFINITE); }
-//for (i=0; i<Nthreads; i++) { CloseHandle( ThreadList[i] ); }
-
 #else
-
-/* Reserve room for handles of threads in ThreadList*/
+pthread_mutex_init(&queue.lock, NULL);
 ThreadList = (pthread_t *) calloc(Nthreads,sizeof(pthread_t));
+#endif
 ThreadArgs = (myargument*) calloc( Nthreads,sizeof(myargument));
 
 for (i=0; i<Nthreads; i++)
 {         
 	// Make Thread Structure   
-    ini=(i*dims[2])/Nthreads;
-    fin=((i+1)*dims[2])/Nthreads;            
    	ThreadArgs[i].cols=dims[0];
     ThreadArgs[i].rows=dims[1];
    	ThreadArgs[i].slices=dims[2];
     ThreadArgs[i].in_image=ima;	
+    ThreadArgs[i].padded_image=padded;
+    ThreadArgs[i].padded_residual=residual;
   	ThreadArgs[i].var_image=variances;
     ThreadArgs[i].means_image=means;  
     ThreadArgs[i].estimate=Estimate;
     ThreadArgs[i].bias=bias;    
     ThreadArgs[i].label=Label;    
-    ThreadArgs[i].ini=ini;
-    ThreadArgs[i].fin=fin;
+    ThreadArgs[i].mask=mask;
+    ThreadArgs[i].queue=&queue;
     ThreadArgs[i].radioB=v;
     ThreadArgs[i].radioS=f;      	        
+    ThreadArgs[i].rician=r;
+    ThreadArgs[i].globalMax=globalMax;
+    ThreadArgs[i].wmax=0.0;
 }
-ThreadFunc(&ThreadArgs[0], r, globalMax);
-/*for (i=0; i<Nthreads; i++)
+
+if(Nthreads==1)
 {
-    if(pthread_create(&ThreadList[i], NULL, ThreadFunc,&ThreadArgs[i]))
-    {
-       //printf("Threads cannot be created\n");
-       exit(1);
-    }        
+    queue.next=0;
+    queue.end=nchunks;
+    queue.step=1;
+    queue.chunk_wmax=0;
+    ThreadFunc(&ThreadArgs[0]);
 }
-   
-for (i=0; i<Nthreads; i++)
+else for(phase=0; phase<2; phase++)
 {
-  pthread_join(ThreadList[i],NULL);
-}*/
+    queue.next=phase;
+    queue.end=nchunks;
+    queue.step=2;
+    queue.chunk_wmax=1;
+#ifdef _WIN32
+    for (i=0; i<Nthreads; i++)
+    {
+        ThreadList[i] = (HANDLE)_beginthreadex( NULL, 0, &ThreadFunc, &ThreadArgs[i] , 0, NULL );
+    }
+    for (i=0; i<Nthreads; i++) { WaitForSingleObject(ThreadList[i], INFINITE); }
+    for (i=0; i<Nthreads; i++) { CloseHandle( ThreadList[i] ); }
+#else
+    for (i=0; i<Nthreads; i++)
+    {
+        if(pthread_create(&ThreadList[i], NULL, ThreadFunc,&ThreadArgs[i]))
+        {
+           printf("Threads cannot be created\n");
+           exit(1);
+        }        
+    }
+    for (i=0; i<Nthreads; i++)
+    {
+      pthread_join(ThreadList[i],NULL);
+    }
+#endif
+}
 
+#ifdef _WIN32
+DeleteCriticalSection(&queue.lock);
+#else
+pthread_mutex_destroy(&queue.lock);
 #endif
 free(ThreadArgs); 
 free(ThreadList);
+free(padded);
+free(residual);
 if(r)
 {
   r=5;
@@ -1,5 +1,7 @@
-void mabonlm3d_c(double *ima, int *dims, int v, int f, int r, double *fima);
+void mabonlm3d_c(double *ima, int *dims, int v, int f, int r, double *fima, int Nthreads, unsigned char *mask);
 void Average_block(double *ima,int x,int y,int z,int neighborhoodsize,double *average, double weight, int sx,int sy,int sz, int rician);
 void Value_block(double *Estimate, double *Label,int x,int y,int z,int neighborhoodsize,double *average, double global_sum, int sx,int sy,int sz);
 double distance(double* ima,int x,int y,int z,int nx,int ny,int nz,int f,int sx,int sy,int sz);
-double distance2(double* ima,double * medias,int x,int y,int z,int nx,int ny,int nz,int f,int sx,int sy,int sz);
\ No newline at end of file
+double distance2(double* ima,double * medias,int x,int y,int z,int nx,int ny,int nz,int f,int sx,int sy,int sz);
+double *Mirror_pad(double *ima, double *medias, int f, int sx, int sy, int sz);
+double patch_distance(double *pad,int x,int y,int z,int nx,int ny,int nz,int f,int psx,int psy,double cutoff);
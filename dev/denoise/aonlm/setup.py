@@ -7,7 +7,8 @@ setup(
     ext_modules=[Extension(
                             "aonlm", ["aonlm.pyx","mabonlm3d.cpp"],
                             include_dirs=get_numpy_include_dirs(), 
-                            extra_compile_args=["-msse2 -mfpmath=sse"],
+                            extra_compile_args=["-msse2 -mfpmath=sse", "-pthread"],
+                            extra_link_args=["-pthread"],
                             language="c++"
                             )]
 )
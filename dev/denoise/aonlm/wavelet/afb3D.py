@@ -1,40 +1,13 @@
-from aonlm import firdn
-import numpy as np
-from cshift3D import cshift3D
-def permutationInverse(perm):
-    inverse = [0] * len(perm)
-    for i, p in enumerate(perm):
-        inverse[p] = i
-    return inverse
+import os
+import sys
+# the filter bank is shared by the wavelet modules of ornlm and aonlm
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+from filterbank import afb_axis
 
 def afb3D_A(x, af, d):
-    lpf=af[:, 0]
-    hpf=af[:, 1]
-    # permute dimensions of x so that dimension d is first.
-    p=[(i+d)%3 for i in xrange(3)]
-    x=x.transpose(p)
-    # filter along dimension 0
-    (N1, N2, N3)=x.shape
-    L=af.shape[0]//2
-    x=cshift3D(x, -L, 0);
-    n1Half=N1//2
-    lo=np.zeros((L+n1Half, N2, N3));
-    hi=np.zeros((L+n1Half, N2, N3));
-    for k in xrange(N3):
-        lo[:, :, k]=firdn(x[:, :, k], lpf);
-    lo[:L]=lo[:L]+lo[n1Half:n1Half+L, :, :];
-    lo=lo[:n1Half, :, :];
-    
-    for k in xrange(N3):
-        hi[:, :, k]=firdn(x[:, :, k], hpf);
-    hi[:L]=hi[:L]+hi[n1Half:n1Half+L, :, :];
-    hi=hi[:n1Half, :, :];
-    #permute dimensions of x (inverse permutation)
-    q=permutationInverse(p)
-    lo=lo.transpose(q)
-    hi=hi.transpose(q)
-    return lo, hi
-
+    # filter along dimension d (see filterbank.afb_axis)
+    return afb_axis(x, af, d)
 
 
 def afb3D(x, af1, af2=None, af3=None):
@@ -1,7 +1,16 @@
+import numpy as np
 from afb3D import afb3D
 def dwt3D(x, J, af):
+    # the periodic filter bank needs sizes that are multiples of 2**J: other
+    # sizes are extended symmetrically at the end of each dimension (the 
+    # reconstruction is cropped back by idwt3D's 'shape' argument)
+    x=np.asarray(x)
+    m=2**J
+    pad=[(0, (-n)%m) for n in x.shape]
+    if any(p[1] for p in pad):
+        x=np.pad(x, pad, mode='symmetric')
     w=[None]*(J+1)
     for k in xrange(J):
         x, w[k] = afb3D(x, af, af, af);
     w[J] = x;
-    return w
\ No newline at end of file
+    return w
@@ -0,0 +1,104 @@
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+from .noise import estimate_sigma
+
+__all__ = ['denoise_4d']
+
+# Shared buffers and filter parameters, set in each worker by _init_worker
+_worker_state = {}
+
+
+def _get_filter(method):
+    if method == 'ornlm':
+        from .ornlm.ornlm import ornlm
+        return ornlm
+    elif method == 'aonlm':
+        from .aonlm.aonlm import aonlm
+        return aonlm
+    raise ValueError("Unknown denoising method '%s' (expected 'ornlm' or "
+                     "'aonlm')" % method)
+
+
+def _shared_volumes(buf, shape):
+    return np.frombuffer(buf, dtype=np.float64).reshape(shape)
+
+
+def _init_worker(in_buf, out_buf, shape, method, args):
+    _worker_state['input'] = _shared_volumes(in_buf, shape)
+    _worker_state['output'] = _shared_volumes(out_buf, shape)
+    _worker_state['filter'] = _get_filter(method)
+    _worker_state['args'] = args
+
+
+def _filter_volume(i):
+    state = _worker_state
+    state['output'][i] = state['filter'](state['input'][i], *state['args'])
+    return i
+
+
+def denoise_4d(data, method='ornlm', v=3, f=1, h=None, rician=1,
+               processes=None, progress=None, mask=None):
+    '''
+    Filters each 3D volume of the given 4D image (e.g. one per diffusion
+    direction) with ornlm or aonlm. The volumes are scheduled on a pool of
+    processes which read their input from, and write their result to, shared
+    memory buffers, so no volume is copied between processes. Returns the
+    filtered 4D image.
+    Parameters
+    ----------
+        data: 4D array, the volumes are indexed by the last dimension
+        method: 'ornlm' or 'aonlm'
+        v:  radius of the search window (see ornlm/aonlm)
+        f:  radius of the blocks (see ornlm/aonlm)
+        h:  the estimated amount of rician noise (only used by ornlm). If
+            None, the median of the estimates of the volumes is used (see
+            noise.estimate_sigma)
+        rician: if 1, aonlm applies the rician bias correction (only used by
+            aonlm)
+        processes: number of worker processes. None uses all the available
+            cores, 1 filters the volumes sequentially in this process
+        progress: optional callable progress(index, ndone, nvolumes), called
+            each time the volume 'index' has been filtered
+        mask: optional 3D foreground mask or bounding box, shared by all the
+            volumes (see ornlm/aonlm)
+    '''
+    if data.ndim != 4:
+        raise ValueError('Expected a 4D image, got %dD' % data.ndim)
+    if method == 'ornlm':
+        if h is None:
+            h = np.median(estimate_sigma(data))
+        args = (v, f, float(h), 1, mask)
+    else:
+        args = (v, f, rician, 1, mask)
+    nvolumes = data.shape[3]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, nvolumes))
+    # volumes are stored contiguously (first index) in the shared buffers
+    shape = (nvolumes,) + data.shape[:3]
+    nvox = int(np.prod(shape))
+    in_buf = RawArray('d', nvox)
+    out_buf = RawArray('d', nvox)
+    _shared_volumes(in_buf, shape)[...] = np.rollaxis(np.asarray(data), 3)
+    if processes == 1:
+        _init_worker(in_buf, out_buf, shape, method, args)
+        done = (_filter_volume(i) for i in range(nvolumes))
+        pool = None
+    else:
+        _get_filter(method)  # fail early if the extension is not available
+        pool = multiprocessing.Pool(processes, _init_worker,
+                                    (in_buf, out_buf, shape, method, args))
+        done = pool.imap_unordered(_filter_volume, range(nvolumes))
+    try:
+        for ndone, i in enumerate(done):
+            if progress is not None:
+                progress(i, ndone+1, nvolumes)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    _worker_state.clear()
+    return np.rollaxis(_shared_volumes(out_buf, shape), 0, 4)
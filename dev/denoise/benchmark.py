@@ -0,0 +1,397 @@
+'''
+Offline benchmark of the denoising filters (ornlm, aonlm and the subband
+mixings hsm, ascm and mixingsubband) on synthetic phantoms corrupted with
+rician noise, at several sizes (3D, and 4D filtered volume by volume). For
+each filter and phantom it records the running time, the peak memory and the
+PSNR of the filtered image against the clean phantom, and writes them to a
+JSON file, which can be compared with the file of a previous version to find
+regressions.
+Each case runs in its own process: the peak memory of one case is not hidden
+by the previous ones, and the ornlm and aonlm wavelet modules (both named
+'wavelet') are never imported together. The phantoms are generated in another
+process and written to temporary files, which the cases load: the temporaries
+of the generation of the phantom do not raise the peak memory of the case.
+
+Usage: python benchmark.py [-s 64,128,256] [-v 8] [-f ornlm,aonlm]
+                           [-n 10] [-o results.json] [-r reference.json]
+'''
+import datetime
+import getopt
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on windows, the memory is not measured
+    resource = None
+
+__all__ = ['rician_phantom', 'save_phantom', 'psnr', 'run_case',
+           'run_benchmark', 'compare_results', 'FILTERS']
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def rician_phantom(shape, sigma, seed=0):
+    '''
+    Returns (clean, noisy): a synthetic phantom and its version corrupted
+    with rician noise, sqrt((clean+x)^2+y^2) with x, y gaussian of standard
+    deviation sigma. The phantom is an ellipsoid (intensity 100) containing
+    a smaller one (150) and small spheres (200) along its axis, so the
+    filters see both large homogeneous regions and structures of a few
+    voxels. A 4D shape gives volumes of decreasing intensity (as the
+    diffusion weighted volumes of a DWI), volume i being scaled by
+    exp(-0.1*i).
+    Parameters
+    ----------
+        shape: 3D or 4D shape of the phantom
+        sigma: standard deviation of the gaussian noise
+        seed: seed of the random generator of the noise
+    '''
+    if len(shape) not in (3, 4):
+        raise ValueError('Expected a 3D or 4D shape, got %dD' % len(shape))
+    grid = np.ogrid[tuple(slice(0, n) for n in shape[:3])]
+    # coordinates relative to the center, in units of the half sizes
+    x, y, z = [(g-(n-1)/2.0)/(n/2.0) for g, n in zip(grid, shape[:3])]
+    clean = np.zeros(shape[:3])
+    clean[(x/0.8)**2+(y/0.7)**2+(z/0.9)**2 <= 1] = 100
+    clean[(x/0.4)**2+(y/0.3)**2+(z/0.5)**2 <= 1] = 150
+    radius = 3.0/min(shape[:3])
+    for center in (-0.6, -0.3, 0.3, 0.6):
+        clean[(x*x+y*y+(z-center)**2) <= radius**2] = 200
+    if len(shape) == 4:
+        clean = clean[..., None]*np.exp(-0.1*np.arange(shape[3]))
+    rng = np.random.RandomState(seed)
+    real = clean+rng.normal(0, sigma, clean.shape)
+    imaginary = rng.normal(0, sigma, clean.shape)
+    noisy = np.sqrt(real*real+imaginary*imaginary)
+    return clean, noisy
+
+
+def save_phantom(shape, sigma, seed, folder):
+    '''
+    Writes the phantom (see rician_phantom) to 'folder', as clean.npy and
+    noisy.npy, and returns the pair of file names. The volumes of a 4D
+    phantom are stored one after the other (volume index first), so that
+    each of them can be filtered without a copy.
+    '''
+    clean, noisy = rician_phantom(shape, sigma, seed)
+    if noisy.ndim == 4:
+        clean = clean.transpose(3, 0, 1, 2)
+        noisy = noisy.transpose(3, 0, 1, 2)
+    phantom = (os.path.join(folder, 'clean.npy'),
+               os.path.join(folder, 'noisy.npy'))
+    np.save(phantom[0], np.ascontiguousarray(clean))
+    np.save(phantom[1], np.ascontiguousarray(noisy))
+    return phantom
+
+
+def _in_new_process(function, args):
+    # runs function(*args) in a fresh process and returns its result
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(function, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def psnr(clean, image):
+    '''
+    Peak signal to noise ratio (dB) of 'image' with respect to 'clean',
+    using the maximum of 'clean' as the peak.
+    '''
+    clean = np.asarray(clean, dtype=np.float64)
+    mse = np.mean((np.asarray(image, dtype=np.float64)-clean)**2)
+    if mse == 0:
+        return float('inf')
+    return float(10*np.log10(clean.max()**2/mse))
+
+
+def _import_from(subdir):
+    # the filters are imported as the examples do, from their own directory
+    path = os.path.join(_HERE, subdir)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def _ornlm(noisy, sigma):
+    _import_from('ornlm')
+    from ornlm import ornlm
+    return ornlm(noisy, 3, 1, sigma)
+
+
+def _aonlm(noisy, sigma):
+    _import_from('aonlm')
+    from aonlm import aonlm
+    return aonlm(noisy, 3, 1, 1)
+
+
+def _hsm(noisy, sigma):
+    _import_from('ornlm')
+    from ornlm import ornlm_pair
+    from hsm import hsm
+    fimau, fimao = ornlm_pair(noisy, 3, sigma, 1, 2)
+    return hsm(np.asarray(fimau), np.asarray(fimao))
+
+
+def _ascm(noisy, sigma):
+    _import_from('ornlm')
+    from ornlm import ornlm_pair
+    from ascm import ascm
+    fimau, fimao = ornlm_pair(noisy, 3, sigma, 1, 2)
+    return ascm(noisy, np.asarray(fimau), np.asarray(fimao), sigma)
+
+
+def _mixingsubband(noisy, sigma):
+    _import_from('aonlm')
+    from aonlm import aonlm
+    from mixingsubband import mixingsubband
+    fimau = np.asarray(aonlm(noisy, 3, 1, 1))
+    fimao = np.asarray(aonlm(noisy, 3, 2, 1))
+    return mixingsubband(fimau, fimao)
+
+
+# filter name -> function(noisy 3D volume, sigma) returning the filtered
+# volume. The mixings include the two filterings they combine
+FILTERS = {'ornlm': _ornlm,
+           'aonlm': _aonlm,
+           'hsm': _hsm,
+           'ascm': _ascm,
+           'mixingsubband': _mixingsubband}
+
+
+def _max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac os
+    if sys.platform == 'darwin':
+        return rss/2.0**20
+    return rss/2.0**10
+
+
+def run_case(name, shape, sigma=10.0, seed=0, repeats=1, phantom=None):
+    '''
+    Runs one case of the benchmark in the current process and returns its
+    record: a dictionary with the filter name, the phantom shape and noise,
+    the running time (seconds, the best of 'repeats' runs), the peak memory
+    used by the filter (peak_mb: growth of the peak resident memory of the
+    process above the loaded phantom, None if it cannot be measured), and
+    the PSNR of the noisy and filtered images. 4D phantoms are filtered
+    volume by volume.
+    Parameters
+    ----------
+        phantom: the (clean, noisy) files of the phantom (see save_phantom).
+            If None, the phantom is generated in another process and written
+            to a temporary folder
+    '''
+    if name not in FILTERS:
+        raise ValueError("Unknown filter '%s' (expected one of %s)"
+                         % (name, ', '.join(sorted(FILTERS))))
+    shape = tuple(int(n) for n in shape)
+    if phantom is None:
+        folder = tempfile.mkdtemp()
+        try:
+            phantom = _in_new_process(save_phantom,
+                                      (shape, sigma, seed, folder))
+            return run_case(name, shape, sigma, seed, repeats, phantom)
+        finally:
+            shutil.rmtree(folder)
+    function = FILTERS[name]
+    # first call outside the measures: imports the extension modules
+    function(rician_phantom((8, 8, 8), sigma, seed)[1], sigma)
+    # the baseline is taken before loading the phantom, whose size is then
+    # subtracted from the peak
+    rss_before = _max_rss_mb()
+    noisy = np.load(phantom[1])
+    volumes = [noisy] if noisy.ndim == 3 else list(noisy)
+    seconds = None
+    filtered = None
+    for r in range(repeats):
+        # the result of the previous run does not count in the peak
+        filtered = None
+        start = time.time()
+        filtered = [np.asarray(function(volume, sigma)) for volume in volumes]
+        elapsed = time.time()-start
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+    rss_after = _max_rss_mb()
+    filtered = filtered[0] if noisy.ndim == 3 else np.stack(filtered)
+    peak_mb = None
+    if rss_before is not None:
+        peak_mb = max(0.0, rss_after-rss_before-noisy.nbytes/2.0**20)
+    clean = np.load(phantom[0])
+    return {'filter': name,
+            'shape': list(shape),
+            'sigma': sigma,
+            'seed': seed,
+            'seconds': seconds,
+            'peak_mb': peak_mb,
+            'input_mb': noisy.nbytes/2.0**20,
+            'psnr_noisy': psnr(clean, noisy),
+            'psnr': psnr(clean, filtered)}
+
+
+def run_benchmark(sizes=(64, 128, 256), volumes=8, filters=None,
+                  sigma=10.0, seed=0, repeats=1, out_file=None,
+                  progress=None):
+    '''
+    Runs every filter on cubic phantoms of the given sizes, and on a 4D
+    phantom of the smallest size with the given number of volumes. Each
+    case runs in a new process (see run_case). Returns the results, a
+    dictionary with the description of the machine ('meta') and the list
+    of records ('results'), also written to out_file (JSON) if given.
+    Parameters
+    ----------
+        sizes: sides of the 3D phantoms
+        volumes: number of volumes of the 4D phantom, 0 to skip it
+        filters: names of the filters (keys of FILTERS), all if None
+        sigma: standard deviation of the noise
+        seed: seed of the random generator of the noise
+        repeats: number of runs of each case, the best time is kept
+        out_file: optional JSON file receiving the results
+        progress: optional callable progress(record), called after each case
+    '''
+    if filters is None:
+        filters = sorted(FILTERS)
+    shapes = [(n, n, n) for n in sizes]
+    if volumes > 0:
+        shapes.append((min(sizes),)*3+(volumes,))
+    records = []
+    for shape in shapes:
+        folder = tempfile.mkdtemp()
+        try:
+            phantom = _in_new_process(save_phantom,
+                                      (shape, sigma, seed, folder))
+            for name in filters:
+                # a fresh process for each case (see the module docstring)
+                record = _in_new_process(
+                    run_case, (name, shape, sigma, seed, repeats, phantom))
+                records.append(record)
+                if progress is not None:
+                    progress(record)
+        finally:
+            shutil.rmtree(folder)
+    results = {'meta': {'date': datetime.datetime.now().isoformat(),
+                        'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'platform': platform.platform(),
+                        'processor': platform.processor(),
+                        'cpu_count': multiprocessing.cpu_count()},
+               'results': records}
+    if out_file is not None:
+        with open(out_file, 'w') as fobj:
+            json.dump(results, fobj, indent=1)
+    return results
+
+
+def compare_results(reference, results, time_tolerance=0.2,
+                    psnr_tolerance=0.1):
+    '''
+    Compares benchmark results with those of a reference version. Returns
+    the list of regressions, as (filter, shape, quantity, reference value,
+    new value) tuples: the cases more than time_tolerance (fraction) slower
+    or with a PSNR more than psnr_tolerance (dB) lower. Cases missing from
+    either side are ignored.
+    Parameters
+    ----------
+        reference: results of the reference version (see run_benchmark),
+            or the name of their JSON file
+        results: results of the new version, or the name of their JSON file
+    '''
+    def load(x):
+        if isinstance(x, dict):
+            return x
+        with open(x) as fobj:
+            return json.load(fobj)
+    key = lambda record: (record['filter'], tuple(record['shape']))
+    previous = dict((key(record), record)
+                    for record in load(reference)['results'])
+    regressions = []
+    for record in load(results)['results']:
+        old = previous.get(key(record))
+        if old is None:
+            continue
+        if record['seconds'] > old['seconds']*(1+time_tolerance):
+            regressions.append(key(record)+('seconds', old['seconds'],
+                                            record['seconds']))
+        if record['psnr'] < old['psnr']-psnr_tolerance:
+            regressions.append(key(record)+('psnr', old['psnr'],
+                                            record['psnr']))
+    return regressions
+
+
+def usage():
+    print(__doc__)
+    print('''Options:
+  -s  sides of the 3D phantoms, comma separated (default 64,128,256)
+  -v  number of volumes of the 4D phantom, 0 to skip it (default 8)
+  -f  filters, comma separated (default all: %s)
+  -n  standard deviation of the noise (default 10)
+  -t  number of runs of each case, the best time is kept (default 1)
+  -o  output JSON file (default benchmark_results.json)
+  -r  reference JSON file of a previous version, to report the regressions
+  -h  this help''' % ','.join(sorted(FILTERS)))
+
+
+def main(argv):
+    sizes = (64, 128, 256)
+    volumes = 8
+    filters = None
+    sigma = 10.0
+    repeats = 1
+    out_file = 'benchmark_results.json'
+    reference = None
+    try:
+        opts, args = getopt.getopt(argv, 'hs:v:f:n:t:o:r:')
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        return 2
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            return 0
+        elif opt == '-s':
+            sizes = [int(n) for n in arg.split(',')]
+        elif opt == '-v':
+            volumes = int(arg)
+        elif opt == '-f':
+            filters = arg.split(',')
+        elif opt == '-n':
+            sigma = float(arg)
+        elif opt == '-t':
+            repeats = int(arg)
+        elif opt == '-o':
+            out_file = arg
+        elif opt == '-r':
+            reference = arg
+
+    def report(record):
+        peak = record['peak_mb']
+        print('%-14s %-18s %9.2f s  %9s MB  PSNR %6.2f -> %6.2f dB' % (
+            record['filter'], 'x'.join(str(n) for n in record['shape']),
+            record['seconds'], '-' if peak is None else '%.1f' % peak,
+            record['psnr_noisy'], record['psnr']))
+    results = run_benchmark(sizes, volumes, filters, sigma, 0, repeats,
+                            out_file, report)
+    print('Results written to %s' % out_file)
+    if reference is not None:
+        regressions = compare_results(reference, results)
+        for name, shape, quantity, old, new in regressions:
+            print('REGRESSION %s %s: %s %.4g -> %.4g' % (
+                name, 'x'.join(str(n) for n in shape), quantity, old, new))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
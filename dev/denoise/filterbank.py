@@ -0,0 +1,148 @@
+'''
+Analysis and synthesis filter banks of the separable 3D wavelet transforms
+(dwt3D/idwt3D) used by the subband mixing of the ornlm and aonlm filters.
+Each function filters whole 3D arrays along one axis with strided slices: it
+produces the same values as the columnwise firdn/upfir of the extension
+modules (same operations in the same order), without looping over the slices
+and without transposing or circularly shifting copies of the input.
+float32 inputs are filtered in single precision, any other input in double
+precision.
+'''
+import numpy as np
+
+__all__ = ['farras_af', 'firdn_axis', 'upfir_axis', 'afb_axis', 'sfb_axis']
+
+# Farras nearly symmetric analysis filters (lowpass in column 0, highpass in
+# column 1), used by the subband mixing and the noise estimation. Both columns
+# have unit norm, the synthesis filters are af[::-1, :]
+farras_af = np.array([[0, -0.01122679215254],
+                      [0, 0.01122679215254],
+                      [-0.08838834764832, 0.08838834764832],
+                      [0.08838834764832, 0.08838834764832],
+                      [0.69587998903400, -0.69587998903400],
+                      [0.69587998903400, 0.69587998903400],
+                      [0.08838834764832, -0.08838834764832],
+                      [-0.08838834764832, -0.08838834764832],
+                      [0.01122679215254, 0],
+                      [0.01122679215254, 0]])
+
+
+def _filter_dtype(x):
+    if x.dtype == np.float32:
+        return np.float32
+    return np.float64
+
+
+def _circular_pieces(n, k0, count, shift):
+    '''
+    Splits the indices k0, k0+2, ..., k0+2*(count-1) of an axis of length n
+    circularly shifted left by 'shift' into (at most two) runs of the
+    unshifted axis. Returns a list of (offset, slice): the elements offset,
+    offset+1, ... of the sequence are read from the given slice.
+    '''
+    s = shift % n
+    count_a = min(count, max(0, (n-s-k0+1)//2))
+    pieces = []
+    if count_a > 0:
+        start = k0+s
+        pieces.append((0, slice(start, start+2*(count_a-1)+1, 2)))
+    if count > count_a:
+        start = k0+2*count_a+s-n
+        pieces.append((count_a, slice(start, start+2*(count-count_a-1)+1, 2)))
+    return pieces
+
+
+def firdn_axis(x, h, axis, shift=0):
+    '''
+    Applies the convolution kernel 'h' to 'x' along the given axis, then
+    subsamples by 2, as firdn does columnwise. If 'shift' is given, the axis
+    is first circularly shifted left by 'shift' samples (same as
+    cshift3D(x, -shift, axis)). Returns the filtered array, of length
+    (n+len(h))//2 along the axis.
+    '''
+    xa = np.moveaxis(x, axis, 0)
+    n = xa.shape[0]
+    dtype = _filter_dtype(xa)
+    h = h.astype(dtype)
+    klen = h.shape[0]
+    out_len = (n+klen)//2
+    out = np.zeros((out_len,)+xa.shape[1:], dtype=dtype)
+    # out[o] = sum_k x[k]*h[2*o-k] accumulated by increasing k, i.e. by
+    # decreasing tap t=2*o-k
+    for t in range(klen-1, -1, -1):
+        omin = (t+1)//2
+        omax = min(out_len-1, (n-1+t)//2)
+        if omax < omin:
+            continue
+        for offset, sl in _circular_pieces(n, 2*omin-t, omax-omin+1, shift):
+            o = omin+offset
+            src = xa[sl]
+            out[o:o+src.shape[0]] += h[t]*src
+    return np.moveaxis(out, 0, axis)
+
+
+def upfir_axis(x, h, axis):
+    '''
+    Upsamples 'x' by 2 along the given axis, then applies the convolution
+    kernel 'h' along that axis, as upfir does columnwise. Returns the filtered
+    array, of length 2*n+len(h)-2 along the axis.
+    '''
+    xa = np.moveaxis(x, axis, 0)
+    n = xa.shape[0]
+    dtype = _filter_dtype(xa)
+    h = h.astype(dtype)
+    klen = h.shape[0]
+    out = np.zeros((2*n+klen-2,)+xa.shape[1:], dtype=dtype)
+    # out[2*m+t] = sum_m x[m]*h[t] accumulated by increasing m, i.e. by
+    # decreasing tap t
+    for t in range(klen-1, -1, -1):
+        out[t:t+2*n-1:2] += h[t]*xa
+    return np.moveaxis(out, 0, axis)
+
+
+def afb_axis(x, af, axis):
+    '''
+    Analysis filter bank along one axis (see afb3D_A): returns the low-pass
+    and high-pass subbands of 'x', periodically extended, each with half the
+    length of 'x' along the axis.
+    Parameters
+    ----------
+        x:  the 3D array to be filtered, even length along 'axis'
+        af: analysis filters, lowpass in column 0 and highpass in column 1
+        axis: the axis to be filtered
+    '''
+    n_half = x.shape[axis]//2
+    L = af.shape[0]//2
+    subbands = []
+    for column in range(2):
+        y = firdn_axis(x, af[:, column], axis, L)
+        ya = np.moveaxis(y, axis, 0)
+        ya[:L] = ya[:L]+ya[n_half:n_half+L]
+        subbands.append(np.moveaxis(ya[:n_half], 0, axis))
+    return subbands[0], subbands[1]
+
+
+def sfb_axis(lo, hi, sf, axis):
+    '''
+    Synthesis filter bank along one axis (see sfb3D_A): returns the array
+    reconstructed from its low-pass and high-pass subbands, twice as long as
+    the subbands along the axis.
+    Parameters
+    ----------
+        lo: low-pass subband
+        hi: high-pass subband
+        sf: synthesis filters, lowpass in column 0 and highpass in column 1
+        axis: the axis to be filtered
+    '''
+    N = 2*lo.shape[axis]
+    L = sf.shape[0]
+    y = upfir_axis(lo, sf[:, 0], axis)
+    y += upfir_axis(hi, sf[:, 1], axis)
+    ya = np.moveaxis(y, axis, 0)
+    ya[:(L-2)] = ya[:(L-2)]+ya[N:(N+L-2)]
+    # circular shift by 1-L/2 (same as cshift3D(y, 1-L/2, axis))
+    s = (L//2-1) % N
+    out = np.empty((N,)+ya.shape[1:], dtype=ya.dtype)
+    out[:N-s] = ya[s:N]
+    out[N-s:] = ya[:s]
+    return np.moveaxis(out, 0, axis)
@@ -0,0 +1,93 @@
+'''
+Restriction of the blockwise non-local means filters (ornlm, aonlm) to a
+foreground region, e.g. the spinal cord segmentation. The image is cropped to
+the bounding box of the blocks that touch the foreground, the filters only
+visit those blocks (as centers of the block grid and as candidates of the
+search windows) and the voxels outside the foreground are returned unchanged.
+'''
+import numpy as np
+
+__all__ = ['foreground_mask', 'crop_to_foreground', 'paste_foreground']
+
+
+def foreground_mask(mask, shape):
+    '''
+    Returns the boolean foreground mask of an image of the given shape.
+    Parameters
+    ----------
+        mask: 3D array of the same shape as the image (nonzero voxels are
+            foreground) or bounding box given as a sequence of three
+            (start, stop) pairs
+        shape: shape of the image
+    '''
+    if isinstance(mask, (tuple, list)):
+        if len(mask) != 3:
+            raise ValueError('The bounding box must have 3 (start, stop) '
+                             'pairs')
+        box = np.zeros(shape, dtype=bool)
+        box[tuple(slice(start, stop) for start, stop in mask)] = True
+        return box
+    mask = np.asarray(mask)
+    if mask.shape != tuple(shape):
+        raise ValueError('The mask shape %s does not match the image shape '
+                         '%s' % (mask.shape, tuple(shape)))
+    return mask != 0
+
+
+def _dilate(mask, radius):
+    '''
+    Dilates the boolean 3D mask by a cube of side 2*radius+1.
+    '''
+    for axis in range(3):
+        m = np.moveaxis(mask, axis, 0)
+        out = m.copy()
+        for s in range(1, min(radius, m.shape[0]-1)+1):
+            out[s:] |= m[:-s]
+            out[:-s] |= m[s:]
+        mask = np.moveaxis(out, 0, axis)
+    return mask
+
+
+def crop_to_foreground(mask, shape, f):
+    '''
+    Computes the region to be filtered by a blockwise filter with blocks of
+    radius f. Returns (box, search, fg): 'box' is the tuple of slices of the
+    image to be filtered, 'search' the (uint8, C-contiguous) mask of the
+    centers of the blocks that overlap the foreground, inside the box, and
+    'fg' the foreground inside the box. Returns None if the foreground is
+    empty.
+    Parameters
+    ----------
+        mask: foreground mask or bounding box (see foreground_mask)
+        shape: shape of the image
+        f:  radius of the blocks
+    '''
+    fg = foreground_mask(mask, shape)
+    if not fg.any():
+        return None
+    search = _dilate(fg, f)
+    # the blocks read up to f voxels around their centers, the local moments
+    # one voxel. The box starts at even indices to keep the (stride 2) block
+    # grid of the whole image
+    margin = max(f, 1)
+    box = []
+    for axis in range(3):
+        other = tuple(a for a in range(3) if a != axis)
+        nonzero = np.flatnonzero(search.any(axis=other))
+        start = max(0, nonzero[0]-margin)
+        start -= start % 2
+        stop = min(shape[axis], nonzero[-1]+margin+1)
+        box.append(slice(start, stop))
+    box = tuple(box)
+    return box, np.ascontiguousarray(search[box], dtype=np.uint8), fg[box]
+
+
+def paste_foreground(image, filtered, box, fg):
+    '''
+    Returns a copy of 'image' whose foreground voxels (fg, inside the box)
+    are replaced by the filtered ones.
+    '''
+    out = np.array(image, dtype=np.float64)
+    region = out[box]
+    region[fg] = np.asarray(filtered)[fg]
+    return out
@@ -0,0 +1,75 @@
+'''
+Local moments (mean and variance in a cubic neighborhood of each voxel) used
+by the blockwise non-local means filters (ornlm, aonlm) to preselect the
+similar blocks, computed with separable box filters on the whole volume.
+'''
+import numpy as np
+
+__all__ = ['local_moments']
+
+
+def _box_sum(x, radius, mirror):
+    '''
+    Sums the values of 'x' inside a cube of side 2*radius+1 centered at each
+    voxel, by applying a separable box filter (sum of shifted views along each
+    axis). Values beyond the boundaries are either mirrored (same convention
+    as the block distances of the filters) or taken as zero.
+    '''
+    for axis in range(3):
+        acc = x.copy()
+        xa = np.moveaxis(x, axis, 0)
+        aa = np.moveaxis(acc, axis, 0)
+        for o in range(1, radius+1):
+            aa[o:] += xa[:-o]
+            aa[:-o] += xa[o:]
+            if mirror:
+                aa[:o] += xa[o:0:-1]
+                aa[-o:] += xa[-o:][::-1]
+        x = acc
+    return x
+
+
+def _box_count(n, radius, skip_first):
+    '''
+    Returns the number of neighbors inside [0, n) of each index in [0, n),
+    optionally ignoring index 0.
+    '''
+    idx = np.arange(n)
+    cnt = np.minimum(idx+radius, n-1)-np.maximum(idx-radius, 0)+1
+    if skip_first:
+        cnt -= (idx <= radius)
+    return cnt
+
+
+def local_moments(image, radius=1):
+    '''
+    Computes the local mean and variance of 'image' inside a cube of side
+    2*radius+1 centered at each voxel, using separable box filters on the
+    whole volume. Returns the pair (means, variances).
+    The means are computed mirroring the image at its boundaries. As in the
+    reference implementation by P. Coupe et al., the variance with respect to
+    the local mean only uses the neighbors lying inside the volume (the first
+    slice is never used as a neighbor) and is normalized by count-1.
+    Parameters
+    ----------
+        image:  the input 3D image
+        radius: the radius of the cubic neighborhood
+    '''
+    ima = np.asarray(image, dtype=np.float64)
+    n = 2*radius+1
+    means = _box_sum(ima, radius, 1)/float(n*n*n)
+    # sum over the valid neighbors of (x-m)^2 = S2 - 2*m*S1 + cnt*m^2. The
+    # data is centered on its global mean to reduce cancellation errors
+    shift = ima.mean()
+    centered = ima-shift
+    centered[:, :, 0] = 0
+    cnt = (_box_count(ima.shape[0], radius, 0)[:, None, None] *
+           _box_count(ima.shape[1], radius, 0)[None, :, None] *
+           _box_count(ima.shape[2], radius, 1)[None, None, :])
+    s1 = _box_sum(centered, radius, 0)
+    s2 = _box_sum(centered*centered, radius, 0)
+    mu = means-shift
+    variances = s2-2*mu*s1+cnt*mu*mu
+    variances[variances < 0] = 0
+    variances /= (cnt-1)
+    return means, variances
@@ -0,0 +1,153 @@
+'''
+Estimation of the standard deviation of the rician noise of MR images (the
+'h' parameter of ornlm), global or local, from a single 3D volume or from
+each volume of a 4D image.
+The wavelet estimator is the robust median estimator of Donoho applied to the
+finest diagonal subband (HHH) of the 3D wavelet transform, restricted to the
+object, where the rician noise is close to gaussian (P. Coupe et al., Robust
+Rician noise estimation for MR images, Medical Image Analysis, 2010). The
+background estimator uses the second moment of the rayleigh distributed
+background.
+'''
+import warnings
+
+import numpy as np
+
+from filterbank import afb_axis, farras_af
+
+__all__ = ['estimate_sigma', 'estimate_sigma_map']
+
+# median(|x|) of a standard normal variable
+_MAD_SCALE = 0.6745
+
+
+def _wavelet_subbands(volume):
+    '''
+    Returns the LLL and HHH subbands of the one level wavelet transform of
+    the volume (cropped to even sizes). The LLL subband is scaled to the
+    intensity range of the volume.
+    '''
+    x = np.asarray(volume, dtype=np.float64)
+    x = x[:x.shape[0]//2*2, :x.shape[1]//2*2, :x.shape[2]//2*2]
+    lo, hi = afb_axis(x, farras_af, 0)
+    hh = afb_axis(hi, farras_af, 1)[1]
+    ll = afb_axis(lo, farras_af, 1)[0]
+    hhh = afb_axis(hh, farras_af, 2)[1]
+    lll = afb_axis(ll, farras_af, 2)[0]
+    # the lowpass filter sums to sqrt(2)
+    return lll/2**1.5, hhh
+
+
+def _object_coefficients(lll, hhh, snr=3.0, min_count=64):
+    '''
+    Returns the HHH coefficients of the object: those whose local mean (LLL)
+    is above snr times a first estimate over the whole subband. Falls back
+    to the whole subband if the object has less than min_count coefficients.
+    '''
+    sigma0 = np.median(np.abs(hhh))/_MAD_SCALE
+    selected = hhh[lll > snr*sigma0]
+    if selected.size < min_count:
+        return hhh.ravel()
+    return selected
+
+
+def _sigma_wavelet(volume):
+    lll, hhh = _wavelet_subbands(volume)
+    return np.median(np.abs(_object_coefficients(lll, hhh)))/_MAD_SCALE
+
+
+def _sigma_background(volume, background):
+    values = np.asarray(volume, dtype=np.float64)[background]
+    if values.size == 0:
+        raise ValueError('The background mask is empty')
+    # E[M^2]=2*sigma^2 for a rayleigh distributed magnitude M
+    return np.sqrt(np.mean(values*values)/2)
+
+
+def estimate_sigma(data, method='wavelet', background=None):
+    '''
+    Estimates the standard deviation of the gaussian noise underlying the
+    rician noise of the image (the 'h' parameter of ornlm). Returns a float
+    for a 3D image and an array with the estimate of each volume for a 4D
+    image.
+    Parameters
+    ----------
+        data: 3D image or 4D image (volumes indexed by the last dimension)
+        method: 'wavelet' (median absolute value of the HHH subband over the
+            object) or 'background' (second moment of the background)
+        background: 3D boolean mask of the background voxels, required by
+            the 'background' method
+    '''
+    data = np.asarray(data)
+    if data.ndim not in (3, 4):
+        raise ValueError('Expected a 3D or 4D image, got %dD' % data.ndim)
+    if method == 'wavelet':
+        estimate = _sigma_wavelet
+    elif method == 'background':
+        if background is None:
+            raise ValueError("The 'background' method requires a background "
+                             "mask")
+        background = np.asarray(background, dtype=bool)
+        estimate = lambda volume: _sigma_background(volume, background)
+    else:
+        raise ValueError("Unknown noise estimation method '%s' (expected "
+                         "'wavelet' or 'background')" % method)
+    if data.ndim == 3:
+        return float(estimate(data))
+    return np.array([estimate(data[..., i]) for i in range(data.shape[3])])
+
+
+def _tile_medians(values, tile):
+    '''
+    Median of |values| over non-overlapping cubic tiles of the given side
+    (the last tiles are cut). Returns the 3D array of the tile medians.
+    '''
+    shape = tuple(-(-n//tile) for n in values.shape)
+    padded = np.full([n*tile for n in shape], np.nan)
+    padded[:values.shape[0], :values.shape[1], :values.shape[2]] = \
+        np.abs(values)
+    tiles = padded.reshape(shape[0], tile, shape[1], tile, shape[2], tile)
+    tiles = tiles.transpose(0, 2, 4, 1, 3, 5).reshape(shape+(tile**3,))
+    with warnings.catch_warnings():
+        # tiles without any value give nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(tiles, axis=3)
+
+
+def _sigma_map(volume, tile):
+    lll, hhh = _wavelet_subbands(volume)
+    global_mad = np.median(np.abs(_object_coefficients(lll, hhh)))
+    # tiles of the background use the global estimate
+    hhh = np.where(lll > 3.0*global_mad/_MAD_SCALE, hhh, np.nan)
+    medians = _tile_medians(hhh, tile)
+    medians[np.isnan(medians)] = global_mad
+    # back to the voxel grid: each coefficient covers 2 voxels along each axis
+    sigma = medians/_MAD_SCALE
+    for axis in range(3):
+        sigma = np.repeat(sigma, 2*tile, axis=axis)
+    padded = [(0, max(0, n-m)) for n, m in zip(volume.shape, sigma.shape)]
+    sigma = np.pad(sigma, padded, mode='edge')
+    return sigma[:volume.shape[0], :volume.shape[1], :volume.shape[2]]
+
+
+def estimate_sigma_map(data, tile=8):
+    '''
+    Local version of estimate_sigma (wavelet method): the median absolute
+    value of the HHH coefficients of the object is taken over tiles of
+    tile^3 coefficients (2*tile voxels along each axis). Tiles without
+    object coefficients get the global estimate. Returns an array of the
+    shape of data.
+    Parameters
+    ----------
+        data: 3D image or 4D image (volumes indexed by the last dimension)
+        tile: side of the tiles, in wavelet coefficients
+    '''
+    data = np.asarray(data)
+    if data.ndim == 3:
+        return _sigma_map(data, tile)
+    if data.ndim != 4:
+        raise ValueError('Expected a 3D or 4D image, got %dD' % data.ndim)
+    out = np.empty(data.shape)
+    for i in range(data.shape[3]):
+        out[..., i] = _sigma_map(data[..., i], tile)
+    return out
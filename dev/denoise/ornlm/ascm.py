@@ -1,12 +1,28 @@
-import math
-
 import numpy as np
 
-from wavelet import dwt3D
-from wavelet import idwt3D
+from decomposition import decompose
+
+
+def _blend(y, u, o, T, out, tmp):
+    '''
+    Sigmoid mixing of one pair of subbands, without temporaries: writes
+    dist*u + (1-dist)*o into 'out', with dist=1/(1+exp(-0.01*(|y|-T))).
+    'tmp' is a work array of the same shape and dtype.
+    '''
+    dist=np.abs(y, out=tmp)
+    dist-=T
+    dist*=-0.01
+    np.exp(dist, out=dist)
+    dist+=1
+    np.reciprocal(dist, out=dist)
+    np.multiply(dist, u, out=out)
+    np.subtract(1, dist, out=dist)
+    dist*=o
+    out+=dist
+    return out
 
 
-def ascm(ima,fimau,fimao,h):
+def ascm(ima,fimau,fimao,h,dtype=np.float64):
     '''
     Adaptive Soft (wavelet) Coefficient Mixing proposed by P. Coupe et al.
     Combines two filtered 3D-images at different resolutions and the orginal
@@ -26,6 +42,12 @@ def ascm(ima,fimau,fimao,h):
             the pixel value and x and y are independent realizations of a 
             random variable with Normal distribution, with mean=0 and 
             standard deviation=h
+        ima, fimau and fimao may also be given as their
+        WaveletDecomposition, e.g. to try several values of h without
+        recomputing the transforms.
+        dtype: np.float64 or np.float32, precision of the transforms of the
+            inputs given as arrays. The mixing is done in place, in the
+            precision of the decompositions
     References
     ----------
     Pierrick Coupe - pierrick.coupe@gmail.com                                  
@@ -40,46 +62,21 @@ def ascm(ima,fimau,fimao,h):
     *           P. Coupe a, J. V. Manjon, M. Robles , D. L. Collin         * 
     ************************************************************************
     '''
-    s=fimau.shape;
-    p=[0,0,0]
-    p[0]=2**math.ceil(math.log(s[0],2))
-    p[1]=2**math.ceil(math.log(s[1],2))
-    p[2]=2**math.ceil(math.log(s[2],2))
-    pad1=np.zeros((p[0],p[1],p[2]));
-    pad2=np.zeros((p[0],p[1],p[2]));
-    pad3=np.zeros((p[0],p[1],p[2]));
-    pad1[:s[0], :s[1], :s[2]]=fimau[:,:,:]
-    pad2[:s[0], :s[1], :s[2]]=fimao[:,:,:]
-    pad3[:s[0], :s[1], :s[2]]=ima[:,:,:]
-    af = np.array([  [0, -0.01122679215254],
-            [0, 0.01122679215254],
-            [-0.08838834764832,   0.08838834764832],
-            [0.08838834764832,   0.08838834764832],
-            [0.69587998903400,  -0.69587998903400],
-            [0.69587998903400,   0.69587998903400],
-            [0.08838834764832,  -0.08838834764832],
-            [-0.08838834764832,  -0.08838834764832],
-            [0.01122679215254,                  0],
-            [0.01122679215254,                  0]])
-    sf=np.array(af[::-1,:])
-    w1= dwt3D.dwt3D(pad1,1,af)
-    w2= dwt3D.dwt3D(pad2,1,af)
-    w3= dwt3D.dwt3D(pad3,1,af)
+    w1= decompose(fimau, dtype)
+    w2= decompose(fimao, dtype)
+    w3= decompose(ima, dtype)
+    tmp = np.empty_like(w3.highpass[0])
+    high = [None]*7
     for i in xrange(7):
-        tmp = np.array(w3[0][i])
-        tmp = tmp[:(s[0]//2), :(s[1]//2), :(s[2]//2)]
-        sigY = np.std(tmp, ddof=1)
+        sigY = w3.subband_std(i)
         sigX = (sigY*sigY) - h*h
         if sigX<0:
-            T=abs(w3[0][i]).max()
+            T=np.abs(w3.highpass[i], out=tmp).max()
         else:
             T=(h*h)/(sigX**0.5)
-        w3[0][i]=abs(w3[0][i])
-        dist=np.array(w3[0][i])-T
-        dist=np.exp(-0.01*dist)
-        dist=1./(1+dist)
-        w3[0][i]=dist*w1[0][i] + (1-dist)*w2[0][i]
-    w3[1]=w1[1]
-    fima= idwt3D.idwt3D(w3,1,sf)
-    fima=fima[:s[0], :s[1], :s[2]]
+        high[i]=_blend(w3.highpass[i], w1.highpass[i], w2.highpass[i], T,
+                       np.empty_like(tmp), tmp)
+    # only w1's low-pass subband is needed by the reconstruction
+    del w2, w3, tmp
+    fima= w1.reconstruct([high, w1.lowpass])
     return fima
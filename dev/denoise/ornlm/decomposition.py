@@ -0,0 +1,73 @@
+import numpy as np
+
+from wavelet import dwt3D
+from wavelet import idwt3D
+
+__all__ = ['af', 'sf', 'WaveletDecomposition', 'decompose']
+
+# analysis and synthesis filters of the subband mixing algorithms (hsm, ascm),
+# the filter bank module is on the path once the wavelet modules are imported
+from filterbank import farras_af as af
+sf = np.array(af[::-1,:])
+
+
+class WaveletDecomposition(object):
+    '''
+    One level 3D wavelet decomposition (dwt3D with the 'af' filters) of an
+    image, computed once. hsm and ascm accept it in place of the image, so
+    trying several mixing strategies, or sweeping ascm's 'h' parameter, on
+    the same filtered images does not recompute their transforms.
+    The subbands must not be modified: the mixing algorithms build new
+    lists of subbands and pass them to reconstruct().
+    Parameters
+    ----------
+        image: 3D array, the image to be decomposed
+        dtype: np.float64 or np.float32, precision of the transform (and of
+            the mixing that uses it). float32 halves the memory used by the
+            subbands of large volumes
+    '''
+    def __init__(self, image, dtype=np.float64):
+        image = np.asarray(image, dtype=dtype)
+        self.shape = image.shape
+        self.dtype = image.dtype
+        self.w = dwt3D.dwt3D(image, 1, af)
+        self._std = {}
+
+    @property
+    def highpass(self):
+        '''the 7 high-pass subbands'''
+        return self.w[0]
+
+    @property
+    def lowpass(self):
+        '''the low-pass subband'''
+        return self.w[1]
+
+    def subband_std(self, i):
+        '''
+        Standard deviation (ddof=1) of the high-pass subband i, restricted
+        to the coefficients of the image (without the extension added by
+        dwt3D for odd sizes). Cached, it does not depend on the mixing.
+        '''
+        if i not in self._std:
+            s = self.shape
+            band = self.w[0][i][:(s[0]//2), :(s[1]//2), :(s[2]//2)]
+            self._std[i] = np.std(band, ddof=1)
+        return self._std[i]
+
+    def reconstruct(self, w):
+        '''
+        Inverse transform (idwt3D) of the subbands w=[highpass, lowpass],
+        cropped to the shape of the decomposed image.
+        '''
+        return idwt3D.idwt3D(w, 1, sf, self.shape)
+
+
+def decompose(x, dtype=np.float64):
+    '''
+    Returns x if it is already a WaveletDecomposition, else its
+    decomposition with the given precision.
+    '''
+    if isinstance(x, WaveletDecomposition):
+        return x
+    return WaveletDecomposition(x, dtype)
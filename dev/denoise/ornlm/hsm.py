@@ -1,9 +1,6 @@
-import math
-
 import numpy as np
 
-from wavelet import dwt3D
-from wavelet import idwt3D
+from decomposition import decompose
 
 
 def hsm(fimau, fimao):
@@ -13,10 +10,10 @@ def hsm(fimau, fimao):
     resulting combined image.
     Parameters
     ----------
-        fimau : 3D double array,
+        fimau : 3D double array (or its WaveletDecomposition),
             filtered image with optimized non-local means using a small block 
             (suggested:3x3), which corresponds to a "high resolution" filter.
-        fimao : 3D double array,
+        fimao : 3D double array (or its WaveletDecomposition),
             filtered image with optimized non-local means using a small block 
             (suggested:5x5), which corresponds to a "low resolution" filter.
     References
@@ -40,36 +37,16 @@ def hsm(fimau, fimao):
     *  International Journal of Biomedical Imaging, 2008                   * 
     ************************************************************************
     '''
-    s=fimau.shape;
-    p=[0,0,0]
-    p[0]=2**math.ceil(math.log(s[0],2))
-    p[1]=2**math.ceil(math.log(s[1],2))
-    p[2]=2**math.ceil(math.log(s[2],2))
-    pad1=np.zeros((p[0],p[1],p[2]));
-    pad2=np.zeros((p[0],p[1],p[2]));
-    pad1[:s[0], :s[1], :s[2]]=fimau;
-    pad2[:s[0], :s[1], :s[2]]=fimao;
-    af = np.array([  [0, -0.01122679215254],
-            [0, 0.01122679215254],
-            [-0.08838834764832,   0.08838834764832],
-            [0.08838834764832,   0.08838834764832],
-            [0.69587998903400,  -0.69587998903400],
-            [0.69587998903400,   0.69587998903400],
-            [0.08838834764832,  -0.08838834764832],
-            [-0.08838834764832,  -0.08838834764832],
-            [0.01122679215254,                  0],
-            [0.01122679215254,                  0]]);
-    sf=np.array(af[::-1,:])
-    w1= dwt3D.dwt3D(pad1,1,af);
-    w2= dwt3D.dwt3D(pad2,1,af);
-    #w1[0][2] = (w2[0][2]+w1[0][2])/2;
-    #w1[0][4] = (w2[0][4]+w1[0][4])/2;
-    #w1[0][5] = (w2[0][5]+w1[0][5])/2;
-    #w1[0][6] = (w2[0][6]+w1[0][6])/2;
-    w1[0][2] = w2[0][2]
-    w1[0][4] = w2[0][4]
-    w1[0][5] = w2[0][5]
-    w1[0][6] = w2[0][6]
-    fima = idwt3D.idwt3D(w1,1,sf);
-    fima = fima[:s[0],:s[1],:s[2]];
+    w1= decompose(fimau)
+    w2= decompose(fimao)
+    high = list(w1.highpass)
+    #high[2] = (w2.highpass[2]+high[2])/2;
+    #high[4] = (w2.highpass[4]+high[4])/2;
+    #high[5] = (w2.highpass[5]+high[5])/2;
+    #high[6] = (w2.highpass[6]+high[6])/2;
+    high[2] = w2.highpass[2]
+    high[4] = w2.highpass[4]
+    high[5] = w2.highpass[5]
+    high[6] = w2.highpass[6]
+    fima = w1.reconstruct([high, w1.lowpass])
     return fima
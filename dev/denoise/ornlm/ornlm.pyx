@@ -1,9 +1,19 @@
 cimport cython
 from cython.view cimport array as cvarray
+from cython.parallel cimport prange, threadid
+from libc.math cimport exp, sqrt, log, INFINITY
+import os
+import sys
 import numpy as np
-import math
+# the foreground restriction and the local moments are shared with aonlm
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from foreground import crop_to_foreground, paste_foreground
+from noise import estimate_sigma
+from moments import local_moments
 
-__all__ = ['firdn', 'upfir', 'ornlm']
+__all__ = ['firdn', 'upfir', 'local_moments', 'ornlm', 'ornlm_pair']
+
+DEF MAX_PATCH_SIDE=16
 
 cdef inline int _int_max(int a, int b): return a if a >= b else b
 cdef inline int _int_min(int a, int b): return a if a <= b else b
@@ -61,11 +71,12 @@ def _upfir_matrix(double[:,:] F, double[:] h, double[:,:] out):
     for j in range(m):
         _upfir_vector(F[:,j], h, out[:,j]);
 
-def _average_block(double[:,:,:] ima, int x, int y, int z, 
-                   double[:,:,:] average, double weight):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _average_block(double[:,:,:] ima, int x, int y, int z, 
+                         double[:,:,:] average, double weight) nogil:
     cdef int a, b, c, x_pos, y_pos, z_pos
     cdef int is_outside
-    cdef int count = 0
     cdef int neighborhoodsize=average.shape[0]//2
     for a in range(average.shape[0]):
         for b in range(average.shape[1]):
@@ -85,9 +96,12 @@ def _average_block(double[:,:,:] ima, int x, int y, int z,
                 else:
                     average[a,b,c]+= weight*(ima[y_pos,x_pos,z_pos]**2)
 
-def _value_block(double[:,:,:] estimate, double[:,:,:] Label, int x, int y, 
-                 int z, double[:,:,:] average, double global_sum, double hh):
-    cdef int is_outside, a, b, c, x_pos, y_pos, z_pos, count=0
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _value_block(double[:,:,:] estimate, double[:,:,:] Label, int x, 
+                       int y, int z, double[:,:,:] average, double global_sum,
+                       double hh) nogil:
+    cdef int is_outside, a, b, c, x_pos, y_pos, z_pos
     cdef double value = 0.0
     cdef double denoised_value =0.0
     cdef double label = 0.0
@@ -109,7 +123,7 @@ def _value_block(double[:,:,:] estimate, double[:,:,:] Label, int x, int y,
                     value = estimate[y_pos, x_pos, z_pos];
                     denoised_value  = (average[a,b,c]/global_sum) - hh;
                     if (denoised_value > 0):
-                        denoised_value = np.sqrt(denoised_value)
+                        denoised_value = sqrt(denoised_value)
                     else:
                         denoised_value = 0.0
                     value += denoised_value
@@ -117,8 +131,11 @@ def _value_block(double[:,:,:] estimate, double[:,:,:] Label, int x, int y,
                     estimate[y_pos, x_pos, z_pos] = value
                     Label[y_pos, x_pos, z_pos] = label +1
 
-def _distance(double[:,:,:] image, int x, int y, int z, 
-              int nx, int ny, int nz, int f):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef double _distance(double[:,:,:] image, int x, int y, int z, 
+                      int nx, int ny, int nz, int f) nogil:
     '''
     Computes the distance between two square subpatches of image located at 
     p and q, respectively. If the centered squares lie beyond the boundaries 
@@ -155,38 +172,246 @@ def _distance(double[:,:,:] image, int x, int y, int z,
     d=distancetotal/acu
     return d
 
-def _local_mean(double [:,:,:]ima, int x, int y, int z):
-    cdef int[:] dims=cvarray((3,), itemsize=sizeof(int), format="i")
-    dims[0]=ima.shape[0]
-    dims[1]=ima.shape[1]
-    dims[2]=ima.shape[2]
-    cdef double ss=0
-    cdef int px, py, pz, dx, dy, dz, nx, ny, nz
-    for px in range(x-1,x+2):
-        for py in range(y-1,y+2):
-            for pz in range(z-1,z+2):
-                px=(-px if px<0 else (2*dims[0]-px-1 if px>=dims[0] else px))
-                py=(-py if py<0 else (2*dims[1]-py-1 if py>=dims[1] else py))
-                pz=(-pz if pz<0 else (2*dims[2]-pz-1 if pz>=dims[2] else pz))
-                ss+=ima[px,py,pz]
-    return ss/27.0
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef double _distance_padded(double[:,:,::1] padded, int x, int y, int z, 
+                             int nx, int ny, int nz, int f, 
+                             double cutoff) nogil:
+    '''
+    Same as _distance, on the image mirrored by f voxels (see _mirror_pad): 
+    the patches are read without bounds checks, row by row along the 
+    contiguous axis, in the same order. If the distance computed so far (a 
+    lower bound of the distance) exceeds 'cutoff' after a row, the scan 
+    stops and that partial distance is returned.
+    '''
+    cdef double distancetotal, diff
+    cdef int i, j, k, n=2*f+1
+    cdef double acu=n*n*n
+    cdef double *row1
+    cdef double *row2
+    distancetotal=0
+    for i in range(n):
+        for j in range(n):
+            row1=&padded[y+j, x+i, z]
+            row2=&padded[ny+j, nx+i, nz]
+            for k in range(n):
+                diff=row1[k]-row2[k]
+                distancetotal+=diff*diff
+            if distancetotal/acu>cutoff:
+                return distancetotal/acu
+    return distancetotal/acu
 
-def _local_variance(double[:,:,:] ima, double mean, int x, int y, int z):
-    cdef int[:] dims=cvarray((3,), itemsize=sizeof(int), format="i")
-    dims[0]=ima.shape[0]
-    dims[1]=ima.shape[1]
-    dims[2]=ima.shape[2]
-    cdef int cnt=0
-    cdef double ss=0
-    cdef int dx, dy, dz, nx, ny, nz
-    for px in range(x-1,x+2):
-        for py in range(y-1,y+2):
-            for pz in range(z-1,z+2):
-                if ((px>=0 and py>=0 and pz>0) and 
-                            (px<dims[0] and py<dims[1] and pz<dims[2])):
-                    ss+=(ima[px,py,pz]-mean)*(ima[px,py,pz]-mean)
-                    cnt+=1
-    return ss/(cnt-1)
+def _mirror_pad(image, int f):
+    '''
+    Returns the image extended by f voxels along each axis, mirrored as in 
+    _distance: without repeating the first voxel (index -n reads n) and 
+    repeating the last one (index s+n reads s-n-1).
+    '''
+    padded=np.pad(np.asarray(image, dtype=np.float64), f, mode='reflect')
+    padded=padded[:padded.shape[0]-f, :padded.shape[1]-f, :padded.shape[2]-f]
+    return np.ascontiguousarray(np.pad(padded, ((0, f),)*3, mode='symmetric'))
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _reset_block(double[:,:,:] average) nogil:
+    cdef int a, b, c
+    for a in range(average.shape[0]):
+        for b in range(average.shape[1]):
+            for c in range(average.shape[2]):
+                average[a,b,c]=0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _filter_block(double[:,:,:] image, double[:,:,::1] padded, 
+                        double[:,:,:] means, 
+                        double[:,:,:] variances, double[:,:,:] Estimate, 
+                        double[:,:,:] Label, double[:,:,:] average, 
+                        int i, int j, int k, int v, int f, double h, 
+                        double hh, double dcut) nogil:
+    '''
+    Processes the block centered at voxel (j,i,k): accumulates the weighted 
+    average of the similar blocks in its search window and adds the result to 
+    Estimate and Label. The blocks at a distance larger than dcut (INFINITY 
+    to keep them all) are discarded.
+    '''
+    cdef double epsilon = 0.00001
+    cdef double mu1 = 0.95
+    cdef double var1 = 0.5+1e-7
+    cdef double totalWeight, wmax, d, w, t1, t2
+    cdef int ni, nj, nk
+    cdef int d0=image.shape[0], d1=image.shape[1], d2=image.shape[2]
+    _reset_block(average)
+    totalWeight=0
+    if (means[j,i,k]<=epsilon) or (variances[j,i,k]<=epsilon):
+        wmax=1.0
+        _average_block(image, i, j, k, average, wmax)
+        totalWeight+=wmax
+        _value_block(Estimate, Label, i, j, k, average, totalWeight, hh)
+        return
+    wmax=0
+    for nk in range(k-v,k+v+1):
+        for ni in range(i-v,i+v+1):
+            for nj in range(j-v,j+v+1):
+                if((ni==i)and(nj==j)and(nk==k)):
+                    continue
+                if ((ni<0) or (nj<0) or (nk<0) or (nj>=d0) or 
+                        (ni>=d1) or (nk>=d2)):
+                    continue;
+                if ((means[nj,ni,nk]<=epsilon) or 
+                        (variances[nj,ni,nk]<=epsilon)):
+                    continue
+                t1 = (means[j,i,k])/(means[nj,ni,nk])
+                t2 = (variances[j,i,k])/(variances[nj,ni,nk])
+                if ((t1>mu1) and (t1<(1/mu1)) and
+                        (t2>var1) and (t2<(1/var1))):
+                    d=_distance_padded(padded, i, j, k, ni, nj, nk, f, dcut)
+                    if d>dcut:
+                        continue
+                    w=exp(-d/(h*h))
+                    if(w>wmax):
+                        wmax = w
+                    _average_block(image, ni, nj, nk, average, w)
+                    totalWeight+=w
+    if(wmax==0.0):#FIXME
+        wmax=1.0
+    _average_block(image, i, j, k, average, wmax)
+    totalWeight+=wmax
+    if(totalWeight != 0.0):
+        _value_block(Estimate, Label, i, j, k, average, totalWeight, hh)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _distance_pair(double[:,:,:] image, int x, int y, int z, 
+                         int nx, int ny, int nz, int f1, int f2, 
+                         double *d1, double *d2) nogil:
+    '''
+    Computes the distances between the patches of radius f1 and between the 
+    patches of radius f2 (f1<=f2) centered at p and q, as given by _distance. 
+    The mirrored indices of each row of the large patches are computed once 
+    and reused for the small ones.
+    '''
+    cdef double distancetotal
+    cdef int i, j, k, ni1, nj1, ni2, nj2, nk1, nk2, o
+    cdef int sx=image.shape[1], sy=image.shape[0], sz=image.shape[2]
+    cdef int n=2*f2+1
+    cdef int idx[6][MAX_PATCH_SIDE]
+    if n>MAX_PATCH_SIDE:
+        d1[0]=_distance(image, x, y, z, nx, ny, nz, f1)
+        d2[0]=_distance(image, x, y, z, nx, ny, nz, f2)
+        return
+    for o in range(-f2, f2+1):
+        ni1=x+o
+        nj1=y+o
+        nk1=z+o
+        ni2=nx+o
+        nj2=ny+o
+        nk2=nz+o
+        if(ni1<0):ni1=-ni1
+        if(nj1<0):nj1=-nj1
+        if(ni2<0):ni2=-ni2
+        if(nj2<0):nj2=-nj2
+        if(nk1<0):nk1=-nk1
+        if(nk2<0):nk2=-nk2
+        if(ni1>=sx):ni1=2*sx-ni1-1
+        if(nj1>=sy):nj1=2*sy-nj1-1
+        if(nk1>=sz):nk1=2*sz-nk1-1
+        if(ni2>=sx):ni2=2*sx-ni2-1
+        if(nj2>=sy):nj2=2*sy-nj2-1
+        if(nk2>=sz):nk2=2*sz-nk2-1
+        idx[0][o+f2]=ni1
+        idx[1][o+f2]=nj1
+        idx[2][o+f2]=nk1
+        idx[3][o+f2]=ni2
+        idx[4][o+f2]=nj2
+        idx[5][o+f2]=nk2
+    distancetotal=0
+    for i in range(f2-f1, f2+f1+1):
+        for j in range(f2-f1, f2+f1+1):
+            for k in range(f2-f1, f2+f1+1):
+                distancetotal+=(image[idx[1][j], idx[0][i], idx[2][k]]-
+                                image[idx[4][j], idx[3][i], idx[5][k]])**2
+    d1[0]=distancetotal/((2*f1+1)*(2*f1+1)*(2*f1+1))
+    distancetotal=0
+    for i in range(n):
+        for j in range(n):
+            for k in range(n):
+                distancetotal+=(image[idx[1][j], idx[0][i], idx[2][k]]-
+                                image[idx[4][j], idx[3][i], idx[5][k]])**2
+    d2[0]=distancetotal/(n*n*n)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _filter_block_pair(double[:,:,:] image, double[:,:,:] means, 
+                             double[:,:,:] variances, double[:,:,:] Estimate1, 
+                             double[:,:,:] Label1, double[:,:,:] average1, 
+                             double[:,:,:] Estimate2, double[:,:,:] Label2, 
+                             double[:,:,:] average2, int i, int j, int k, 
+                             int v, int f1, int f2, double h, 
+                             double hh) nogil:
+    '''
+    Same as _filter_block, for the blocks of radius f1 and f2 at once: the 
+    search window scan and the preselection of the neighbors are shared, and 
+    both patch distances are computed in the same pass.
+    '''
+    cdef double epsilon = 0.00001
+    cdef double mu1 = 0.95
+    cdef double var1 = 0.5+1e-7
+    cdef double totalWeight1, totalWeight2, wmax1, wmax2, d1, d2, w1, w2, t1, t2
+    cdef int ni, nj, nk
+    _reset_block(average1)
+    _reset_block(average2)
+    totalWeight1=0
+    totalWeight2=0
+    if (means[j,i,k]<=epsilon) or (variances[j,i,k]<=epsilon):
+        _average_block(image, i, j, k, average1, 1.0)
+        _average_block(image, i, j, k, average2, 1.0)
+        _value_block(Estimate1, Label1, i, j, k, average1, 1.0, hh)
+        _value_block(Estimate2, Label2, i, j, k, average2, 1.0, hh)
+        return
+    wmax1=0
+    wmax2=0
+    for nk in range(k-v,k+v+1):
+        for ni in range(i-v,i+v+1):
+            for nj in range(j-v,j+v+1):
+                if((ni==i)and(nj==j)and(nk==k)):
+                    continue
+                if ((ni<0) or (nj<0) or (nk<0) or (nj>=image.shape[0]) or 
+                        (ni>=image.shape[1]) or (nk>=image.shape[2])):
+                    continue;
+                if ((means[nj,ni,nk]<=epsilon) or 
+                        (variances[nj,ni,nk]<=epsilon)):
+                    continue
+                t1 = (means[j,i,k])/(means[nj,ni,nk])
+                t2 = (variances[j,i,k])/(variances[nj,ni,nk])
+                if ((t1>mu1) and (t1<(1/mu1)) and
+                        (t2>var1) and (t2<(1/var1))):
+                    _distance_pair(image, i, j, k, ni, nj, nk, f1, f2, &d1, &d2)
+                    w1=exp(-d1/(h*h))
+                    w2=exp(-d2/(h*h))
+                    if(w1>wmax1):
+                        wmax1 = w1
+                    if(w2>wmax2):
+                        wmax2 = w2
+                    _average_block(image, ni, nj, nk, average1, w1)
+                    _average_block(image, ni, nj, nk, average2, w2)
+                    totalWeight1+=w1
+                    totalWeight2+=w2
+    if(wmax1==0.0):#FIXME
+        wmax1=1.0
+    if(wmax2==0.0):#FIXME
+        wmax2=1.0
+    _average_block(image, i, j, k, average1, wmax1)
+    _average_block(image, i, j, k, average2, wmax2)
+    totalWeight1+=wmax1
+    totalWeight2+=wmax2
+    if(totalWeight1 != 0.0):
+        _value_block(Estimate1, Label1, i, j, k, average1, totalWeight1, hh)
+    if(totalWeight2 != 0.0):
+        _value_block(Estimate2, Label2, i, j, k, average2, totalWeight2, hh)
 
 cpdef firdn(double[:,:] image, double[:] h):
     '''
@@ -222,7 +447,88 @@ cpdef upfir(double[:,:] image, double[:] h):
     _upfir_matrix(image, h, filtered)
     return filtered
 
-def ornlm(double [:,:,:]image, int v, int f, double h):
+def _aggregate(double[:,:,:] image, double[:,:,:,:] Estimates, 
+               double[:,:,:,:] Labels):
+    '''
+    Reduces the per-thread Estimate/Label volumes and computes the filtered 
+    image (voxels never reached by a block keep their original value).
+    '''
+    cdef double[:,:,:] fima=np.zeros_like(image)
+    cdef double estimate, label
+    cdef int i, j, k, t
+    for k in range(0, image.shape[2]):
+        for i in range(0, image.shape[1]):
+            for j in range(0, image.shape[0]):
+                estimate=Estimates[0,j,i,k]
+                label=Labels[0,j,i,k]
+                for t in range(1, Estimates.shape[0]):
+                    estimate+=Estimates[t,j,i,k]
+                    label+=Labels[t,j,i,k]
+                if(label==0.0):
+                    fima[j,i,k]=image[j,i,k]
+                else:
+                    fima[j,i,k]=estimate/label
+    return fima
+
+def _moments_in(image, search):
+    '''
+    Local moments of the image (see local_moments). The means outside the
+    'search' mask, if given, are set to zero: the blockwise sweep then 
+    discards those voxels as candidates of the search windows, like the 
+    background voxels.
+    '''
+    means, variances=local_moments(image, 1)
+    if search is not None:
+        means[np.asarray(search)==0]=0
+    return means, variances
+
+def _weight_distance(double h, double weight_cutoff):
+    '''
+    Distance above which the weight exp(-d/h^2) of a block is below 
+    weight_cutoff (INFINITY if weight_cutoff==0: no block is discarded).
+    '''
+    if weight_cutoff<0 or weight_cutoff>=1:
+        raise ValueError('weight_cutoff must be in [0, 1)')
+    if weight_cutoff==0:
+        return INFINITY
+    return -h*h*log(weight_cutoff)
+
+def _ornlm_sweep(double [:,:,:]image, int v, int f, double h, int num_threads, 
+                 search, double weight_cutoff=0):
+    cdef int[:] dims=cvarray((3,), itemsize=sizeof(int), format="i")
+    dims[0]=image.shape[0]
+    dims[1]=image.shape[1]
+    dims[2]=image.shape[2]
+    cdef double hh=2*h*h
+    cdef int nvox=dims[0]*dims[1]*dims[2]
+    cdef double[:,:,:,:] averages=np.zeros((num_threads,2*f+1,2*f+1,2*f+1), 
+                                           dtype=np.float64)
+    cdef double[:,:,:] means, variances
+    cdef double[:,:,:,:] Estimates=np.zeros((num_threads,dims[0],dims[1],dims[2]))
+    cdef double[:,:,:,:] Labels=np.zeros((num_threads,dims[0],dims[1],dims[2]))
+    cdef int i,j,k,kb,t
+    cdef int nblocks=(dims[2]+1)//2
+    cdef int use_mask=search is not None
+    cdef unsigned char[:,:,:] centers=(search if use_mask else 
+                                       np.ones((1,1,1), dtype=np.uint8))
+    cdef double[:,:,::1] padded=_mirror_pad(image, f)
+    cdef double dcut=_weight_distance(h, weight_cutoff)
+    means, variances=_moments_in(image, search)
+    for kb in prange(nblocks, nogil=True, schedule='dynamic', 
+                     num_threads=num_threads):
+        t=threadid()
+        k=2*kb
+        for i in range(0, dims[1], 2):
+            for j in range(0, dims[0], 2):
+                if use_mask and centers[j,i,k]==0:
+                    continue
+                _filter_block(image, padded, means, variances, Estimates[t], 
+                              Labels[t], averages[t], i, j, k, v, f, h, hh, 
+                              dcut)
+    return _aggregate(image, Estimates, Labels)
+
+def ornlm(double [:,:,:]image, int v, int f, h, int num_threads=1, 
+          mask=None, double weight_cutoff=0):
     '''
     Filters the given 3D image using optimized non-local means, proposed by
     P. Coupe et al. Returns the filtered image.
@@ -237,79 +543,115 @@ def ornlm(double [:,:,:]image, int v, int f, double h):
             Coupe et al. the rician noise was simulated as 
             sqrt((f+x)^2 + (y)^2) where f is the pixel value and x and y are 
             independent realizations of a random variable with Normal 
-            distribution, with mean=0 and standard deviation=h
+            distribution, with mean=0 and standard deviation=h. If None, it
+            is estimated from the image (see noise.estimate_sigma)
+        num_threads: number of OpenMP threads used for the blockwise sweep.
+            The slices of the (stride 2) block grid are distributed among the 
+            threads, each of which accumulates into its own Estimate/Label 
+            volumes, reduced at the end. With num_threads=1 the output is 
+            identical to the sequential implementation.
+        mask: optional foreground (3D array of the image shape, nonzero 
+            inside) or bounding box (three (start, stop) pairs). Only the 
+            blocks overlapping the foreground are filtered, searching for 
+            similar blocks among them, and the voxels outside the foreground 
+            are returned unchanged
+        weight_cutoff: the similar blocks whose weight exp(-d/h^2) would be 
+            below this value are discarded, and their distance computation 
+            is stopped as soon as the partial distance exceeds the 
+            corresponding threshold. 0 (default) keeps all the blocks, 
+            giving the exact output; small values (e.g. 1e-3) trade some 
+            accuracy for speed, mostly on the blocks without similar blocks, 
+            which are then left as they are
     '''
+    if num_threads<1:
+        raise ValueError('num_threads must be positive')
+    if h is None:
+        h=estimate_sigma(image)
+    if mask is None:
+        return _ornlm_sweep(image, v, f, h, num_threads, None, weight_cutoff)
+    region=crop_to_foreground(mask, 
+                              (image.shape[0], image.shape[1], image.shape[2]), 
+                              f)
+    if region is None:
+        return np.array(image)
+    box, search, fg=region
+    filtered=_ornlm_sweep(np.ascontiguousarray(np.asarray(image)[box]), v, f, 
+                          h, num_threads, search, weight_cutoff)
+    return paste_foreground(image, filtered, box, fg)
+
+def _ornlm_pair_sweep(double [:,:,:]image, int v, double h, int f1, int f2, 
+                      int num_threads, search):
     cdef int[:] dims=cvarray((3,), itemsize=sizeof(int), format="i")
     dims[0]=image.shape[0]
     dims[1]=image.shape[1]
     dims[2]=image.shape[2]
     cdef double hh=2*h*h
-    cdef int Ndims=(2*f+1)**3
-    cdef int nvox=dims[0]*dims[1]*dims[2]
-    cdef double[:,:,:] average=np.zeros((2*f+1,2*f+1,2*f+1), dtype=np.float64)
-    cdef double[:,:,:] fima=np.zeros_like(image)
-    cdef double[:,:,:] means=np.zeros_like(image)
-    cdef double[:,:,:] variances=np.zeros_like(image)
-    cdef double[:,:,:] Estimate=np.zeros_like(image)
-    cdef double[:,:,:] Label=np.zeros_like(image)
-    cdef int i,j,k, ni, nj, nk
-    cdef double mm
-    for k in range(dims[2]):
-        for i in range(dims[1]):
-            for j in range(dims[0]):
-                mm=_local_mean(image,j,i,k)
-                means[j,i,k]=mm
-                variances[j,i,k]=_local_variance(image, mm, j, i, k)
-    cdef double epsilon = 0.00001
-    cdef double mu1 = 0.95
-    cdef double var1 = 0.5+1e-7
-    cdef double totalWeight, wmax, d, w
-    for k in range(0, dims[2], 2):
+    cdef double[:,:,:,:] averages1=np.zeros((num_threads,2*f1+1,2*f1+1,2*f1+1), 
+                                            dtype=np.float64)
+    cdef double[:,:,:,:] averages2=np.zeros((num_threads,2*f2+1,2*f2+1,2*f2+1), 
+                                            dtype=np.float64)
+    cdef double[:,:,:] means, variances
+    cdef double[:,:,:,:] Estimates1=np.zeros((num_threads,dims[0],dims[1],dims[2]))
+    cdef double[:,:,:,:] Labels1=np.zeros((num_threads,dims[0],dims[1],dims[2]))
+    cdef double[:,:,:,:] Estimates2=np.zeros((num_threads,dims[0],dims[1],dims[2]))
+    cdef double[:,:,:,:] Labels2=np.zeros((num_threads,dims[0],dims[1],dims[2]))
+    cdef int i,j,k,kb,t
+    cdef int nblocks=(dims[2]+1)//2
+    cdef int use_mask=search is not None
+    cdef unsigned char[:,:,:] centers=(search if use_mask else 
+                                       np.ones((1,1,1), dtype=np.uint8))
+    means, variances=_moments_in(image, search)
+    for kb in prange(nblocks, nogil=True, schedule='dynamic', 
+                     num_threads=num_threads):
+        t=threadid()
+        k=2*kb
         for i in range(0, dims[1], 2):
             for j in range(0, dims[0], 2):
-                average[...]=0
-                totalWeight=0
-                if (means[j,i,k]<=epsilon) or (variances[j,i,k]<=epsilon):
-                    wmax=1.0
-                    _average_block(image, i, j, k, average, wmax)
-                    totalWeight+=wmax
-                    _value_block(Estimate, Label, i, j, k, 
-                                 average, totalWeight, hh)
-                else:
-                    wmax=0
-                    for nk in range(k-v,k+v+1):
-                        for ni in range(i-v,i+v+1):
-                            for nj in range(j-v,j+v+1):
-                                if((ni==i)and(nj==j)and(nk==k)):
-                                    continue
-                                if ((ni<0) or (nj<0) or (nk<0) or (nj>=dims[0]) or 
-                                        (ni>=dims[1]) or (nk>=dims[2])):
-                                    continue;
-                                if ((means[nj,ni,nk]<=epsilon) or 
-                                        (variances[nj,ni,nk]<=epsilon)):
-                                    continue
-                                t1 = (means[j,i,k])/(means[nj,ni,nk])
-                                t2 = (variances[j,i,k])/(variances[nj,ni,nk])
-                                if ((t1>mu1) and (t1<(1/mu1)) and
-                                        (t2>var1) and (t2<(1/var1))):
-                                    d=_distance(image, i, j, k, ni, nj, nk, f)
-                                    w=math.exp(-d/(h*h))
-                                    if(w>wmax):
-                                        wmax = w
-                                    _average_block(image, ni, nj, nk, average, w)
-                                    totalWeight+=w
-                    if(wmax==0.0):#FIXME
-                        wmax=1.0
-                    _average_block(image, i, j, k, average, wmax)
-                    totalWeight+=wmax
-                    if(totalWeight != 0.0):
-                        _value_block(Estimate, Label, i, j, k, 
-                                     average, totalWeight, hh)
-    for k in range(0, image.shape[2]):
-        for i in range(0, image.shape[1]):
-            for j in range(0, image.shape[0]):
-                if(Label[j,i,k]==0.0):
-                    fima[j,i,k]=image[j,i,k]
-                else:
-                    fima[j,i,k]=Estimate[j,i,k]/Label[j,i,k]
-    return fima
+                if use_mask and centers[j,i,k]==0:
+                    continue
+                _filter_block_pair(image, means, variances, 
+                                   Estimates1[t], Labels1[t], averages1[t], 
+                                   Estimates2[t], Labels2[t], averages2[t], 
+                                   i, j, k, v, f1, f2, h, hh)
+    return (_aggregate(image, Estimates1, Labels1), 
+            _aggregate(image, Estimates2, Labels2))
+
+def ornlm_pair(double [:,:,:]image, int v, h, int f1=1, int f2=2, 
+               int num_threads=1, mask=None):
+    '''
+    Fused version of ornlm: filters the given 3D image with two block sizes 
+    in a single sweep, sharing the search window scan, the preselection of 
+    the neighbors and the patch distance computation. Returns the pair 
+    (ornlm(image, v, f1, h), ornlm(image, v, f2, h)), typically the "high 
+    resolution" (fimau) and "low resolution" (fimao) inputs of hsm/ascm.
+    Parameters
+    ----------
+        image: the input image, corrupted with rician noise
+        v:  radius of the search window (see ornlm)
+        h:  the estimated amount of rician noise in the input image, or None
+            to estimate it (see ornlm)
+        f1: radius of the small blocks
+        f2: radius of the large blocks, f2>=f1
+        num_threads: number of OpenMP threads used for the blockwise sweep 
+            (see ornlm)
+        mask: optional foreground or bounding box (see ornlm)
+    '''
+    if num_threads<1:
+        raise ValueError('num_threads must be positive')
+    if f1>f2:
+        raise ValueError('f1 must not be larger than f2')
+    if h is None:
+        h=estimate_sigma(image)
+    if mask is None:
+        return _ornlm_pair_sweep(image, v, h, f1, f2, num_threads, None)
+    region=crop_to_foreground(mask, 
+                              (image.shape[0], image.shape[1], image.shape[2]), 
+                              f2)
+    if region is None:
+        return np.array(image), np.array(image)
+    box, search, fg=region
+    filtered1, filtered2=_ornlm_pair_sweep(
+        np.ascontiguousarray(np.asarray(image)[box]), v, h, f1, f2, num_threads, 
+        search)
+    return (paste_foreground(image, filtered1, box, fg), 
+            paste_foreground(image, filtered2, box, fg))
@@ -46,7 +46,8 @@ setup(
     cmdclass=cmdclass,
     ext_modules=[Extension("ornlm", ["ornlm.pyx"],
                            include_dirs=get_numpy_include_dirs(),
-                           extra_compile_args=["-msse2 -mfpmath=sse"],
+                           extra_compile_args=["-msse2 -mfpmath=sse", "-fopenmp"],
+                           extra_link_args=["-fopenmp"],
                            language="c++")]
 )
 #Note on the usage of -msse and -mfpmath-sse compiler options
@@ -1,6 +1,9 @@
 from sfb3D import sfb3D
-def idwt3D(w, J, sf):
+def idwt3D(w, J, sf, shape=None):
     y=w[J];
     for k in range(J)[::-1]:
         y=sfb3D(y, w[k], sf, sf, sf);
+    # crop the extension added by dwt3D for sizes not multiple of 2**J
+    if shape is not None:
+        y=y[:shape[0], :shape[1], :shape[2]]
     return y
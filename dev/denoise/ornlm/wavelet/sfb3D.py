@@ -1,34 +1,13 @@
-from ornlm import upfir
-import numpy as np
-from cshift3D import cshift3D
-def permutationInverse(perm):
-    inverse = [0] * len(perm)
-    for i, p in enumerate(perm):
-        inverse[p] = i
-    return inverse
+import os
+import sys
+# the filter bank is shared by the wavelet modules of ornlm and aonlm
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+from filterbank import sfb_axis
 
 def sfb3D_A(lo, hi, sf, d):
-    lpf=sf[:, 0]
-    hpf=sf[:, 1]
-    # permute dimensions of lo and hi so that dimension d is first.
-    p=[(i+d)%3 for i in xrange(3)]
-    lo=lo.transpose(p)
-    hi=hi.transpose(p)
-
-    (N1, N2, N3)=lo.shape
-    N=2*N1
-    L=sf.shape[0]
-    y=np.zeros((N+L-2, N2, N3))
-    for k in xrange(N3):
-        y[:, :, k] = (np.array(upfir(lo[:, :, k], lpf)) + 
-                     np.array(upfir(hi[:, :, k], hpf)))
-    y[:(L-2), :, :] = y[:(L-2), :, :] + y[N:(N+L-2), :, :]
-    y=y[:N, :, :]
-    y=cshift3D(y, 1-L/2, 0);
-    #permute dimensions of y (inverse permutation)
-    q=permutationInverse(p)
-    y=y.transpose(q);
-    return y
+    # filter along dimension d (see filterbank.sfb_axis)
+    return sfb_axis(lo, hi, sf, d)
 
 def sfb3D(lo, hi, sf1, sf2=None, sf3=None):
     if sf2==None:
@@ -51,6 +30,7 @@ def sfb3D(lo, hi, sf1, sf2=None, sf3=None):
     # filter along dimension 1
     L=sfb3D_A(LL, LH, sf2, 1);
     H=sfb3D_A(HL, HH, sf2, 1);
+    del LL, LH, HL, HH
     # filter along dimension 0
     y=sfb3D_A(L, H, sf1, 0);
     return y
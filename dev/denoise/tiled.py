@@ -0,0 +1,207 @@
+'''
+Out-of-core filtering of large volumes with ornlm: the volume is split into
+bricks (tiles) which are filtered one at a time with a halo of neighboring
+voxels, and written to the output, so the memory used only depends on the
+size of the bricks.
+'''
+import numpy as np
+
+__all__ = ['ornlm_tiled', 'denoise_nifti', 'check_tiled']
+
+
+def _halo(v, f):
+    # a voxel is written by the blocks centered at most f voxels away, which
+    # compare their patches with those of the candidates at most v voxels
+    # away from them: the filtered value depends on the input up to v+2f
+    # voxels away (and on the local moments of the candidates, up to v+f+1
+    # voxels away). The local moments are only those of the whole volume
+    # from the index 2 of a brick: its first slice is never used in the
+    # variances (see local_moments) and its means are mirrored at the edge,
+    # so the halo keeps the candidates at index >= 2 (v+f+2). It is even to
+    # keep the (stride 2) block grid
+    halo = max(v+2*f, v+f+2)
+    return halo+halo % 2
+
+
+def _bricks(shape, tile, halo):
+    '''
+    Yields the (core, padded) tuples of slices of the bricks: 'core' is the
+    region written to the output and 'padded' the region read from the input
+    (the core extended by the halo, clipped to the volume).
+    '''
+    starts = [range(0, n, tile) for n in shape]
+    for i in starts[0]:
+        for j in starts[1]:
+            for k in starts[2]:
+                core = []
+                padded = []
+                for start, n in zip((i, j, k), shape):
+                    stop = min(n, start+tile)
+                    core.append(slice(start, stop))
+                    padded.append(slice(max(0, start-halo),
+                                        min(n, stop+halo)))
+                yield tuple(core), tuple(padded)
+
+
+def ornlm_tiled(image, v, f, h, tile=64, num_threads=1, out=None,
+                progress=None):
+    '''
+    Filters the given 3D image with ornlm, brick by brick. Each brick of
+    tile^3 voxels is filtered together with a halo of max(v+2f, v+f+2)
+    voxels (rounded up to even), which is enough to obtain the same values as filtering the
+    whole image at once. Returns the filtered image ('out' if given).
+    Parameters
+    ----------
+        image: 3D array-like supporting slicing, e.g. a numpy memmap or the
+            dataobj of a nibabel image: only the bricks are read
+        v:  radius of the search window (see ornlm)
+        f:  radius of the blocks (see ornlm)
+        h:  the estimated amount of rician noise (see ornlm), required
+        tile: side of the bricks, even
+        num_threads: number of OpenMP threads used to filter each brick
+        out: optional 3D array-like (e.g. a writable memmap) receiving the
+            result, a float64 array is allocated if None
+        progress: optional callable progress(ndone, nbricks), called each
+            time a brick has been written
+    '''
+    from .ornlm.ornlm import ornlm
+    if h is None:
+        raise ValueError("The noise level 'h' is required")
+    if tile < 2 or tile % 2:
+        raise ValueError('The tile size must be even and positive')
+    shape = tuple(image.shape)
+    if len(shape) != 3:
+        raise ValueError('Expected a 3D image, got %dD' % len(shape))
+    if out is None:
+        out = np.empty(shape)
+    halo = _halo(v, f)
+    bricks = list(_bricks(shape, tile, halo))
+    for ndone, (core, padded) in enumerate(bricks):
+        brick = np.ascontiguousarray(image[padded], dtype=np.float64)
+        filtered = np.asarray(ornlm(brick, v, f, h, num_threads))
+        inner = tuple(slice(c.start-p.start, c.stop-p.start)
+                      for c, p in zip(core, padded))
+        out[core] = filtered[inner]
+        if progress is not None:
+            progress(ndone+1, len(bricks))
+    return out
+
+
+def _central_brick(dataobj, shape, side):
+    center = tuple(slice(max(0, n//2-side//2), n//2-side//2+side)
+                   for n in shape[:3])
+    return np.asarray(dataobj[center+(slice(None),)*(len(shape)-3)])
+
+
+class _VolumeView(object):
+    '''
+    3D view of one volume of a 4D array-like, read on slicing.
+    '''
+    def __init__(self, dataobj, volume, shape):
+        self.dataobj = dataobj
+        self.volume = volume
+        self.shape = shape
+
+    def __getitem__(self, index):
+        return self.dataobj[index+(self.volume,)]
+
+
+def denoise_nifti(in_file, out_file, v=3, f=1, h=None, tile=64,
+                  num_threads=1, progress=None):
+    '''
+    Filters a 3D or 4D NIfTI image with ornlm out of core: the input is read
+    brick by brick from the (memory mapped, for uncompressed files) image and
+    the result is written brick by brick to a memory mapped float32 NIfTI
+    file, so the memory used only depends on the size of the bricks. Each
+    volume of a 4D image is filtered separately.
+    Parameters
+    ----------
+        in_file: the input image (.nii, or .nii.gz which is read sequentially)
+        out_file: the output image, uncompressed (.nii)
+        v:  radius of the search window (see ornlm)
+        f:  radius of the blocks (see ornlm)
+        h:  the estimated amount of rician noise. If None, it is estimated on
+            the central brick of side 2*tile of each volume (see
+            noise.estimate_sigma)
+        tile: side of the bricks (see ornlm_tiled)
+        num_threads: number of OpenMP threads used to filter each brick
+        progress: optional callable progress(volume, ndone, nbricks)
+    '''
+    import nibabel as nib
+    from .noise import estimate_sigma
+    if out_file.endswith('.gz'):
+        raise ValueError('The output image must be uncompressed to be memory '
+                         'mapped')
+    image = nib.load(in_file)
+    shape = image.shape
+    if len(shape) not in (3, 4):
+        raise ValueError('Expected a 3D or 4D image, got %dD' % len(shape))
+    # header of the output: geometry of the input, float32 data without
+    # scaling nor extensions
+    header = nib.Nifti1Header.from_header(image.header)
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    header.set_data_offset(0)
+    del header.extensions[:]
+    with open(out_file, 'wb') as fobj:
+        header.write_to(fobj)
+        offset = header.get_data_offset()
+        fobj.seek(offset+4*int(np.prod(shape))-1)
+        fobj.write(b'\0')
+    out = np.memmap(out_file, dtype=np.float32, mode='r+', offset=offset,
+                    shape=shape, order='F')
+    dataobj = image.dataobj
+    if h is None:
+        sigma = estimate_sigma(_central_brick(dataobj, shape, 2*tile))
+    volumes = [None] if len(shape) == 3 else range(shape[3])
+    for n, volume in enumerate(volumes):
+        if volume is None:
+            source, target = dataobj, out
+        else:
+            source = _VolumeView(dataobj, volume, shape[:3])
+            target = out[..., volume]
+        if h is None:
+            h_volume = sigma if volume is None else sigma[volume]
+        else:
+            h_volume = h
+        report = None
+        if progress is not None:
+            report = lambda ndone, total, n=n: progress(n, ndone, total)
+        ornlm_tiled(source, v, f, h_volume, tile, num_threads, target, report)
+    out.flush()
+    del out
+
+
+def check_tiled(v, f, shape=(40, 36, 44), tile=8, sigma=10.0, seed=0):
+    '''
+    Filters a synthetic noisy volume with ornlm_tiled and with ornlm on the
+    whole volume, and returns the maximum absolute difference of the two
+    outputs (0 if the halo is large enough).
+    Parameters
+    ----------
+        v:  radius of the search window (see ornlm)
+        f:  radius of the blocks (see ornlm)
+        shape: shape of the volume, larger than a few bricks
+        tile: side of the bricks, even
+        sigma: standard deviation of the rician noise
+        seed: seed of the random generator of the noise
+    '''
+    from .ornlm.ornlm import ornlm
+    rng = np.random.RandomState(seed)
+    clean = np.zeros(shape)
+    clean[tuple(slice(n//5, n-n//5) for n in shape)] = 100
+    clean[tuple(slice(n//3, n//2) for n in shape)] = 200
+    real = clean+rng.normal(0, sigma, shape)
+    imaginary = rng.normal(0, sigma, shape)
+    noisy = np.sqrt(real*real+imaginary*imaginary)
+    whole = np.asarray(ornlm(noisy, v, f, sigma))
+    tiled = ornlm_tiled(noisy, v, f, sigma, tile)
+    return float(np.abs(tiled-whole).max())
+
+
+if __name__ == '__main__':
+    # python -m denoise.tiled: checks that the tiling does not change the
+    # output of ornlm
+    for v, f in ((2, 1), (3, 1)):
+        print('v=%d f=%d: max |tiled-whole| = %g' % (v, f, check_tiled(v, f)))